@@ -0,0 +1,297 @@
+"""asyncio client for Bluefin 1.5 kWh batteries.
+
+AsyncSBM mirrors the SBM command surface, but every command is a coroutine
+that awaits its reply frame with a deadline instead of blocking the thread.
+Batteries on separate ports can be polled concurrently from one event loop:
+
+    python bluefin/scripts/async_sbm.py /dev/ttyUSB0 /dev/ttyUSB1
+"""
+
+import asyncio
+import sys
+import time
+
+import serial
+
+from balance import (ACK_FIELDS, ACK_WINDOW, ADDRESS_FIELDS, BALANCE_FIELDS, BAUDRATE,
+                     POLL_INTERVAL, Q0_FIELDS, Q1_FIELDS, SNAPSHOT, Z0_FIELDS,
+                     describe_error, describe_state, format_address,
+                     parse_address, parse_balance, parse_cell_voltages, parse_summary,
+                     parse_version_summary)
+from connections import FrameReassembler
+
+
+class AsyncSBM():
+    def __init__(self, port, address=0, timeout=1):
+        """Asynchronous connection to a Bluefin 1.5 kWh battery.
+        The port is opened by open() or by entering an async with block.
+        @param port -- the serial port the battery is attached to.
+        @param address -- the battery address as a decimal value (0-250).
+        @param timeout -- the deadline in seconds for each command's reply frame.
+        """
+        self.timeout = timeout
+        self.rs485 = serial.Serial()
+        self.rs485.port = port
+        self.rs485.baudrate = BAUDRATE
+        self.rs485.timeout = 0
+        self.address = format_address(address)
+        self._frames = FrameReassembler()
+        self._last_rx = 0.0
+        self._data = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._loop = None
+        self._reader = False
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, et, ev, etb):
+        self.close()
+
+    async def open(self):
+        try:
+            self.rs485.open()
+            self.rs485.reset_input_buffer()
+            self.rs485.reset_output_buffer()
+        except serial.SerialException:
+            msg = f"Unable to connect to Bluefin 1.5 kWh battery on port {self.rs485.port}."
+            raise ConnectionError(msg)
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._loop.add_reader(self.rs485.fileno(), self._on_readable)
+            self._reader = True
+        except (NotImplementedError, AttributeError):
+            self._reader = False  # No selector support for this port, poll in_waiting instead.
+
+    def close(self):
+        if self._reader:
+            self._loop.remove_reader(self.rs485.fileno())
+            self._reader = False
+        self.rs485.close()
+
+    def _on_readable(self):
+        try:
+            data = self.rs485.read(max(1, self.rs485.in_waiting))
+        except serial.SerialException:
+            data = b''
+        if data:
+            self._frames.feed(data)
+            self._last_rx = time.monotonic()
+            self._data.set()
+
+    async def _wait_for_data(self, timeout):
+        if self._reader:
+            self._data.clear()
+            try:
+                await asyncio.wait_for(self._data.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(min(POLL_INTERVAL, timeout))
+            self._on_readable()
+
+    async def _read_frame(self, header, fields, timeout=None, quiet=None):
+        """Await a complete reply frame.
+        @param header -- the expected frame header (e.g. '$01q0').
+        @param fields -- the minimum number of fields in the frame, header included.
+        @param timeout -- the deadline in seconds. Defaults to the instance timeout.
+        @param quiet -- if set, give up once the line has been silent this many seconds.
+        @return -- the frame as bytes, or None if the deadline or quiet period expired.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        target = header.encode()
+        start_time = self._last_rx = time.monotonic()
+        while True:
+            frame = self._frames.take(target, fields)
+            if frame is not None:
+                return frame
+            now = time.monotonic()
+            remaining = timeout - (now - start_time)
+            if quiet is not None:
+                remaining = min(remaining, quiet - (now - self._last_rx))
+            if remaining <= 0:
+                return None
+            await self._wait_for_data(remaining)
+
+    def _discard_stale(self):
+        """Drop replies to earlier commands that arrived after they were given up.
+        A frame still arriving is kept, as in SBM.
+        """
+        for frame in self._frames.frames():
+            self._frames.dropped += len(frame)
+
+    async def _query(self, command, fields, timeout=None):
+        async with self._lock:
+            self._discard_stale()
+            self.rs485.write(str.encode(command + '\r\n'))
+            response = await self._read_frame('$' + command[1:5], fields, timeout)
+        if response is None:
+            msg = f"No complete reply to {command} from port {self.rs485.port}."
+            raise TimeoutError(msg)
+        return response
+
+    async def _command(self, command, wait):
+        async with self._lock:
+            self._discard_stale()
+            self.rs485.write(str.encode(command + '\r\n'))
+            return await self._read_frame('$' + command[1:5], ACK_FIELDS,
+                                          timeout=max(wait, self.timeout), quiet=ACK_WINDOW)
+
+    async def get_summary(self):
+        response = await self._query(f'#{self.address}q0', Q0_FIELDS)
+        return parse_summary(response)
+
+    async def get_version_summary(self):
+        response = await self._query(f'#{self.address}z0', Z0_FIELDS)
+        return parse_version_summary(response)
+
+    async def get_cell_voltages(self):
+        response = await self._query(f'#{self.address}q1', Q1_FIELDS)
+        return parse_cell_voltages(response)
+
+    async def snapshot(self):
+        """Read the battery summary and cell voltages back to back.
+        @return -- a SNAPSHOT of the summary and cell voltages.
+        """
+        timestamp = time.monotonic()
+        summary = await self.get_summary()
+        voltages = await self.get_cell_voltages()
+        return SNAPSHOT(timestamp, summary, voltages)
+
+    async def set_address(self, address: int):
+        """Sets the battery address.
+        The battery must be the only battery on the RS485 bus.
+        @param address -- a decimal value ranging between 0 and 250
+        """
+        await self._command(f'#00?8 {format_address(address)}', wait=0.2)
+
+    async def get_address(self):
+        """Get the battery address.
+        This function only works when the battery is the
+        only battery on the bus.
+        @return -- the address as a decimal value.
+        """
+        response = await self._query('#00?0', ADDRESS_FIELDS)
+        return parse_address(response)
+
+    async def get_state(self):
+        summary = await self.get_summary()
+        return summary.state, describe_state(summary.state)
+
+    async def get_error_state(self):
+        summary = await self.get_summary()
+        return summary.error_state, describe_error(summary.error_state)
+
+    async def get_voltage(self):
+        summary = await self.get_summary()
+        return summary.voltage
+
+    async def get_current(self):
+        summary = await self.get_summary()
+        return summary.current
+
+    async def get_max_temperature(self):
+        summary = await self.get_summary()
+        return summary.max_temperature
+
+    async def get_min_max_cell_voltage(self):
+        summary = await self.get_summary()
+        return summary.min_cell_voltage, summary.max_cell_voltage
+
+    async def water_detected(self):
+        summary = await self.get_summary()
+        if summary.water_leak_detect == 0:
+            return False
+        elif summary.water_leak_detect == 1:
+            return True
+
+    async def get_power(self):
+        summary = await self.get_summary()
+        return summary.power
+
+    async def get_runtime(self):
+        summary = await self.get_summary()
+        hms = summary.runtime.split(':')
+        msg = 'Battery has been enabled for {}h, {}m, and {}s.'
+        print(msg.format(hms[0], hms[1], hms[2]))
+        return hms
+
+    async def get_sleep_time(self):
+        summary = await self.get_summary()
+        timer = summary.sleep_timer
+        if timer == 0:
+            print('Sleep timer is disabled.')
+        else:
+            print('Battery will go to sleep in {} seconds.'.format(timer))
+        return timer
+
+    async def get_battery_sn(self):
+        summary = await self.get_version_summary()
+        return summary.sn
+
+    async def get_fw_version(self):
+        summary = await self.get_version_summary()
+        return summary.firmware_info
+
+    async def get_voltage_rating(self):
+        summary = await self.get_version_summary()
+        return summary.voltage_rating
+
+    async def get_current_rating(self):
+        summary = await self.get_version_summary()
+        return summary.current_rating
+
+    async def get_mode(self):
+        summary = await self.get_version_summary()
+        return summary.mode
+
+    async def sleep(self, length=0):
+        """Put the battery to sleep.
+        @param length -- the number of seconds to wait before going to sleep.
+        """
+        await self._command(f'#{self.address}bs {length}', wait=3)
+
+    async def off(self):
+        """Turn off the battery.
+        This resets any existing errors.
+        """
+        await self._command(f'#{self.address}bf', wait=1)
+
+    async def reset_battery(self, wait=1):
+        await self.off()
+        await asyncio.sleep(wait)
+        await self.get_summary()
+
+    async def balance_cell(self, cell):
+        '''Discharge a cell of the battery for balancing.
+        @param cell -- the whole number value for a cell (0-7)
+        @return -- True if the command was accepted. False if not.
+        '''
+        response = await self._query(f'#{self.address}b{cell}', BALANCE_FIELDS)
+        return parse_balance(response)
+
+    async def balance_max_cell(self):
+        response = await self._query(f'#{self.address}bb', BALANCE_FIELDS)
+        return parse_balance(response)
+
+    async def is_balanced(self, delta=0.030):
+        mincell, maxcell = await self.get_min_max_cell_voltage()
+        return abs(maxcell - mincell) <= delta
+
+
+async def poll_ports(ports, address=0):
+    """Read a snapshot from the battery on each port concurrently.
+    @return -- a dict of port -> SNAPSHOT, or the exception raised for that port.
+    """
+    async def poll(port):
+        async with AsyncSBM(port, address) as sbm:
+            return await sbm.snapshot()
+    results = await asyncio.gather(*(poll(port) for port in ports), return_exceptions=True)
+    return dict(zip(ports, results))
+
+
+if __name__ == "__main__":
+    for port, result in asyncio.run(poll_ports(sys.argv[1:])).items():
+        print(f'{port}: {result}')
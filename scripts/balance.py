@@ -1,45 +1,149 @@
+import atexit
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from datetime import datetime, timezone
 import logging
 import sys
+import threading
 import time
 import serial.tools.list_ports
+from constants import BAUDRATE, CHAR_TIME, MAX_TEMPERATURE
+from controller import BalanceController
+from interlock import Interlock, InterlockError, default_rules
+from monitor import Monitor
+from recorder import TelemetryRecorder, default_path
+from metrics import command_type
+import connections
+from logqueue import DailyFileHandler, queue_logger
+from transcript import TranscriptWriter, default_path as transcript_path
 import re
+from array import array
 from typing import NamedTuple
 
 address = 0
 delta = 0.030
+max_age = 2  # Seconds a battery summary is reused by the scalar getters.
+max_temperature = MAX_TEMPERATURE  # Degrees C above which balancing stops.
+transcript = False  # Record raw serial traffic to ~/bluefin/transcripts for offline replay.
+pipeline = False  # Write each balancing pass as one batch. Only on a full-duplex (4-wire) bus, see SBM.
 
 NUM_PAT = '([+-]?[0-9]*[.]?[0-9]+)'
 CHAR_PAT = '([^0-9])'
-BATSUM_PATTERN = '(\$\d{2}[a-z]\d{1})\s+(.)(.)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+:[+-]?[0-9]*[.]?[0-9]+:[+-]?[0-9]*[.]?[0-9]+)\s+([a-z])\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)'
-VERSUM_PATTERN = '(\$\d{2}[a-z]\d{1})\s+([+-]?[0-9]*[.]?[0-9]+)\s+(.)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+(.*)\s+\r'
-CELLSUM_PATTERN = '\s+([+-]?[0-9]*[.]?[0-9]+)'
+
+POLL_INTERVAL = 0.005  # Serial read timeout used while waiting on a reply frame.
+COMPAT_DELAY = 0.5  # Fixed pre-read sleep used in compatibility mode.
+PROBE_TIMEOUT = 0.3  # Reply deadline used while searching ports for a battery.
+PORT_CACHE = os.path.join(os.path.expanduser('~'), 'bluefin', 'ports.json')
+IDENTITY_REGISTRY = os.path.join(os.path.expanduser('~'), 'bluefin', 'identities.json')
+SCAN_TIMEOUT = 0.05  # Seconds to wait for a reply to start while scanning the bus.
+# Silence within a reply after which a scan moves on: a few character times
+# plus the latency timer of USB serial adapters (16 ms on FTDI parts).
+SCAN_GAP = 5 * CHAR_TIME + 0.016
+Z0_WIRE_TIME = 80 * CHAR_TIME  # Upper bound on the time a z0 reply spends on the wire.
+ACK_WINDOW = 0.25  # Seconds of line silence before giving up on an optional acknowledgement.
+KEEPALIVE = 20  # Seconds without a command before a bleeding battery is polled, inside its watchdog timeout.
+RETRIES = 1  # Times a query is resent after a missing or corrupt reply.
+OFF_ATTEMPTS = 3  # Times bf is sent when a battery must be confirmed off, e.g. after an interlock trip.
+
+# Minimum number of whitespace separated fields in a complete reply, header included.
+Q0_FIELDS = 14
+Q1_FIELDS = 9
+Z0_FIELDS = 8
+ADDRESS_FIELDS = 2
+BALANCE_FIELDS = 2
+ACK_FIELDS = 1
 
 def get_port():
     try:
         port = str(sys.argv[1])
-    except:
-        available_ports = [v.name for v in serial.tools.list_ports.comports()]
-        for port in available_ports:
-            with SBM(port, address = address) as sbm:
-                versum = sbm.get_version_summary()
-                if not isinstance(versum.sn, int):
-                    continue
-                else:
-                    if '/dev' not in port and os.name == 'posix':
-                        port = os.path.join('/dev',port)
-                    break
+    except IndexError:
+        port = find_port()
     return port
 
-def main():
-    port = get_port()
-    with SBM(port, address = address) as sbm:
+def probe_port(port, timeout=PROBE_TIMEOUT):
+    """Ask whatever is on a port for its battery serial number.
+    @param port -- the serial port to probe.
+    @param timeout -- the reply deadline in seconds.
+    @return -- the battery serial number, or None if no battery answered.
+    """
+    try:
+        with SBM(port, address = address, timeout = timeout) as sbm:
+            versum = sbm.get_version_summary()
+    except (ConnectionError, TimeoutError, ValueError):
+        return None
+    if not isinstance(versum.sn, int):
+        return None
+    return versum.sn
+
+def _port_key(info):
+    """Identify a port by its USB VID/PID/serial number, which survive re-enumeration."""
+    if info.vid is None:
+        return info.device
+    return f"{info.vid:04x}:{info.pid:04x}:{info.serial_number}"
+
+def _load_port_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_port_cache(cache_path, cache):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f, indent=1)
+
+def find_port(cache_path=PORT_CACHE, timeout=PROBE_TIMEOUT):
+    """Find the port a battery is attached to.
+    Ports recorded in the cache are tried first. If none of them answers with
+    the cached serial number, every port is probed concurrently.
+    @param cache_path -- the JSON file mapping port identities to battery serial numbers.
+    @param timeout -- the reply deadline in seconds for each probe.
+    @return -- the port of the first battery found.
+    """
+    ports = serial.tools.list_ports.comports()
+    cache = _load_port_cache(cache_path)
+    for info in ports:
+        sn = cache.get(_port_key(info))
+        if sn is not None and probe_port(info.device, timeout) == sn:
+            return info.device
+
+    if not ports:
+        raise ConnectionError("No serial ports found.")
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        futures = {pool.submit(probe_port, info.device, timeout): info for info in ports}
+        for future in as_completed(futures):
+            sn = future.result()
+            if sn is not None:
+                info = futures[future]
+                cache[_port_key(info)] = sn
+                _save_port_cache(cache_path, cache)
+                return info.device
+    raise ConnectionError("No Bluefin 1.5 kWh battery found on any serial port.")
+
+def main(port=None, telemetry=True, **options):
+    """Balance one battery.
+    @param port -- the serial port. Defaults to the command line argument or a port search.
+    @param telemetry -- if False, do not append to the battery's telemetry file (e.g. when replaying).
+    @param options -- further SBM arguments, e.g. transport and clock for a replay.
+    """
+    if port is None:
+        port = get_port()
+    if transcript is True:
+        options.setdefault('transcript', transcript_path())
+    options.setdefault('pipeline', pipeline)
+    options.setdefault('interlock', Interlock(default_rules(max_temperature=max_temperature)))
+    with SBM(port, address = address, max_age = max_age, **options) as sbm, ExitStack() as stack:
+        clock = sbm.clock
         sbm.reset_battery()
 
         versum = sbm.get_version_summary()
         _date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
         console = initialize_logger(2,versum.sn, _date)
+        if telemetry is True:
+            recorder = stack.enter_context(TelemetryRecorder(default_path(versum.sn)))
         console.debug(f"{'-'*35} New Run {'-'*35}")
         console.info(f'Connected to Battery {versum.sn}.')
         console.info(f'Battery FW Version: {versum.firmware_info}.')
@@ -48,6 +152,7 @@ def main():
         console.info(f"Current Battery Address: {current_address}")
 
         summary = sbm.get_summary()
+        check_interlock(sbm, console)
         console.info(f"Current Temperature: {summary.max_temperature}")
         console.info(f"Minimum Cell Voltage: {summary.min_cell_voltage}")
         console.info(f"Maximum Cell Voltage: {summary.max_cell_voltage}")
@@ -60,6 +165,8 @@ def main():
 
         voltages = sbm.get_cell_voltages()
         console.debug(f"Cell Voltages: {voltages}")
+        if telemetry is True:
+            recorder.append(summary, voltages)
 
         balanced = sbm.is_balanced(delta=delta)
         if balanced is True:
@@ -69,53 +176,72 @@ def main():
             exit()
         else:
             i = 0
+            controller = BalanceController(delta=delta, logger=console)
             console.info('Starting balancing loop...')
             while balanced is False:
                 i += 1
-                lstart = time.monotonic()
+                lstart = clock.monotonic()
                 summary = sbm.get_summary()
+                check_interlock(sbm, console)
                 console.info(f"Balance Loop: {i}")
                 console.info(f'Current Temperature: {summary.max_temperature}')
 
                 voltages = sbm.get_cell_voltages()
                 console.debug(f"Cell Voltages: {voltages}")
+                if telemetry is True:
+                    recorder.append(summary, voltages)
 
                 # Issue Catch: Exceeding maximum allowed temperature.
-                if summary.max_temperature >= 42:
-                    msg = f"Maximum cell temperature exceeds 42 degrees. Allow battery to cool down before balancing again."
+                if summary.max_temperature >= max_temperature:
+                    msg = f"Maximum cell temperature exceeds {max_temperature} degrees. Allow battery to cool down before balancing again."
                     console.critical(msg)
                     raise TimeoutError(msg)
                     exit()
 
                 console.info('Balancing cells...')
-                sbm.balance_non_min_cells(console)
+                interval = controller.step(sbm, summary, voltages, timestamp=clock.monotonic())
+                check_interlock(sbm, console)
 
                 balanced = sbm.is_balanced()
                 if balanced is True:
-                    time.sleep(0.5)
+                    if sbm.compat is True:
+                        clock.sleep(0.5)
                     console.info('Battery is balanced. Turning off battery.')
                     sbm.off()
                     console.info('Exiting application.')
                     exit()
 
                 else:
-                    lstop = time.monotonic()
-                    wait = int(60-(lstop-lstart))
+                    lstop = clock.monotonic()
+                    wait = max(0, int(interval-(lstop-lstart)))
                     console.info(f"Starting next loop in {wait} seconds.")
-                    time.sleep(wait)
+                    sbm.idle(wait)
+                    check_interlock(sbm, console)
+
 
 
+def check_interlock(sbm, console):
+    """Stop balancing if the safety interlock has turned the battery off."""
+    trip = sbm.interlocked()
+    if trip is not None:
+        msg = f"Safety interlock '{trip.rule.name}' turned the battery off. Resolve the cause before balancing again."
+        console.critical(msg)
+        raise InterlockError(msg)
+
 
 def initialize_logger(console_level,sn,str_date):
+    """Set up the 'bluefin' logger.
+    Records are written by a background thread, to the console and to a log
+    file that starts on str_date and rolls over at UTC midnight or by size.
+    """
     logger = logging.getLogger('bluefin')
     save_dir = os.path.join(os.path.expanduser('~'),'bluefin')
     save_dir = os.path.join(save_dir, 'logs')
     os.makedirs(save_dir, exist_ok=True)
-    save_filepath = os.path.join(save_dir, f'bluefin1.5kwh_{sn}_{str_date}.txt')
     logger.setLevel(logging.DEBUG)
     if not logger.handlers:
         console = logging.StreamHandler()
-        filelog = logging.FileHandler(save_filepath)
+        filelog = DailyFileHandler(save_dir, f'bluefin1.5kwh_{sn}', date=str_date)
         if console_level == 0:
             console.setLevel(logging.ERROR)
             filelog.setLevel(logging.ERROR)
@@ -134,8 +260,8 @@ def initialize_logger(console_level,sn,str_date):
         console.setFormatter(fmt)
         filelog.setFormatter(fmt)
 
-        logger.addHandler(console)
-        logger.addHandler(filelog)
+        listener = queue_logger(logger, [console, filelog])
+        atexit.register(listener.stop)
 
     if logger:
         return logger
@@ -144,178 +270,848 @@ def initialize_logger(console_level,sn,str_date):
 
 
 
-class BATTERY_SUMMARY(NamedTuple):
-    state: str
-    error_state: str
-    voltage: float
-    current: float
-    max_temperature: float
-    min_cell_voltage: float
-    max_cell_voltage: float
-    water_leak_detect: int
-    power: float
-    runtime: str
-    mode: str
-    discharge_status_1: int
-    discharge_status_2: int
-    sleep_timer: int
-
-class VERSION_SUMMARY(NamedTuple):
+class _ArrayRecord():
+    """Base for slotted records whose numeric fields live in a typed array.
+    Subclasses list their fields in order in _fields, the numeric ones in
+    _columns, and expose each column through a _column property.
+    """
+    __slots__ = ('_values',)
+    _fields = ()
+    _columns = ()
+
+    def __init__(self, *args, **kwargs):
+        kwargs.update(zip(self._fields, args))
+        self._values = array('d', [kwargs.pop(name) for name in self._columns])
+        for name in self._fields:
+            if name not in self._columns:
+                setattr(self, name, kwargs.pop(name))
+        if kwargs:
+            raise TypeError(f"Unexpected fields: {', '.join(kwargs)}")
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._asdict() == other._asdict()
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields)
+        return f'{type(self).__name__}({fields})'
+
+
+def _column(index, cast=float):
+    return property(lambda self: cast(self._values[index]))
+
+
+class BATTERY_SUMMARY(_ArrayRecord):
+    __slots__ = ('state', 'error_state', 'runtime', 'mode')
+    _fields = ('state', 'error_state', 'voltage', 'current', 'max_temperature',
+               'min_cell_voltage', 'max_cell_voltage', 'water_leak_detect', 'power',
+               'runtime', 'mode', 'discharge_status_1', 'discharge_status_2', 'sleep_timer')
+    _columns = ('voltage', 'current', 'max_temperature', 'min_cell_voltage', 'max_cell_voltage',
+                'water_leak_detect', 'power', 'discharge_status_1', 'discharge_status_2', 'sleep_timer')
+    voltage = _column(0)
+    current = _column(1)
+    max_temperature = _column(2)
+    min_cell_voltage = _column(3)
+    max_cell_voltage = _column(4)
+    water_leak_detect = _column(5, int)
+    power = _column(6)
+    discharge_status_1 = _column(7, int)
+    discharge_status_2 = _column(8, int)
+    sleep_timer = _column(9, int)
+
+class VERSION_SUMMARY(_ArrayRecord):
+    __slots__ = ('address', 'mode', 'firmware_info')
+    _fields = ('address', 'mode', 'board_sn', 'sn', 'voltage_rating', 'current_rating', 'firmware_info')
+    _columns = ('board_sn', 'sn', 'voltage_rating', 'current_rating')
+    board_sn = _column(0, int)
+    sn = _column(1, int)
+    voltage_rating = _column(2)
+    current_rating = _column(3)
+
+class CELL_SUMMARY(_ArrayRecord):
+    """Cell voltages. Also behaves as a sequence of the 8 voltages."""
+    __slots__ = ()
+    _fields = ('cell_1', 'cell_2', 'cell_3', 'cell_4', 'cell_5', 'cell_6', 'cell_7', 'cell_8')
+    _columns = _fields
+    cell_1 = _column(0)
+    cell_2 = _column(1)
+    cell_3 = _column(2)
+    cell_4 = _column(3)
+    cell_5 = _column(4)
+    cell_6 = _column(5)
+    cell_7 = _column(6)
+    cell_8 = _column(7)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        return self._values[index]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def tolist(self):
+        return self._values.tolist()
+
+
+class PARSE_ERROR(NamedTuple):
+    kind: str
+    reason: str
+    raw: bytes
+
+
+class ResponseError(ValueError):
+    """Raised when a battery reply cannot be parsed. The PARSE_ERROR is kept in .error."""
+    def __init__(self, error):
+        self.error = error
+        super().__init__(f"Unable to parse {error.kind or 'reply'}: {error.reason}. Raw reply: {error.raw!r}")
+
+
+FRAME_PATTERN = re.compile(rb'\$[0-9a-fA-F]{2}([a-z?][0-9a-z])([^\r\n]*)')
+
+def _parse_q0(fields):
+    if len(fields) < Q0_FIELDS - 1:
+        return f'expected at least {Q0_FIELDS - 1} fields'
+    flags = fields[0]
+    if len(flags) != 2:
+        return 'state and error field must be two characters'
+    record = BATTERY_SUMMARY.__new__(BATTERY_SUMMARY)
+    record._values = array('d', list(map(float, fields[1:8] + fields[10:13])))
+    record.state = chr(flags[0])
+    record.error_state = chr(flags[1])
+    record.runtime = fields[8].decode()
+    record.mode = fields[9].decode()
+    return record
+
+def _parse_z0(fields):
+    if len(fields) < Z0_FIELDS - 1:
+        return f'expected at least {Z0_FIELDS - 1} fields'
+    record = VERSION_SUMMARY.__new__(VERSION_SUMMARY)
+    record._values = array('d', (int(fields[2]), int(fields[3]), float(fields[4]), float(fields[5])))
+    record.address = fields[0].decode()
+    record.mode = fields[1].decode()
+    record.firmware_info = b' '.join(fields[6:]).decode(errors='replace')
+    return record
+
+def _parse_q1(fields):
+    if len(fields) != Q1_FIELDS - 1:
+        return 'Response did not return all cell voltages'
+    record = CELL_SUMMARY.__new__(CELL_SUMMARY)
+    record._values = array('d', list(map(float, fields)))
+    return record
+
+def _parse_address(fields):
+    if len(fields) < ADDRESS_FIELDS - 1:
+        return 'missing address'
+    return int(fields[0], 16)
+
+def _parse_bleed(fields):
+    if len(fields) < BALANCE_FIELDS - 1:
+        return 'missing bleed status'
+    return int(fields[0]) == 1
+
+_PARSERS = {b'q0': _parse_q0, b'z0': _parse_z0, b'q1': _parse_q1, b'?0': _parse_address, b'bb': _parse_bleed}
+_PARSERS.update({b'b%d' % cell: _parse_bleed for cell in range(10)})
+
+def parse_frame(data, kind=None):
+    """Parse a reply frame straight from the received bytes.
+    @param data -- bytes, bytearray or memoryview holding the frame.
+    @param kind -- the expected reply type as bytes (e.g. b'q0', or b'b' for any bleed reply),
+        or None to accept any.
+    @return -- a BATTERY_SUMMARY (q0), VERSION_SUMMARY (z0), CELL_SUMMARY (q1),
+        the address as an int (?0) or the bleed status as a bool (bN, bb).
+        A PARSE_ERROR is returned instead of raising if the frame is malformed.
+    """
+    if data[:1] == b'$' and data[-1:] in (b'\n', b'\r'):
+        frame_kind, body = bytes(data[3:5]), bytes(data[5:])  # An isolated frame, as returned by FrameReassembler.take().
+    else:
+        match = FRAME_PATTERN.search(data)
+        if match is None:
+            return PARSE_ERROR(kind and kind.decode(), 'no reply header', bytes(data))
+        frame_kind, body = match.groups()
+    if kind is not None and not frame_kind.startswith(kind):
+        return PARSE_ERROR(kind.decode(), f'unexpected reply type {frame_kind.decode()}', bytes(data))
+    parser = _PARSERS.get(frame_kind)
+    if parser is None:
+        return PARSE_ERROR(frame_kind.decode(), 'unknown reply type', bytes(data))
+    try:
+        result = parser(body.split())
+    except (ValueError, IndexError) as e:
+        result = str(e)
+    if result.__class__ is str:
+        return PARSE_ERROR(frame_kind.decode(), result, bytes(data))
+    return result
+
+def _parse(data, kind):
+    if isinstance(data, str):
+        data = data.encode()
+    result = parse_frame(data, kind)
+    if isinstance(result, PARSE_ERROR):
+        raise ResponseError(result)
+    return result
+
+def parse_summary(response):
+    """Parse a q0 reply into a BATTERY_SUMMARY."""
+    return _parse(response, b'q0')
+
+def parse_version_summary(response):
+    """Parse a z0 reply into a VERSION_SUMMARY."""
+    return _parse(response, b'z0')
+
+def parse_cell_summary(response):
+    """Parse a q1 reply into a CELL_SUMMARY."""
+    return _parse(response, b'q1')
+
+def parse_cell_voltages(response):
+    """Parse a q1 reply into a list of the 8 cell voltages."""
+    return _parse(response, b'q1').tolist()
+
+def parse_address(response):
+    """Parse a ?0 reply into the battery address as a decimal value."""
+    return _parse(response, b'?0')
+
+def parse_balance(response):
+    """Parse a bN or bb reply. True if the battery accepted the bleed command."""
+    return _parse(response, b'b')
+
+
+def format_address(address):
+    """Formats a decimal value into a hexadecimal value that works
+        with the Bluefin 1.5 kWh (SmallBattMod).
+    @param address -- a decimal value ranging between 0 and 250.
+    @return -- the address as a hexadecimal value if the input address
+        was between 0 and 250. False if the address is outside of that
+        range.
+    """
+    address = int(address)
+    if address >= 1 and address <= 250:
+        address = hex(int(address))  # Convert address if between 0-250.
+        if len(address) == 3:  # Take the last char and append a zero.
+            address = str(address[-1]).rjust(2, '0')
+        elif len(address) == 4:
+            address = address[-2:]  # Take the last two char.
+        return address
+    elif address == 0:
+        address = '00'
+        return address
+    else:
+        return False
+
+
+def describe_state(state):
+    if state == 'f':
+        msg = 'OFF'
+    elif state == 'd':
+        msg = 'DISCHARGING'
+    elif state == 'c':
+        msg = 'CHARGING'
+    elif state == 'b':
+        msg = 'BALANCING'
+    return msg
+
+
+def describe_error(error_state):
+    if error_state == '-':
+        msg = 'No Error'
+    elif error_state == 'V':
+        msg = 'Battery over voltage'
+    elif error_state == 'v':
+        msg = 'Battery under voltage'
+    elif error_state == 'I':
+        msg = 'Battery over current'
+    elif error_state == 'C':
+        msg = 'Battery max cell over voltage'
+    elif error_state == 'c':
+        msg = 'Battery min cell under voltage'
+    elif error_state == 'x':
+        msg = 'Battery min cell under fault voltage (2.0V)'
+    elif error_state == 'T':
+        msg = 'Battery over temperature'
+    elif error_state == 'W':
+        msg = 'Battery moisture intrusion detected by H2O sensors'
+    elif error_state == 'H' or error_state == 'h':
+        msg = 'Battery internal hardware fault'
+    elif error_state == 'm':
+        msg = 'Battery watchdog timeout'
+    return msg
+
+
+class SNAPSHOT(NamedTuple):
+    timestamp: float
+    summary: BATTERY_SUMMARY
+    voltages: list
+
+
+class _CACHED(NamedTuple):
     address: str
-    mode: str
-    board_sn: int
-    sn: int
-    voltage_rating: float
-    current_rating: float
-    firmware_info: str
-
-class CELL_SUMMARY(NamedTuple):
-    cell_1: float
-    cell_2: float
-    cell_3: float
-    cell_4: float
-    cell_5: float
-    cell_6: float
-    cell_7: float
-    cell_8: float
+    summary: BATTERY_SUMMARY or None
+    summary_time: float
+    voltages: list or None
+    voltages_time: float
+
+
+class IdentityRegistry():
+    def __init__(self, path=IDENTITY_REGISTRY):
+        """An on-disk record of each battery's version summary by port and address.
+        Lookups cost no bus traffic. SBM keeps the registry current whenever it
+        reads a version summary.
+        @param path -- the JSON file the registry is kept in.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = _load_port_cache(path)
+
+    @staticmethod
+    def _key(port, address):
+        return f'{port}#{int(address):02x}'
+
+    def lookup(self, port, address):
+        """Return the VERSION_SUMMARY recorded for a port and address.
+        @param port -- the serial port.
+        @param address -- the battery address as a decimal value.
+        @return -- the VERSION_SUMMARY, or None if the battery is not registered.
+        """
+        entry = self._entries.get(self._key(port, address))
+        if entry is None:
+            return None
+        return VERSION_SUMMARY(**entry['identity'])
+
+    def find(self, sn):
+        """Return the (port, address) pairs a battery serial number is registered at."""
+        found = []
+        for key, entry in self._entries.items():
+            if entry['identity']['sn'] == sn:
+                port, address = key.rsplit('#', 1)
+                found.append((port, int(address, 16)))
+        return found
+
+    def entries(self):
+        """Return a dict of (port, address) -> VERSION_SUMMARY for every registered battery."""
+        return {(key.rsplit('#', 1)[0], int(key.rsplit('#', 1)[1], 16)): VERSION_SUMMARY(**entry['identity'])
+                for key, entry in self._entries.items()}
+
+    def update(self, port, address, versum):
+        """Record a version summary, writing the file only if the identity changed."""
+        key = self._key(port, address)
+        identity = versum._asdict()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['identity'] == identity:
+                return
+            self._entries[key] = {'identity': identity,
+                                  'seen': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            _save_port_cache(tmp, self._entries)
+            os.replace(tmp, self.path)
+
+
+class Transaction():
+    def __init__(self, sbm):
+        """A batch of commands written back to back, with replies matched by header.
+        Use SBM.transaction() to create one, add() each command and then send().
+        @param sbm -- the SBM connection to send on.
+        """
+        self.sbm = sbm
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def add(self, command, fields=ACK_FIELDS):
+        """Queue a command.
+        @param command -- the command without line ending (e.g. '#01b3').
+        @param fields -- the minimum number of fields in a complete reply.
+        @return -- the index of the command's reply in the list returned by send().
+        """
+        self._commands.append((command, fields))
+        return len(self._commands) - 1
+
+    def send(self, timeout=None):
+        """Write every queued command and collect the replies.
+        The commands are written back to back only if the SBM was created with
+        pipeline=True. Otherwise, and in compatibility mode, they are sent one
+        at a time, each after the previous reply.
+        @param timeout -- the reply deadline in seconds per command. A pipelined batch
+            gives up on missing replies once the line has been silent this long, and
+            in any case after this long per command. Defaults to the instance timeout.
+        @return -- a list with each command's reply as bytes, or None where no reply arrived.
+        """
+        sbm = self.sbm
+        commands, self._commands = self._commands, []
+        if timeout is None:
+            timeout = sbm.timeout
+        with sbm.lock:
+            if sbm.compat is True or sbm.pipeline is not True:
+                return [self._one(command, fields, timeout) for command, fields in commands]
+            return self._exchange(commands, timeout)
+
+    def _one(self, command, fields, timeout):
+        try:
+            return self.sbm._query(command, fields, timeout)
+        except TimeoutError:
+            return None
+
+    def _exchange(self, commands, timeout):
+        sbm = self.sbm
+        replies = [None] * len(commands)
+        waiting = list(range(len(commands)))
+        headers = [('$' + command[1:5]).encode() for command, _ in commands]
+        frames = sbm._frames
+        sbm._write_command(''.join(command + '\r\n' for command, _ in commands), EOL='')
+        start_time = last_rx = sbm.clock.monotonic()
+        deadline = timeout * len(commands)  # Bounds the batch even if noise keeps the line busy.
+        dropped = frames.dropped
+        while waiting:
+            data = sbm.rs485.read(max(1, sbm.rs485.in_waiting))
+            now = sbm.clock.monotonic()
+            if data:
+                frames.feed(data)
+                last_rx = now
+                if sbm.metrics is not None:
+                    sbm.metrics.received(sbm.rs485.port, len(data))
+                for frame in frames.frames():
+                    for i in waiting:  # The first outstanding command with this header, so repeats pair in order.
+                        if frame.startswith(headers[i]) and len(frame.split()) >= commands[i][1]:
+                            break
+                    else:
+                        frames.dropped += len(frame)
+                        continue
+                    replies[i] = frame
+                    waiting.remove(i)
+                    if sbm.metrics is not None:
+                        sbm._observe(commands[i][0], start_time, frame)
+            elif now - last_rx >= timeout:
+                break
+            if now - start_time >= deadline:
+                break
+        sbm._count_dropped(dropped)
+        if sbm.metrics is not None:
+            for i in waiting:
+                sbm._observe(commands[i][0], start_time, None)
+        return replies
 
 
 class SBM():
-    def __init__(self, port, address=0):
-        self.rs485 = serial.Serial()
-        self.rs485.port = port
-        self.rs485.baudrate = 9600
-        self.rs485.timeout = 1
+    def __init__(self, port, address=0, timeout=1, compat=False, max_age=None, metrics=None,
+                 transport=None, transcript=None, clock=time, keepalive=KEEPALIVE, registry=None,
+                 pool=None, retries=RETRIES, interlock=None, pipeline=False):
+        """Connect to a Bluefin 1.5 kWh battery.
+        @param port -- the serial port the battery is attached to, or a pyserial URL
+            such as socket://host:4001 for a ser2net bridge.
+        @param address -- the battery address as a decimal value (0-250).
+        @param timeout -- the deadline in seconds for each command's reply frame.
+        @param compat -- if True, sleep a fixed interval before every read
+            instead of reading until the reply frame is complete.
+        @param max_age -- if set, the scalar getters reuse a battery summary
+            that is at most this many seconds old instead of polling again.
+        @param metrics -- if set, a metrics.Metrics that records command latency,
+            traffic and errors for this connection.
+        @param transport -- an open serial.Serial compatible object to use instead
+            of opening the port, e.g. a transcript.ReplaySerial.
+        @param transcript -- if set, record every byte written and read to this
+            transcript file.
+        @param clock -- the source of monotonic() and sleep() used for every
+            deadline and wait. Defaults to the time module.
+        @param keepalive -- seconds without a command after which keepalive() and
+            idle() poll a bleeding battery so its watchdog does not expire. None to disable.
+        @param registry -- if set, an IdentityRegistry kept current with every version
+            summary read. A registered battery at the initial address is re-read on connect.
+        @param pool -- the connections.ConnectionPool the port is shared through.
+            Defaults to connections.pool. Ignored if transport is given.
+        @param retries -- times a query is resent after a missing or corrupt reply.
+        @param interlock -- if set, an interlock.Interlock that checks every battery
+            summary read and turns off a battery that breaks one of its rules.
+        @param pipeline -- if True, a Transaction writes all of its commands before
+            reading any reply. This needs a full-duplex (4-wire RS-485 or RS-422) link,
+            where replies cannot collide with commands still being sent. On a 2-wire
+            half-duplex bus leave it False so only one command is in flight at a time.
+        """
+        self.metrics = metrics
+        self.clock = clock
+        self.keepalive_interval = keepalive
+        self._last_command = {}  # Address -> clock time of the last command sent to it.
+        self._bleeding = set()  # Addresses with cells bleeding.
+        self.registry = registry
+        self._versions = {}  # Address -> VERSION_SUMMARY, which does not change during a session.
+        self.timeout = timeout
+        self.compat = compat
+        self.max_age = max_age
+        self.retries = retries
+        self.interlock = interlock
+        self.pipeline = pipeline
+        self._snapshot = None
+        self._pool = pool if pool is not None else connections.pool
+        self._shared = None
 
         try:
-            self.rs485.open()
+            if transport is not None:
+                self.rs485 = transport
+                self.lock = threading.RLock()
+                self._frames = connections.FrameReassembler()
+                if not self.rs485.is_open:
+                    self.rs485.open()
+            else:
+                self._shared = self._pool.acquire(port, baudrate=BAUDRATE, timeout=POLL_INTERVAL)
+                self.rs485 = self._shared.serial
+                self.lock = self._shared.lock  # Held for each exchange, as other SBMs may share the port.
+                self._frames = self._shared.frames
+            if transcript is not None:
+                self.rs485 = TranscriptWriter(self.rs485, transcript)
             self._clear_buffers()
             self.address = self._format_address(address)
         except:
-            msg = f"Unable to connect to Bluefin 1.5 kWh battery on port {self.rs485.port}."
+            if self._shared is not None:
+                self._pool.release(self._shared)
+                self._shared = None
+            msg = f"Unable to connect to Bluefin 1.5 kWh battery on port {port}."
             raise ConnectionError(msg)
+        if registry is not None:
+            self.revalidate()
 
     def __enter__(self):
-        self._clear_buffers()
         return self
 
     def __exit__(self, et, ev, etb):
-        self._clear_buffers()
-        self.rs485.close()
+        if self._shared is not None:
+            if isinstance(self.rs485, TranscriptWriter):
+                self.rs485.finish()  # The port itself stays open for the other users of the pool.
+            self._pool.release(self._shared)
+            self._shared = None
+        else:
+            self.rs485.close()
 
     def reset_battery(self, wait = 1):
         self.off()
-        time.sleep(wait)
+        self.clock.sleep(wait)
         summary = self.get_summary()
-        self._clear_buffers()
 
     def _clear_buffers(self):
-        self.rs485.reset_input_buffer()
-        self.rs485.reset_output_buffer()
+        """Discard unread input. Only compatibility mode, which reads whatever
+        has arrived, needs this. Otherwise stale and stray bytes are dropped
+        by the frame reassembler as replies are read.
+        """
+        if self.compat is not True:
+            return
+        with self.lock:
+            self.rs485.reset_input_buffer()
+            self.rs485.reset_output_buffer()
+
+    def _discard_stale(self):
+        """Drop replies to earlier commands that arrived after they were given up."""
+        dropped = self._frames.dropped
+        waiting = self.rs485.in_waiting
+        if waiting:
+            data = self.rs485.read(waiting)
+            self._frames.feed(data)
+            if self.metrics is not None:
+                self.metrics.received(self.rs485.port, len(data))
+        for frame in self._frames.frames():
+            self._frames.dropped += len(frame)
+        self._count_dropped(dropped)
+
+    def _count_dropped(self, before):
+        """Record the bytes the reassembler dropped since its count was before."""
+        if self.metrics is not None and self._frames.dropped > before:
+            self.metrics.dropped(self.rs485.port, self._frames.dropped - before)
 
     def _write_command(self, command, EOL='\r\n'):
+        self._discard_stale()
         cmd = str.encode(command + EOL)
         self.rs485.write(cmd)
-
-    def _read_response(self, buffer_check: None or float = None):
-        if buffer_check is None:
-            response = self.rs485.read(self.rs485.in_waiting)
-        elif isinstance(buffer_check, (float, int)):
-            if self._buffer_check(check_pause=buffer_check) is True:
+        self._last_command[command[1:3]] = self.clock.monotonic()
+        if self.metrics is not None:
+            self.metrics.sent(self.rs485.port, len(cmd))
+
+    def _read_frame(self, header, fields, timeout=None, quiet=None, gap=None):
+        """Read from the bus until a complete reply frame arrives.
+        @param header -- the expected frame header (e.g. '$01q0').
+        @param fields -- the minimum number of fields in the frame, header included.
+        @param timeout -- the deadline in seconds. Defaults to the instance timeout.
+        @param quiet -- if set, give up once the line has been silent this many seconds.
+        @param gap -- if set, give up once a reply has started and the line has then
+            been silent this many seconds.
+        @return -- the frame as bytes, or None if the deadline or a silence limit expired.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        target = header.encode()
+        frames = self._frames
+        dropped = frames.dropped
+        start_time = last_rx = self.clock.monotonic()
+        try:
+            while True:
+                data = self.rs485.read(max(1, self.rs485.in_waiting))
+                now = self.clock.monotonic()
+                if data:
+                    frames.feed(data)
+                    last_rx = now
+                    if self.metrics is not None:
+                        self.metrics.received(self.rs485.port, len(data))
+                    frame = frames.take(target, fields)
+                    if frame is not None:
+                        return frame
+                if now - start_time >= timeout:
+                    return None
+                if quiet is not None and now - last_rx >= quiet:
+                    return None
+                if gap is not None and len(frames) and now - last_rx >= gap:
+                    return None
+        finally:
+            self._count_dropped(dropped)
+
+    def _settle(self, quiet, limit=None):
+        """Read until the line has been silent for quiet seconds, or for at most limit seconds.
+        The bytes read are left to the reassembler, which drops them before the next command.
+        """
+        if limit is None:
+            limit = self.timeout
+        start_time = last_rx = self.clock.monotonic()
+        while True:
+            data = self.rs485.read(max(1, self.rs485.in_waiting))
+            now = self.clock.monotonic()
+            if data:
+                self._frames.feed(data)
+                last_rx = now
+                if self.metrics is not None:
+                    self.metrics.received(self.rs485.port, len(data))
+            if now - last_rx >= quiet or now - start_time >= limit:
+                return
+
+    def _query(self, command, fields, timeout=None):
+        """Send a command and return its reply.
+        @param command -- the command without line ending (e.g. '#01q0').
+        @param fields -- the minimum number of fields in a complete reply.
+        @param timeout -- the reply deadline in seconds. Defaults to the instance timeout.
+        @return -- the reply as bytes.
+        """
+        with self.lock:
+            start_time = self.clock.monotonic()
+            self._write_command(command)
+            if self.compat is True:
+                self.clock.sleep(COMPAT_DELAY)
                 response = self.rs485.read(self.rs485.in_waiting)
-        data = response.decode()
-        return data
-
-    def _buffer_check(self, check_pause=0.05):
-        _buffer = self.rs485.in_waiting
-        start_time = time.monotonic()
-        while time.monotonic() - start_time < 30:
-            incoming = self.rs485.in_waiting
-            if _buffer == incoming:
-                return True
+                if self.metrics is not None:
+                    self.metrics.received(self.rs485.port, len(response))
             else:
-                _buffer = incoming
-                time.sleep(check_pause)
-        msg = 'Buffer check is reading continuous data.'
-        raise ConnectionError
-
-    def _format_address(self, address):
-        """Formats a decimal value into a hexadecimal value that works
-            with the Bluefin 1.5 kWh (SmallBattMod).
-        @param address -- a decimal value ranging between 0 and 250.
-        @return -- the address as a hexadecimal value if the input address
-            was between 0 and 250. False if the address is outside of that
-            range.
+                response = self._read_frame('$' + command[1:5], fields, timeout)
+        if self.metrics is not None:
+            self._observe(command, start_time, response)
+        if response is None:
+            msg = f"No complete reply to {command} from port {self.rs485.port}."
+            raise TimeoutError(msg)
+        return response
+
+    def _request(self, command, fields, parser):
+        """Send a query and parse its reply, resending it up to self.retries
+        times if the reply is missing or corrupt, e.g. after line noise.
+        @param command -- the command without line ending (e.g. '#01q0').
+        @param fields -- the minimum number of fields in a complete reply.
+        @param parser -- the function that parses the reply.
+        @return -- the parsed reply.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self._decode(parser, self._query(command, fields))
+            except (TimeoutError, ResponseError):
+                if attempt == self.retries:
+                    raise
+                if self.metrics is not None:
+                    self.metrics.retry(self.rs485.port, command_type(command))
+
+    def _command(self, command, wait):
+        """Send a command whose reply is not used.
+        @param command -- the command without line ending.
+        @param wait -- the fixed sleep in seconds used in compatibility mode.
+        @return -- the acknowledgement frame, or None if the battery did not acknowledge.
         """
-        address = int(address)
-        if address >= 1 and address <= 250:
-            address = hex(int(address))  # Convert address if between 0-250.
-            if len(address) == 3:  # Take the last char and append a zero.
-                address = str(address[-1]).rjust(2, '0')
-            elif len(address) == 4:
-                address = address[-2:]  # Take the last two char.
-            return address
-        elif address == 0:
-            address = '00'
-            return address
+        with self.lock:
+            start_time = self.clock.monotonic()
+            self._write_command(command)
+            if self.compat is True:
+                self.clock.sleep(wait)
+                return None
+            response = self._read_frame('$' + command[1:5], ACK_FIELDS,
+                                        timeout=max(wait, self.timeout), quiet=ACK_WINDOW)
+        if self.metrics is not None and response is not None:
+            self._observe(command, start_time, response)
+        return response
+
+    def _observe(self, command, start_time, response):
+        """Record the round trip of a command, or a timeout if there was no reply."""
+        if response is None:
+            self.metrics.timeout(self.rs485.port, command_type(command))
         else:
-            return False
+            self.metrics.observe(self.rs485.port, command_type(command), self.clock.monotonic() - start_time)
+
+    def _decode(self, parser, response):
+        """Parse a reply, counting parse errors when metrics are enabled."""
+        try:
+            return parser(response)
+        except ResponseError as e:
+            if self.metrics is not None:
+                self.metrics.parse_error(self.rs485.port, e.error.kind or 'unknown')
+            raise
+
+    def transaction(self):
+        """Return a Transaction for sending several commands as one batch."""
+        return Transaction(self)
+
+    def keepalive(self):
+        """Poll every bleeding battery that has not been sent a command for
+        the keepalive interval, so its watchdog does not stop the bleed.
+        The poll is a q1 read, the shortest reply that any battery accepts,
+        or a q0 read when an interlock is set so that it sees the battery.
+        """
+        if self.keepalive_interval is None or not self._bleeding:
+            return
+        original = self.address
+        try:
+            for address in list(self._bleeding):
+                if self.clock.monotonic() - self._last_command.get(address, 0.0) >= self.keepalive_interval:
+                    self.address = address
+                    if self.interlock is not None:
+                        self.get_summary()
+                    else:
+                        self.get_cell_voltages()
+        finally:
+            self.address = original
+
+    def idle(self, seconds):
+        """Wait, sending keepalives to bleeding batteries as they fall due.
+        A keepalive that gets no valid reply is retried after another interval.
+        @param seconds -- the time to wait.
+        """
+        end = self.clock.monotonic() + seconds
+        while True:
+            try:
+                self.keepalive()
+            except (TimeoutError, ResponseError):
+                pass
+            now = self.clock.monotonic()
+            if now >= end:
+                return
+            wait = end - now
+            if self.keepalive_interval is not None and self._bleeding:
+                due = min(self._last_command.get(a, 0.0) for a in self._bleeding) + self.keepalive_interval
+                wait = min(wait, max(POLL_INTERVAL, due - now))  # Never a rounding-sized sleep short of due.
+            self.clock.sleep(wait)
+
+    def monitor(self, addresses=None, **options):
+        """Return a monitor.Monitor that polls batteries on this bus at a state dependent rate.
+        @param addresses -- the battery addresses as decimal values. Defaults to this address.
+        @param options -- further Monitor arguments, e.g. on_event.
+        """
+        options.setdefault('max_temperature', max_temperature)
+        return Monitor(self, addresses, **options)
+
+    def invalidate(self):
+        """Discard the cached battery summary and cell voltages."""
+        self._snapshot = None
+
+    def _cache(self, summary=None, voltages=None):
+        cached = self._snapshot
+        if cached is None or cached.address != self.address:
+            cached = _CACHED(self.address, None, 0.0, None, 0.0)
+        now = self.clock.monotonic()
+        if summary is not None:
+            cached = cached._replace(summary=summary, summary_time=now)
+        if voltages is not None:
+            cached = cached._replace(voltages=voltages, voltages_time=now)
+        self._snapshot = cached
+
+    def _cached(self, max_age):
+        """Return the cache entry for the current address if max_age is set."""
+        cached = self._snapshot
+        if max_age is None or cached is None or cached.address != self.address:
+            return None
+        return cached
+
+    def _cached_summary(self):
+        cached = self._cached(self.max_age)
+        if cached is not None and cached.summary is not None:
+            if self.clock.monotonic() - cached.summary_time <= self.max_age:
+                return cached.summary
+        return self.get_summary()
+
+    def _format_address(self, address):
+        return format_address(address)
 
     def get_summary(self):
-        cmd = f'#{self.address}q0'
-        self._write_command(cmd, EOL='\r\n')
-        time.sleep(0.5)
-        response = self.rs485.read_until('\r\n').decode()
-        [response] = re.findall(BATSUM_PATTERN, response)
-        batsum = BATTERY_SUMMARY(state=str(response[1]),
-                                 error_state=str(response[2]),
-                                 voltage=float(response[3]),
-                                 current=float(response[4]),
-                                 max_temperature=float(response[5]),
-                                 min_cell_voltage=float(response[6]),
-                                 max_cell_voltage=float(response[7]),
-                                 water_leak_detect=int(response[8]),
-                                 power=float(response[9]),
-                                 runtime=str(response[10]),
-                                 mode=str(response[11]),
-                                 discharge_status_1=int(response[12]),
-                                 discharge_status_2=int(response[13]),
-                                 sleep_timer=int(response[14]))
+        batsum = self._request(f'#{self.address}q0', Q0_FIELDS, parse_summary)
+        self._cache(summary=batsum)
+        self._inspect(batsum)
         return batsum
 
-    def get_version_summary(self):
-        cmd = f'#{self.address}z0'
-        self._write_command(cmd, EOL='\r\n')
-        time.sleep(0.5)
-        response = self._read_response()
-        [response] = re.findall(VERSUM_PATTERN, response)
-        versum = VERSION_SUMMARY(address=str(response[1]),
-                                 mode=str(response[2]),
-                                 board_sn=int(response[3]),
-                                 sn=int(response[4]),
-                                 voltage_rating=float(response[5]),
-                                 current_rating=float(response[6]),
-                                 firmware_info=str(response[7]))
+    def _inspect(self, summary):
+        """Pass a summary just read to the interlock, if there is one."""
+        if self.interlock is not None:
+            self.interlock.observe(self, summary)
+
+    def interlocked(self):
+        """Return the interlock TRIP latched for the current address, or None."""
+        if self.interlock is None:
+            return None
+        return self.interlock.tripped(self.rs485.port, int(self.address, 16))
+
+    def get_version_summary(self, refresh=False):
+        """Get the battery's version summary.
+        It is read once per address and then served from memory.
+        @param refresh -- if True, read it from the battery again.
+        @return -- the VERSION_SUMMARY.
+        """
+        versum = self._versions.get(self.address)
+        if versum is None or refresh is True:
+            versum = self._request(f'#{self.address}z0', Z0_FIELDS, parse_version_summary)
+            self._remember(versum)
         return versum
 
+    def _remember(self, versum):
+        self._versions[self.address] = versum
+        if self.registry is not None:
+            self.registry.update(self.rs485.port, int(self.address, 16), versum)
+
+    def revalidate(self):
+        """Check the registered identity of the battery at the current address.
+        Nothing is sent if the battery is not in the registry.
+        @return -- True if the battery still matches its registry entry, False if it
+            changed (the entry is updated) or did not answer, None if not registered.
+        """
+        known = self.registry.lookup(self.rs485.port, int(self.address, 16))
+        if known is None:
+            return None
+        try:
+            versum = self.get_version_summary(refresh=True)
+        except (TimeoutError, ResponseError):
+            return False
+        return versum == known
+
     def get_cell_voltages(self):
-        self._write_command(f'#{self.address}q1')
-        time.sleep(0.5)
-        response = self._read_response()
-        # return response
-        voltages = list(map(float, re.findall(CELLSUM_PATTERN, response)))
-        if len(voltages) != 8:
-            raise ValueError('Response did not return all cell voltages.')
-        # cellsum = CELL_SUMMARY(cell_1 = voltages[0],
-        #                        cell_2 = voltages[1],
-        #                        cell_3 = voltages[2],
-        #                        cell_4 = voltages[3],
-        #                        cell_5 = voltages[4],
-        #                        cell_6 = voltages[5],
-        #                        cell_7 = voltages[6],
-        #                        cell_8 = voltages[7])
+        voltages = self.get_cell_summary().tolist()
+        self._cache(voltages=voltages)
         return voltages
 
+    def get_cell_summary(self):
+        return self._request(f'#{self.address}q1', Q1_FIELDS, parse_cell_summary)
+
+    def snapshot(self, max_age=None):
+        """Read the battery summary and cell voltages back to back.
+        @param max_age -- if set, return the cached readings when both are at
+            most this many seconds old.
+        @return -- a SNAPSHOT of the summary and cell voltages.
+        """
+        cached = self._cached(max_age)
+        if cached is not None and cached.summary is not None and cached.voltages is not None:
+            timestamp = min(cached.summary_time, cached.voltages_time)
+            if self.clock.monotonic() - timestamp <= max_age:
+                return SNAPSHOT(timestamp, cached.summary, cached.voltages)
+        timestamp = self.clock.monotonic()  # Not from the cache, which an interlock trip clears.
+        summary = self.get_summary()
+        voltages = self.get_cell_voltages()
+        return SNAPSHOT(timestamp, summary, voltages)
+
     # ---------------------------Battery Commands---------------------------------#
     def set_address(self, address: int):
         """Sets the battery address.
@@ -323,9 +1119,10 @@ class SBM():
         @param address -- a decimal value ranging between 0 and 250
         """
         new_address = self._format_address(address)
-        self._write_command(f'#00?8 {new_address}')
-        self._clear_buffers()
-        time.sleep(0.2)
+        self.invalidate()
+        self._versions.clear()
+        with self.lock:
+            self._command(f'#00?8 {new_address}', wait=0.2)
 
     def get_address(self):
         """Get the battery address.
@@ -333,89 +1130,90 @@ class SBM():
         only battery on the bus.
         @return -- the address as a decimal value.
         """
-        self._clear_buffers()
-        self._write_command('#00?0')
-        time.sleep(0.5)
-        response = self._read_response()
-        pattern = '\s+(.*?)\s+'
-        [hexval] = re.findall(pattern, response)
-        address = int(hexval, 16)
+        address = self._request('#00?0', ADDRESS_FIELDS, parse_address)
         return address
 
+    def scan(self, start=0, stop=250, timeout=SCAN_TIMEOUT, gap=SCAN_GAP):
+        """Find every battery on the bus.
+        Address 0 is answered by any battery, so start at 1 when several
+        batteries share the bus.
+        @param start -- the first address to probe as a decimal value.
+        @param stop -- the last address to probe as a decimal value (inclusive).
+        @param timeout -- seconds to wait for a reply to start before moving on.
+        @param gap -- seconds of silence within a reply after which it is abandoned.
+        @return -- a dict of address (decimal) -> VERSION_SUMMARY.
+        """
+        found = {}
+        original = self.address
+        frames = self._frames
+        try:
+            for address in range(start, stop + 1):
+                self.address = self._format_address(address)
+                with self.lock:
+                    self._write_command(f'#{self.address}z0')
+                    dropped = frames.dropped
+                    response = self._read_frame(f'${self.address}z0', Z0_FIELDS,
+                                                timeout=timeout + Z0_WIRE_TIME, quiet=timeout, gap=gap)
+                    if response is not None or len(frames) or frames.dropped != dropped:
+                        # Other batteries may still be answering (every battery answers
+                        # address 0), so let the line fall silent before the next probe.
+                        self._settle(timeout)
+                if response is None:
+                    continue
+                versum = parse_frame(response, b'z0')
+                if not isinstance(versum, PARSE_ERROR):
+                    found[address] = versum
+                    self._remember(versum)
+                elif self.metrics is not None:
+                    self.metrics.parse_error(self.rs485.port, versum.kind or 'unknown')
+        finally:
+            self.address = original
+        return found
+
     def get_state(self):
-        summary = self.get_summary()
-        if summary.state == 'f':
-            msg = 'OFF'
-        elif summary.state == 'd':
-            msg = 'DISCHARGING'
-        elif summary.state == 'c':
-            msg = 'CHARGING'
-        elif summary.state == 'b':
-            msg = 'BALANCING'
-        return summary.state, msg
+        summary = self._cached_summary()
+        return summary.state, describe_state(summary.state)
 
     def get_error_state(self):
-        summary = self.get_summary()
-        if summary.error_state == '-':
-            msg = 'No Error'
-        elif summary.error_state == 'V':
-            msg = 'Battery over voltage'
-        elif summary.error_state == 'v':
-            msg = 'Battery under voltage'
-        elif summary.error_state == 'I':
-            msg = 'Battery over current'
-        elif summary.error_state == 'C':
-            msg = 'Battery max cell over voltage'
-        elif summary.error_state == 'c':
-            msg = 'Battery min cell under voltage'
-        elif summary.error_state == 'x':
-            msg = 'Battery min cell under fault voltage (2.0V)'
-        elif summary.error_state == 'T':
-            msg = 'Battery over temperature'
-        elif summary.error_state == 'W':
-            msg = 'Battery moisture intrusion detected by H2O sensors'
-        elif summary.error_state == 'H' or summary.error_state == 'h':
-            msg = 'Battery internal hardware fault'
-        elif summary.error_state == 'm':
-            msg = 'Battery watchdog timeout'
-        return summary.error_state, msg
+        summary = self._cached_summary()
+        return summary.error_state, describe_error(summary.error_state)
 
     def get_voltage(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         return summary.voltage
 
     def get_current(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         return summary.current
 
     def get_max_temperature(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         return summary.max_temperature
 
     def get_min_max_cell_voltage(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         return summary.min_cell_voltage, summary.max_cell_voltage
 
     def water_detected(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         if summary.water_leak_detect == 0:
             return False
         elif summary.water_leak_detect == 1:
             return True
 
     def get_power(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         return summary.power
 
     def get_runtime(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         hms = summary.runtime.split(':')
         msg = 'Battery has been enabled for {}h, {}m, and {}s.'
         print(msg.format(hms[0], hms[1], hms[2]))
         return hms
 
     def get_sleep_time(self):
-        summary = self.get_summary()
+        summary = self._cached_summary()
         timer = summary.sleep_timer
         if timer == 0:
             print('Sleep timer is disabled.')
@@ -462,42 +1260,56 @@ class SBM():
         """Put the battery to sleep.
         @param length -- the number of seconds to wait before going to sleep.
         """
-        self._write_command(f'#{self.address}bs {length}')
-        time.sleep(3)
+        self.invalidate()
+        self._bleeding.discard(self.address)
+        self._command(f'#{self.address}bs {length}', wait=3)
 
     def off(self):
         """Turn off the battery.
         This resets any existing errors.
         """
-        self._write_command(f'#{self.address}bf')
-        time.sleep(1)
+        self.invalidate()
+        self._bleeding.discard(self.address)
+        self._command(f'#{self.address}bf', wait=1)
+
+    def confirm_off(self, attempts=OFF_ATTEMPTS):
+        """Turn off the battery and read its state back, resending bf until it reports off.
+        The summaries read are not passed to the interlock, so the interlock can call this.
+        @param attempts -- the most times bf is sent.
+        @return -- True once the battery reports state f. False if that was never confirmed.
+        """
+        for attempt in range(attempts):
+            self.off()
+            try:
+                summary = self._request(f'#{self.address}q0', Q0_FIELDS, parse_summary)
+            except (TimeoutError, ResponseError):
+                continue
+            self._cache(summary=summary)
+            if summary.state == 'f':
+                return True
+        return False
 
     def balance_cell(self, cell):
         '''Discharge a cell of the battery for balancing.
         @param cell -- the whole number value for a cell (0-7)
         @return -- True if the command was accepted. False if not.
         '''
-        self._write_command(f'#{self.address}b{cell}')
-        time.sleep(0.5)
-        response = self._read_response()
-        pattern = '\$....\s+([0-9])\s+'
-
-        balancing = int(re.findall(pattern, response)[-1])
-        if balancing == 1:
-            return True
-        else:
+        self.invalidate()
+        if self.interlocked() is not None:
             return False
+        accepted = self._request(f'#{self.address}b{cell}', BALANCE_FIELDS, parse_balance)
+        if accepted is True:
+            self._bleeding.add(self.address)
+        return accepted
 
     def balance_max_cell(self):
-        self._write_command(f"#{self.address}bb")
-        time.sleep(0.5)
-        response = self._read_response()
-        pattern = '\s+([0-9])\s+'
-        [balancing] = re.findall(pattern, response)
-        if balancing == 1:
-            return True
-        else:
+        self.invalidate()
+        if self.interlocked() is not None:
             return False
+        accepted = self._request(f"#{self.address}bb", BALANCE_FIELDS, parse_balance)
+        if accepted is True:
+            self._bleeding.add(self.address)
+        return accepted
 
     # ----------------------------------Tests-------------------------------------#
     def is_balanced(self, delta=0.030):
@@ -514,40 +1326,106 @@ class SBM():
     # --------------------------------Balance-------------------------------------#
     def balance_non_min_cells(self, logger):
         '''Discharge and balance cells that are not the minimum voltage cell
+        @return -- the list of cells that accepted the command. Empty if all
+            cells are already within 30mV of each other.
         '''
         voltages = self.get_cell_voltages()
         if self._check_all_cells(voltages) is True:
             logger.info('All cells are within 30mV of each other.')
-            exit()
+            return []
+        mincell = min(voltages)
+        cells = []
         for i in range(len(voltages)):
-            if voltages[i] == min(voltages):
+            if voltages[i] == mincell:
                 logger.info(f"Cell #{i} is the minimum cell.")
                 continue
-            elif voltages[i] - 0.030 < min(voltages) < voltages[i] + 0.030:
+            elif voltages[i] - 0.030 < mincell < voltages[i] + 0.030:
                 logger.info(f"Cell #{i} is within 30mV of the minimum cell.")
                 continue
             else:
-                if self.balance_cell(i) is True:
-                    logger.info(f"Cell #{i} discharging...{round(voltages[i] - min(voltages),3)*1000}mV from minimum cell.")
-                    time.sleep(1)
-                    continue
+                cells.append(i)
+        return self.balance_cells(cells, voltages, logger)
+
+    def balance_cells(self, cells, voltages, logger):
+        '''Discharge the given cells.
+        The bleed commands and a battery summary read go out as one transaction.
+        A bleed command that gets no usable reply is resent on its own, with the
+        bounded retry of every query, before the cell counts as refused.
+        @param cells -- the cell indices (0-7) to discharge.
+        @param voltages -- the cell voltages the decision was based on, for logging.
+        @return -- the list of cells that accepted the command.
+        '''
+        mincell = min(voltages)
+        accepted = []
+        cleared = False  # Whether a watchdog error has been cleared during this pass.
+        self.invalidate()
+        if self.interlocked() is not None:
+            logger.warning('Safety interlock is tripped. Not discharging cells.')
+            return []
+        batch = self.transaction()
+        for i in cells:
+            batch.add(f'#{self.address}b{i}', BALANCE_FIELDS)
+        status = batch.add(f'#{self.address}q0', Q0_FIELDS)
+        replies = batch.send()
+        summary = None
+        if replies[status] is not None:
+            summary = self._decode(parse_summary, replies[status])
+            self._cache(summary=summary)
+            self._inspect(summary)
+            if self.interlocked() is not None:
+                return []  # The interlock has turned the battery off.
+        for i, response in zip(cells, replies):
+            started = None
+            if response is not None:
+                try:
+                    started = self._decode(parse_balance, response)
+                except ResponseError:
+                    pass
+            if started is None:
+                try:
+                    started = self.balance_cell(i)
+                except (TimeoutError, ResponseError):
+                    started = False
+            if started is True:
+                logger.info(f"Cell #{i} discharging...{round(voltages[i] - mincell,3)*1000}mV from minimum cell.")
+                accepted.append(i)
+                if self.compat is True:
+                    self.clock.sleep(1)
+                continue
+            else:
+                logger.info(f"Unable to discharge cell #{i}.")
+                if summary is not None:
+                    error = summary.error_state
                 else:
-                    logger.info(f"Unable to discharge cell #{i}.")
                     error, error_msg = self.get_error_state()
-                    if error == 'm':
-                        logger.error('Reason: Watchdog timeout. Resetting.')
-                        self.reset_battery(5)
-                        self.balance_cell()
-                        logger.info(f"Cell # {i} discharging...{round(voltages[i] - min(voltages),3)*1000}mV from minimum cell.")
-                        time.sleep(1)
-                        continue
+                if error == 'm' or cleared is True:
+                    if cleared is False:
+                        logger.error('Reason: Watchdog timeout. Clearing the error.')
+                        if self.metrics is not None:
+                            self.metrics.watchdog_reset(self.rs485.port)
+                        self.off()
+                        cleared = True
+                        for j in list(accepted):  # bf also stopped the cells started earlier in this pass.
+                            try:
+                                restarted = self.balance_cell(j)
+                            except (TimeoutError, ResponseError):
+                                restarted = False
+                            if restarted is not True:
+                                logger.info(f"Unable to discharge cell #{j}.")
+                                accepted.remove(j)
+                    if self.balance_cell(i) is True:
+                        logger.info(f"Cell #{i} discharging...{round(voltages[i] - mincell,3)*1000}mV from minimum cell.")
+                        accepted.append(i)
+                        if self.compat is True:
+                            self.clock.sleep(1)
+                    continue
+        if accepted:
+            self._bleeding.add(self.address)
+        return accepted
 
     def _check_all_cells(self, voltages):
         '''Check if all cells are within 30mV of the minimum cell.'''
-        for voltage in voltages:
-            if voltage < min(voltages) - 0.030 or voltage > min(voltages) + 0.030:
-                return False
-        return True
+        return max(voltages) <= min(voltages) + 0.030
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+"""Micro-benchmark of the reply parser against the regular expressions it replaced.
+
+    python bluefin/scripts/bench_parser.py
+"""
+
+import re
+import timeit
+from typing import NamedTuple
+
+from balance import parse_cell_summary, parse_summary, parse_version_summary
+
+# The patterns and record type used before parse_frame().
+LEGACY_BATSUM_PATTERN = r'(\$\d{2}[a-z]\d{1})\s+(.)(.)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+:[+-]?[0-9]*[.]?[0-9]+:[+-]?[0-9]*[.]?[0-9]+)\s+([a-z])\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)'
+LEGACY_VERSUM_PATTERN = r'(\$\d{2}[a-z]\d{1})\s+([+-]?[0-9]*[.]?[0-9]+)\s+(.)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+([+-]?[0-9]*[.]?[0-9]+)\s+(.*)\s+\r'
+LEGACY_CELLSUM_PATTERN = r'\s+([+-]?[0-9]*[.]?[0-9]+)'
+
+Q0_REPLY = b'$01q0 b- 29.612 -0.102 24.5 3.690 3.742 0 -3.0 1:02:03 s 0 0 0\r\n'
+Z0_REPLY = b'$01z0 1 s 104215 4215 29.6 50.0 SBM 1.5.0 \r\n'
+Q1_REPLY = b'$01q1 3.701 3.742 3.690 3.711 3.725 3.699 3.702 3.733\r\n'
+
+
+class LEGACY_SUMMARY(NamedTuple):
+    state: str
+    error_state: str
+    voltage: float
+    current: float
+    max_temperature: float
+    min_cell_voltage: float
+    max_cell_voltage: float
+    water_leak_detect: int
+    power: float
+    runtime: str
+    mode: str
+    discharge_status_1: int
+    discharge_status_2: int
+    sleep_timer: int
+
+
+class LEGACY_VERSION_SUMMARY(NamedTuple):
+    address: str
+    mode: str
+    board_sn: int
+    sn: int
+    voltage_rating: float
+    current_rating: float
+    firmware_info: str
+
+
+def legacy_summary(data):
+    [r] = re.findall(LEGACY_BATSUM_PATTERN, data.decode())
+    return LEGACY_SUMMARY(str(r[1]), str(r[2]), float(r[3]), float(r[4]), float(r[5]), float(r[6]),
+                          float(r[7]), int(r[8]), float(r[9]), str(r[10]), str(r[11]), int(r[12]),
+                          int(r[13]), int(r[14]))
+
+
+def legacy_version_summary(data):
+    [r] = re.findall(LEGACY_VERSUM_PATTERN, data.decode())
+    return LEGACY_VERSION_SUMMARY(str(r[1]), str(r[2]), int(r[3]), int(r[4]), float(r[5]),
+                                  float(r[6]), str(r[7]))
+
+
+def legacy_cell_voltages(data):
+    return list(map(float, re.findall(LEGACY_CELLSUM_PATTERN, data.decode())))
+
+
+def bench(func, data, number):
+    best = min(timeit.repeat(lambda: func(data), number=number, repeat=7))
+    return best / number * 1e6
+
+
+def main(number=20000):
+    cases = [('q0', legacy_summary, parse_summary, Q0_REPLY),
+             ('z0', legacy_version_summary, parse_version_summary, Z0_REPLY),
+             ('q1', legacy_cell_voltages, parse_cell_summary, Q1_REPLY)]
+    print(f"{'reply':<6}{'regex (us)':>12}{'parser (us)':>13}{'speedup':>9}")
+    for name, legacy, current, data in cases:
+        old = bench(legacy, data, number)
+        new = bench(current, data, number)
+        print(f'{name:<6}{old:>12.2f}{new:>13.2f}{old / new:>8.1f}x')
+
+
+if __name__ == "__main__":
+    main()
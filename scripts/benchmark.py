@@ -0,0 +1,197 @@
+"""End-to-end benchmarks of the SBM command path and the balancing loop.
+
+Everything runs in-process against simulator.SimulatedSerial on a virtual
+clock, so no hardware or pty is needed and the numbers measure the library
+rather than the bus:
+
+    commands  wall clock time per call for q0, q1, z0, bN and bf, plus the
+              modelled bus time of each exchange at 9600 baud.
+    parsers   BATTERY_SUMMARY and cell list parses per second.
+    balance   simulated seconds for main() to balance each imbalance profile.
+
+    python bluefin/scripts/benchmark.py --output baseline.json
+    python bluefin/scripts/benchmark.py --compare baseline.json
+
+With --compare the exit status is 1 if any tracked metric is worse than the
+baseline by more than --threshold.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import time
+import timeit
+
+import balance
+from balance import SBM, parse_cell_summary, parse_summary
+from bench_parser import Q0_REPLY, Q1_REPLY
+from interlock import InterlockError
+from simulator import SimulatedBattery, SimulatedSerial
+from transcript import VirtualClock
+
+ITERATIONS = 2000
+THRESHOLD = 0.2  # Fractional change beyond which a tracked metric counts as a regression.
+
+# Tracked metric names and the direction that is better: -1 lower, +1 higher.
+TRACKED = {'wall_us_median': -1, 'bus_ms_mean': -1, 'per_second': 1, 'simulated_seconds': -1}
+
+PROFILES = {
+    'one_high': [3.70] * 7 + [3.80],
+    'one_low': [3.60] + [3.70] * 7,
+    'linear': [round(3.60 + 0.02 * i, 3) for i in range(8)],
+    'two_groups': [3.62] * 4 + [3.72] * 4,
+    'random': [round(random.Random(seed).uniform(3.60, 3.75), 3) for seed in range(8)],
+}
+
+
+def _connect(batteries, clock):
+    transport = SimulatedSerial(batteries, clock=clock, timeout=balance.POLL_INTERVAL)
+    return SBM(transport.port, address=batteries[0].address, transport=transport, clock=clock)
+
+
+def bench_commands(iterations=ITERATIONS):
+    """Time each command type through the full SBM path.
+    @return -- a dict of command type -> wall_us_median, wall_us_p95 and bus_ms_mean.
+    """
+    clock = VirtualClock()
+    battery = SimulatedBattery(address=1, watchdog=None, bleed_rate=0.0, heat_per_cell=0.0)
+    calls = {'q0': lambda sbm: sbm.get_summary(),
+             'q1': lambda sbm: sbm.get_cell_summary(),
+             'z0': lambda sbm: sbm.get_version_summary(refresh=True),
+             'bN': lambda sbm: sbm.balance_cell(3),
+             'bf': lambda sbm: sbm.off()}
+    results = {}
+    with _connect([battery], clock) as sbm:
+        for name, call in calls.items():
+            wall = []
+            bus = 0.0
+            for _ in range(iterations):
+                started, virtual = time.perf_counter(), clock.now
+                call(sbm)
+                wall.append(time.perf_counter() - started)
+                bus += clock.now - virtual
+            wall.sort()
+            results[name] = {'iterations': iterations,
+                             'wall_us_median': statistics.median(wall) * 1e6,
+                             'wall_us_p95': wall[int(len(wall) * 0.95)] * 1e6,
+                             'bus_ms_mean': bus / iterations * 1e3}
+    return results
+
+
+def bench_parsers(number=20000):
+    """Measure reply parses per second.
+    @return -- a dict of parser name -> per_second.
+    """
+    cases = {'battery_summary': (parse_summary, Q0_REPLY), 'cell_summary': (parse_cell_summary, Q1_REPLY)}
+    results = {}
+    for name, (parser, data) in cases.items():
+        best = min(timeit.repeat(lambda: parser(data), number=number, repeat=5))
+        results[name] = {'per_second': number / best}
+    return results
+
+
+def bench_balance(profiles=PROFILES):
+    """Run main() on a simulated battery for each imbalance profile.
+    @return -- a dict of profile -> simulated_seconds, commands, final spread and wall seconds.
+    """
+    logger = logging.getLogger('bluefin')
+    if not logger.handlers:  # Keep main() from opening the console and log file handlers.
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    results = {}
+    for name, voltages in profiles.items():
+        clock = VirtualClock()
+        battery = SimulatedBattery(address=0, voltages=voltages, sn=1000)
+        transport = SimulatedSerial([battery], clock=clock, timeout=balance.POLL_INTERVAL)
+        started = time.perf_counter()
+        outcome = 'balanced'
+        try:
+            balance.main(transport.port, telemetry=False, transport=transport, clock=clock)
+        except SystemExit:
+            pass  # main() exits once the battery is balanced.
+        except TimeoutError:
+            outcome = 'over temperature'
+        except InterlockError:
+            outcome = 'interlock'
+        results[name] = {'outcome': outcome,
+                         'simulated_seconds': clock.now,
+                         'commands': transport.commands,
+                         'spread': round(max(battery.voltages) - min(battery.voltages), 4),
+                         'wall_seconds': time.perf_counter() - started}
+    return results
+
+
+def run(iterations=ITERATIONS):
+    """Run every benchmark.
+    @return -- the results as a JSON serialisable dict.
+    """
+    return {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'commands': bench_commands(iterations),
+            'parsers': bench_parsers(),
+            'balance': bench_balance()}
+
+
+def _tracked(results):
+    """Flatten the tracked metrics to {(section, case, metric): value}."""
+    found = {}
+    for section in ('commands', 'parsers', 'balance'):
+        for case, metrics in results.get(section, {}).items():
+            for metric, value in metrics.items():
+                if metric in TRACKED:
+                    found[(section, case, metric)] = value
+    return found
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Compare results with a baseline.
+    @return -- a list of (section, case, metric, baseline, current, change, regressed),
+        where change is the fractional change and regressed is True if it is
+        worse than the threshold.
+    """
+    current = _tracked(results)
+    rows = []
+    for key, before in sorted(_tracked(baseline).items()):
+        if key not in current or before == 0:
+            continue
+        after = current[key]
+        change = (after - before) / before
+        regressed = change * TRACKED[key[2]] < -threshold
+        rows.append((*key, before, after, change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SBM command path and balancing loop.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file instead of stdout.')
+    parser.add_argument('--compare', default=None, help='A baseline JSON file to compare the results with.')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Fractional change that counts as a regression. Default: 0.2.')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS, help='Calls timed per command type.')
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif args.compare is None:
+        print(json.dumps(results, indent=2))
+    if args.compare is None:
+        return
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.threshold)
+    print(f"{'metric':<44}{'baseline':>12}{'current':>12}{'change':>9}")
+    for section, case, metric, before, after, change, regressed in rows:
+        flag = '  REGRESSED' if regressed else ''
+        print(f'{section + "." + case + "." + metric:<44}{before:>12.3f}{after:>12.3f}{change:>+9.1%}{flag}')
+    if any(row[-1] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Shared serial connections for SBM instances on the same bus.
+
+Every SBM created without an explicit transport gets its port from a
+ConnectionPool. The pool opens each physical port (or URL such as
+socket://host:port for ser2net, or rfc2217://host:port) once and hands out
+a reference-counted SharedPort. SBM holds the port's lock for every
+command/response exchange, so instances for different addresses on the same
+adapter take turns instead of interleaving bytes or flushing each other's
+replies. Each shared port also keeps one FrameReassembler, so bytes read
+during one exchange are not lost to the next.
+"""
+
+import atexit
+import re
+import threading
+import time
+
+import serial
+
+LINGER = 5  # Seconds an unused port stays open so back-to-back `with SBM(...)` blocks reuse it.
+MAX_PENDING = 4096  # Bytes kept while waiting for a frame terminator before the oldest are dropped.
+_TERMINATOR = re.compile(rb'[\r\n]')
+
+
+class FrameReassembler():
+    def __init__(self, max_pending=MAX_PENDING):
+        """A persistent receive buffer that splits the byte stream into reply frames.
+        A frame runs from '$' to the first carriage return or line feed. Bytes
+        outside a frame, and a frame cut short by the start of another, are
+        dropped without disturbing the frames around them.
+        @param max_pending -- the most bytes kept while a frame is incomplete.
+        """
+        self.buffer = bytearray()
+        self.max_pending = max_pending
+        self.dropped = 0  # Bytes dropped as noise, broken frames or unmatched frames.
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data):
+        self.buffer += data
+        excess = len(self.buffer) - self.max_pending
+        if excess > 0:
+            self._drop(excess)
+
+    def _drop(self, count):
+        del self.buffer[:count]
+        self.dropped += count
+
+    def frames(self):
+        """Remove and yield each complete frame in the buffer, oldest first.
+        An incomplete frame at the end stays buffered for the next feed().
+        """
+        buffer = self.buffer
+        while buffer:
+            start = buffer.find(b'$')
+            if start == -1:
+                self._drop(len(buffer))
+                return
+            if start:
+                self._drop(start)
+            following = buffer.find(b'$', 1)
+            match = _TERMINATOR.search(buffer)
+            if match is None:
+                if following == -1:
+                    return  # Frame still arriving.
+                self._drop(following)
+                continue
+            end = match.start()
+            if following != -1 and following < end:
+                self._drop(following)  # A frame broken off by the next one.
+                continue
+            end += 1
+            if buffer[end - 1] == 13 and end < len(buffer) and buffer[end] == 10:
+                end += 1
+            frame = bytes(buffer[:end])
+            del buffer[:end]
+            yield frame
+
+    def take(self, header, fields):
+        """Return the first complete frame with the given header and at least
+        the given number of fields. Complete frames before it are dropped.
+        @return -- the frame as bytes, or None if no such frame is complete yet.
+        """
+        for frame in self.frames():
+            if frame.startswith(header) and len(frame.split()) >= fields:
+                return frame
+            self.dropped += len(frame)
+        return None
+
+    def clear(self):
+        self._drop(len(self.buffer))
+
+
+class SharedPort():
+    def __init__(self, url, serial_port):
+        """One open port and the lock that serialises exchanges on it."""
+        self.url = url
+        self.serial = serial_port
+        self.lock = threading.RLock()
+        self.frames = FrameReassembler()
+        self.refs = 0
+        self.released = None  # Monotonic time the last reference was released.
+
+
+class ConnectionPool():
+    def __init__(self, linger=LINGER):
+        """Hand out one shared connection per port.
+        @param linger -- seconds an unreferenced port is kept open before it is
+            closed by a later acquire() or release(). None to keep it open until close().
+        """
+        self.linger = linger
+        self._ports = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url, **settings):
+        """Return the shared connection for a port, opening it if needed.
+        @param url -- a device path (e.g. /dev/ttyUSB0) or a pyserial URL (e.g. socket://host:4001).
+        @param settings -- serial settings used when the port is opened, e.g. baudrate and timeout.
+        @return -- the SharedPort. Pass it to release() when done.
+        """
+        with self._lock:
+            self._close_idle()
+            shared = self._ports.get(url)
+            if shared is None or not shared.serial.is_open:
+                shared = SharedPort(url, serial.serial_for_url(url, **settings))
+                self._ports[url] = shared
+            shared.refs += 1
+            return shared
+
+    def release(self, shared):
+        """Drop a reference to a connection returned by acquire()."""
+        with self._lock:
+            shared.refs -= 1
+            if shared.refs <= 0:
+                shared.refs = 0
+                shared.released = time.monotonic()
+                if self.linger == 0:
+                    self._close(shared)
+            self._close_idle()
+
+    def _close(self, shared):
+        with shared.lock:
+            shared.serial.close()
+        if self._ports.get(shared.url) is shared:
+            del self._ports[shared.url]
+
+    def _close_idle(self):
+        if self.linger is None:
+            return
+        now = time.monotonic()
+        for shared in list(self._ports.values()):
+            if shared.refs == 0 and now - shared.released >= self.linger:
+                self._close(shared)
+
+    def ports(self):
+        """Return a dict of url -> reference count of the open connections."""
+        with self._lock:
+            return {url: shared.refs for url, shared in self._ports.items()}
+
+    def close(self):
+        """Close every connection, referenced or not."""
+        with self._lock:
+            for shared in list(self._ports.values()):
+                self._close(shared)
+
+
+pool = ConnectionPool()
+atexit.register(pool.close)
@@ -0,0 +1,9 @@
+"""Values shared by the balancer, its safety checks, the simulator and the log tools.
+
+Kept free of imports so that any module can use them without pulling in
+balance.py.
+"""
+
+BAUDRATE = 9600
+CHAR_TIME = 10 / BAUDRATE  # Seconds per character at 8N1.
+MAX_TEMPERATURE = 42  # Degrees C at which balancing stops.
@@ -0,0 +1,115 @@
+"""Model-driven balancing controller.
+
+Instead of re-checking the pack every 60 seconds, the controller estimates
+how fast each bleeding cell closes its gap to the minimum cell from
+successive q1 readings, predicts when each cell will be inside the delta
+window, and schedules the next check for the earliest predicted crossing.
+"""
+
+import logging
+
+
+class BalanceController():
+    def __init__(self, delta=0.030, min_interval=5, max_interval=60, learn_interval=15,
+                 smoothing=0.5, stop_overshoot=True, logger=None):
+        """Plan cell bleeding from predicted time to balance.
+        @param delta -- a cell is balanced once it is within delta volts of the minimum cell.
+        @param min_interval -- the shortest wait in seconds between checks.
+        @param max_interval -- the longest wait in seconds between checks.
+        @param learn_interval -- the wait in seconds while no bleed rate is known yet.
+        @param smoothing -- weight of the newest rate measurement (0-1).
+        @param stop_overshoot -- if True, turn bleeding off and re-issue the remaining
+            cells once a bleeding cell has reached the window.
+        @param logger -- the logger to report to. Defaults to the 'bluefin' logger.
+        """
+        self.delta = delta
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.learn_interval = learn_interval
+        self.smoothing = smoothing
+        self.stop_overshoot = stop_overshoot
+        self.logger = logger if logger is not None else logging.getLogger('bluefin')
+        self.rates = {}  # Cell index -> volts per second its gap to the minimum cell closes.
+        self.bleeding = set()
+        self.time_to_balance = None
+        self._last = None  # (timestamp, gaps) of the previous check.
+
+    def gaps(self, voltages):
+        mincell = min(voltages)
+        return [v - mincell for v in voltages]
+
+    def update(self, gaps, timestamp, bleeding_confirmed=True):
+        """Update the bleed rate estimates from a new reading.
+        @param gaps -- each cell's voltage above the minimum cell.
+        @param timestamp -- the monotonic time of the reading.
+        @param bleeding_confirmed -- False if the battery is no longer balancing,
+            in which case the interval cannot be attributed to bleeding.
+        """
+        if self._last is not None and bleeding_confirmed:
+            last_time, last_gaps = self._last
+            dt = timestamp - last_time
+            if dt > 0:
+                for cell in self.bleeding:
+                    rate = (last_gaps[cell] - gaps[cell]) / dt
+                    if rate <= 0:
+                        continue
+                    previous = self.rates.get(cell)
+                    if previous is None:
+                        self.rates[cell] = rate
+                    else:
+                        self.rates[cell] = self.smoothing * rate + (1 - self.smoothing) * previous
+        self._last = (timestamp, gaps)
+
+    def predict(self, gaps):
+        """Predict the seconds until each out of window cell is within delta of the minimum cell.
+        @return -- a dict of cell index -> seconds, or None where no bleed rate is known.
+        """
+        predictions = {}
+        for cell, gap in enumerate(gaps):
+            if gap <= self.delta:
+                continue
+            rate = self.rates.get(cell)
+            predictions[cell] = None if not rate else (gap - self.delta) / rate
+        return predictions
+
+    def next_interval(self, predictions):
+        known = [t for t in predictions.values() if t is not None]
+        if not predictions:
+            return self.min_interval
+        if len(known) < len(predictions):
+            interval = min(known + [self.learn_interval])
+        else:
+            interval = min(known)
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def step(self, sbm, summary, voltages, timestamp=None):
+        """Run one balancing pass.
+        @param sbm -- the SBM connection to the battery.
+        @param summary -- the latest BATTERY_SUMMARY.
+        @param voltages -- the latest cell voltages.
+        @param timestamp -- the monotonic time of the reading. Defaults to now on the SBM's clock.
+        @return -- the number of seconds to wait before the next pass.
+        """
+        timestamp = sbm.clock.monotonic() if timestamp is None else timestamp
+        gaps = self.gaps(voltages)
+        balancing = summary.state == 'b'
+        self.update(gaps, timestamp, bleeding_confirmed=balancing)
+        if not balancing:
+            self.bleeding.clear()
+
+        need = [cell for cell, gap in enumerate(gaps) if gap > self.delta]
+        finished = self.bleeding.difference(need)
+        if self.stop_overshoot and finished and need:
+            self.logger.info(f"Cells {sorted(finished)} reached the window. Stopping bleed before re-issuing.")
+            sbm.off()
+            self.bleeding.clear()
+        self.bleeding = set(sbm.balance_cells(need, voltages, self.logger))
+
+        predictions = self.predict(gaps)
+        if None not in predictions.values():
+            self.time_to_balance = max(predictions.values(), default=0)
+            self.logger.info(f"Predicted time to balance: {round(self.time_to_balance)} seconds.")
+        else:
+            self.time_to_balance = None
+            self.logger.info("Predicted time to balance: unknown until bleed rates are measured.")
+        return self.next_interval(predictions)
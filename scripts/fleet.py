@@ -0,0 +1,328 @@
+"""Balance every battery on every port from one host.
+
+Each battery gets its own balancing state machine,
+
+    RESET -> ASSESS -> BLEED -> VERIFY -> ... -> OFF
+
+whose steps run on a worker pool. Batteries on the same port share one
+connection and take turns on the bus. A hot or faulted battery is handled
+on its own; the rest of the fleet keeps balancing.
+
+    python bluefin/scripts/fleet.py
+    python bluefin/scripts/fleet.py /dev/ttyUSB0 /dev/ttyUSB1 --workers 4
+    python bluefin/scripts/fleet.py --metrics /var/lib/node_exporter/bluefin.prom
+"""
+
+import argparse
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
+from datetime import datetime, timezone
+
+import serial.tools.list_ports
+
+from balance import SBM, IdentityRegistry, delta, initialize_logger, max_temperature
+from controller import BalanceController
+from interlock import Interlock, default_rules
+from metrics import Metrics, TextfileExporter
+
+RESET = 'RESET'
+ASSESS = 'ASSESS'
+BLEED = 'BLEED'
+VERIFY = 'VERIFY'
+COOLING = 'COOLING'
+OFF = 'OFF'
+FAULT = 'FAULT'
+KEEPALIVE_CHECK = 1  # Seconds between checks for bleeding batteries that are due a keepalive.
+
+
+class Bus():
+    def __init__(self, port, timeout=1, metrics=None, registry=None, interlock=None, **options):
+        """One connection shared by the batteries on a port.
+        Hold the lock for every exchange so batteries take turns on the bus. It is
+        reentrant, so a step that faults its battery can turn it off while holding it.
+        @param options -- further SBM arguments, e.g. transport and clock.
+        """
+        self.port = port
+        self.sbm = SBM(port, timeout=timeout, metrics=metrics, registry=registry, interlock=interlock, **options)
+        self.lock = threading.RLock()
+
+    @property
+    def bleeding(self):
+        return bool(self.sbm._bleeding)
+
+    def keepalive(self):
+        """Poll the bleeding batteries on this bus that are due, between their balancing steps."""
+        with self.lock:
+            try:
+                self.sbm.keepalive()
+            except (TimeoutError, ValueError, ConnectionError):
+                pass  # Retried at the next check; a battery that stays silent is handled by its Pack.
+
+    def close(self):
+        self.sbm.__exit__(None, None, None)
+
+
+class _PackLogger(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[{self.extra['pack']}] {msg}", kwargs
+
+
+class Pack():
+    def __init__(self, bus, address, versum, logger, max_errors=5, cool_down=300):
+        """The balancing state machine of one battery.
+        @param bus -- the Bus the battery is on.
+        @param address -- the battery address as a decimal value.
+        @param versum -- the battery's VERSION_SUMMARY.
+        @param logger -- the logger the battery reports to.
+        @param max_errors -- consecutive communication errors before the battery is faulted.
+        @param cool_down -- seconds between checks while the battery is too hot to balance.
+        """
+        self.bus = bus
+        self.address = address
+        self.sn = versum.sn
+        self.max_errors = max_errors
+        self.cool_down = cool_down
+        self.logger = _PackLogger(logger, {'pack': f'{bus.port}#{address} SN {self.sn}'})
+        self.controller = BalanceController(delta=delta, logger=self.logger)
+        self.state = RESET
+        self.summary = None
+        self.voltages = None
+        self.reason = ''
+        self.errors = 0
+
+    @property
+    def spread(self):
+        if self.voltages is None:
+            return None
+        return max(self.voltages) - min(self.voltages)
+
+    def step(self):
+        """Run the current state and move to the next one.
+        @return -- seconds until the next step is due, or None once the battery is done.
+        """
+        with self.bus.lock:
+            sbm = self.bus.sbm
+            sbm.address = sbm._format_address(self.address)
+            try:
+                wait = self._run(sbm)
+                self.errors = 0
+            except (TimeoutError, ValueError, ConnectionError) as e:
+                self.errors += 1
+                self.logger.warning(f'Communication error in {self.state}: {e}')
+                if self.errors >= self.max_errors:
+                    return self._finish(FAULT, f'{self.errors} consecutive communication errors')
+                wait = min(60, 2 ** self.errors)
+        return wait
+
+    def _finish(self, state, reason):
+        self.state = state
+        self.reason = reason
+        log = self.logger.error if state == FAULT else self.logger.info
+        log(f'{state}: {reason}')
+        if state == FAULT:
+            self._shut_down()
+        return None
+
+    def _shut_down(self):
+        """Turn a faulted battery off and stop its keepalives, even if the off command is lost."""
+        with self.bus.lock:
+            sbm = self.bus.sbm
+            address = sbm._format_address(self.address)
+            sbm.address = address
+            try:
+                sbm.off()
+            except (TimeoutError, ValueError, ConnectionError) as e:
+                self.logger.error(f'Unable to turn the battery off: {e}')
+            finally:
+                sbm._bleeding.discard(address)
+
+    def _run(self, sbm):
+        if self.state == RESET:
+            sbm.off()
+            self.state = ASSESS
+            return 1
+        if self.state in (ASSESS, VERIFY, COOLING):
+            snapshot = sbm.snapshot()
+            self.summary, self.voltages = snapshot.summary, snapshot.voltages
+            self.logger.debug(f'Cell Voltages: {self.voltages}')
+            trip = sbm.interlocked()
+            if trip is not None:
+                if trip.rule.field != 'max_temperature':
+                    return self._finish(FAULT, f"interlock '{trip.rule.name}' tripped")
+                sbm.interlock.reset(trip.port, trip.address)  # The battery is already off.
+                self.logger.warning(f"Interlock '{trip.rule.name}' tripped. Cooling down.")
+                self.state = COOLING
+                return self.cool_down
+            error = self.summary.error_state
+            if error == 'm':
+                self.logger.warning('Watchdog timeout. Resetting.')
+                if sbm.metrics is not None:
+                    sbm.metrics.watchdog_reset(self.bus.port)
+                self.state = RESET
+                return 0
+            if error != '-':
+                return self._finish(FAULT, f'error state {error}')
+            if self.summary.max_temperature >= max_temperature:
+                if self.state != COOLING:
+                    self.logger.warning(f'Temperature {self.summary.max_temperature} exceeds '
+                                        f'{max_temperature} degrees. Cooling down.')
+                    sbm.off()
+                self.state = COOLING
+                return self.cool_down
+            if self.spread <= delta:
+                sbm.off()
+                return self._finish(OFF, 'balanced')
+            self.state = BLEED
+        if self.state == BLEED:
+            interval = self.controller.step(sbm, self.summary, self.voltages)
+            self.state = VERIFY
+            return interval
+
+
+class Fleet():
+    def __init__(self, ports=None, workers=4, start=1, stop=250, status_interval=30, logger=None,
+                 metrics=None, registry=None, interlock=None):
+        """Discover and balance every battery on the given ports.
+        @param ports -- the serial ports to use. Defaults to every port on the host.
+        @param workers -- the number of worker threads running battery steps.
+        @param start -- the first address to scan for.
+        @param stop -- the last address to scan for.
+        @param status_interval -- seconds between aggregate status reports.
+        @param logger -- the logger to report to. Defaults to the 'bluefin' logger.
+        @param metrics -- if set, a metrics.Metrics shared by every bus.
+        @param registry -- if set, a balance.IdentityRegistry updated with every battery found.
+        @param interlock -- if set, an interlock.Interlock shared by every bus.
+        """
+        if ports is None:
+            ports = [info.device for info in serial.tools.list_ports.comports()]
+        self.ports = ports
+        self.workers = workers
+        self.start = start
+        self.stop = stop
+        self.status_interval = status_interval
+        self.logger = logger if logger is not None else logging.getLogger('bluefin')
+        self.metrics = metrics
+        self.registry = registry
+        self.interlock = interlock
+        self.buses = []
+        self.packs = []
+
+    def _discover(self, port):
+        try:
+            bus = Bus(port, metrics=self.metrics, registry=self.registry, interlock=self.interlock)
+        except ConnectionError:
+            return None, {}
+        found = bus.sbm.scan(self.start, self.stop)
+        if not found and self.start > 0:
+            found = bus.sbm.scan(0, 0)  # A lone battery still at the default address.
+        return bus, found
+
+    def discover(self):
+        """Scan every port concurrently for batteries."""
+        with ThreadPoolExecutor(max_workers=max(1, len(self.ports))) as pool:
+            for bus, found in pool.map(self._discover, self.ports):
+                if bus is None:
+                    continue
+                if not found:
+                    bus.close()
+                    continue
+                self.buses.append(bus)
+                for address, versum in found.items():
+                    self.packs.append(Pack(bus, address, versum, self.logger))
+                    self.logger.info(f'Found battery {versum.sn} at {bus.port} address {address}.')
+        return self.packs
+
+    def status(self):
+        """Return the aggregate status as a printable table."""
+        counts = {}
+        for pack in self.packs:
+            counts[pack.state] = counts.get(pack.state, 0) + 1
+        lines = [f"{len(self.packs)} batteries: " + ', '.join(f'{n} {s}' for s, n in sorted(counts.items()))]
+        for pack in self.packs:
+            spread = '-' if pack.spread is None else f'{pack.spread * 1000:.0f} mV'
+            temp = '-' if pack.summary is None else f'{pack.summary.max_temperature:.1f} C'
+            ttb = pack.controller.time_to_balance
+            ttb = '-' if ttb is None or pack.state in (OFF, FAULT) else f'{ttb:.0f} s'
+            lines.append(f'  {pack.bus.port:<14}{pack.address:>4}  SN {pack.sn:<8}{pack.state:<8}'
+                         f'spread {spread:<8}temp {temp:<8}balanced in {ttb:<8}{pack.reason}')
+        return '\n'.join(lines)
+
+    def run(self):
+        """Balance until every battery is off or faulted."""
+        queue = [(time.monotonic(), i) for i in range(len(self.packs))]
+        heapq.heapify(queue)
+        running = {}
+        keepalives = {}  # Bus -> its pending keepalive future.
+        next_status = next_keepalive = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while queue or running:
+                now = time.monotonic()
+                while queue and queue[0][0] <= now:
+                    _, i = heapq.heappop(queue)
+                    running[pool.submit(self.packs[i].step)] = i
+                if now >= next_status:
+                    print(self.status(), flush=True)
+                    next_status = now + self.status_interval
+                if now >= next_keepalive:  # Steps can be a minute apart, longer than a bleed's watchdog.
+                    for bus in self.buses:
+                        pending = keepalives.get(bus)
+                        if bus.bleeding and (pending is None or pending.done()):
+                            keepalives[bus] = pool.submit(bus.keepalive)
+                    next_keepalive = now + KEEPALIVE_CHECK
+                timeout = min(queue[0][0] - now if queue else self.status_interval,
+                              next_status - now, next_keepalive - now)
+                if not running:
+                    time.sleep(max(0, timeout))
+                    continue
+                done, _ = wait(running, timeout=max(0, timeout), return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        delay = future.result()
+                    except Exception as e:
+                        delay = self.packs[i]._finish(FAULT, f'unexpected error: {e!r}')
+                    if delay is not None:
+                        heapq.heappush(queue, (time.monotonic() + delay, i))
+        print(self.status(), flush=True)
+
+    def close(self):
+        for bus in self.buses:
+            bus.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Balance every Bluefin 1.5 kWh battery on this host.')
+    parser.add_argument('ports', nargs='*', help='Serial ports to use. Defaults to every port.')
+    parser.add_argument('--workers', type=int, default=4, help='Worker threads running battery steps.')
+    parser.add_argument('--start', type=int, default=1, help='First address to scan for.')
+    parser.add_argument('--stop', type=int, default=250, help='Last address to scan for.')
+    parser.add_argument('--status', type=float, default=30, help='Seconds between status reports.')
+    parser.add_argument('--metrics', help='Prometheus textfile to write bus metrics to.')
+    parser.add_argument('--metrics-interval', type=float, default=15, help='Seconds between metrics writes.')
+    parser.add_argument('--registry', action='store_true',
+                        help='Record every battery found in ~/bluefin/identities.json.')
+    args = parser.parse_args()
+
+    _date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    console = initialize_logger(1, 'fleet', _date)
+    metrics = Metrics() if args.metrics else None
+    fleet = Fleet(args.ports or None, workers=args.workers, start=args.start, stop=args.stop,
+                  status_interval=args.status, logger=console, metrics=metrics,
+                  registry=IdentityRegistry() if args.registry else None,
+                  interlock=Interlock(default_rules(max_temperature=max_temperature), logger=console))
+    with ExitStack() as stack:
+        if metrics is not None:
+            stack.enter_context(TextfileExporter(metrics, args.metrics, args.metrics_interval))
+        stack.callback(fleet.close)
+        if not fleet.discover():
+            console.error('No batteries found.')
+            return
+        fleet.run()
+
+
+if __name__ == "__main__":
+    main()
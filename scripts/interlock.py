@@ -0,0 +1,162 @@
+"""Safety interlocks evaluated on every battery summary.
+
+An Interlock is a list of declarative RULEs on BATTERY_SUMMARY fields. SBM
+hands it every q0 reply it parses, so a rule is checked as often as the
+battery is polled, not once per balancing loop. A rule that trips turns the
+battery off at once, resending bf until a q0 read shows it off, logs the
+sample that tripped it and blocks further bleed commands to that battery
+until reset().
+
+    RULE('over temperature', 'max_temperature', 'above', 42)
+    RULE('temperature rise', 'max_temperature', 'rising', 0.05)
+
+Tests are 'above' (at or above the limit), 'below' (at or below), 'in'
+(one of a set of values) and 'rising' (increasing by at least the limit
+per second, measured against a reference sample that is renewed once it is
+rate_window seconds old).
+"""
+
+import logging
+import threading
+from typing import NamedTuple
+
+from constants import MAX_TEMPERATURE
+
+MIN_CELL_VOLTAGE = 3.0  # Volts.
+MAX_TEMPERATURE_RISE = 0.05  # Degrees C per second, 3 degrees a minute.
+RATE_WINDOW = 30  # Seconds a 'rising' rule's change is measured over at least, so 0.1 C steps do not trip it.
+FAULTS = frozenset('VvICcxTWHh')  # Error states that stop balancing. A watchdog timeout (m) is recovered from instead.
+TESTS = ('above', 'below', 'in', 'rising')
+
+
+class InterlockError(RuntimeError):
+    """A safety interlock turned the battery off."""
+
+
+class RULE(NamedTuple):
+    name: str
+    field: str  # A BATTERY_SUMMARY field.
+    test: str  # One of TESTS.
+    limit: object
+
+
+class TRIP(NamedTuple):
+    rule: RULE
+    port: str
+    address: int
+    value: object  # The field value, or its change per second for a 'rising' rule.
+    timestamp: float
+    summary: object  # The BATTERY_SUMMARY that tripped the rule.
+
+
+def default_rules(max_temperature=MAX_TEMPERATURE, min_cell_voltage=MIN_CELL_VOLTAGE,
+                  max_temperature_rise=MAX_TEMPERATURE_RISE):
+    """Return the standard rules: temperature, leak, error state, cell under-voltage and temperature rise."""
+    return [RULE('over temperature', 'max_temperature', 'above', max_temperature),
+            RULE('water leak', 'water_leak_detect', 'above', 1),
+            RULE('battery error', 'error_state', 'in', FAULTS),
+            RULE('cell under-voltage', 'min_cell_voltage', 'below', min_cell_voltage),
+            RULE('temperature rise', 'max_temperature', 'rising', max_temperature_rise)]
+
+
+def describe(rule, value):
+    """Return a short description of a broken rule, e.g. 'max_temperature 42.5 >= 42'."""
+    if rule.test == 'rising':
+        return f'{rule.field} rising {value:.3f}/s >= {rule.limit}/s'
+    if rule.test == 'in':
+        return f"{rule.field} {value} in {''.join(sorted(rule.limit))}"
+    return f"{rule.field} {value} {'>=' if rule.test == 'above' else '<='} {rule.limit}"
+
+
+class Interlock():
+    def __init__(self, rules=None, logger=None, on_trip=None, rate_window=RATE_WINDOW):
+        """Check every battery summary against a fixed set of rules.
+        @param rules -- a list of RULE. Defaults to default_rules().
+        @param logger -- the logger trips are reported to. Defaults to the 'bluefin' logger.
+        @param on_trip -- optional callable(TRIP) run after the battery has been turned off.
+        @param rate_window -- 'rising' rules trip on a rise of at least limit * rate_window
+            until the reference sample is that old, and on limit per second after.
+        """
+        self.rules = default_rules() if rules is None else list(rules)
+        for rule in self.rules:
+            if rule.test not in TESTS:
+                raise ValueError(f"Unknown interlock test '{rule.test}' in rule '{rule.name}'.")
+        self.logger = logger if logger is not None else logging.getLogger('bluefin')
+        self.on_trip = on_trip
+        self.rate_window = rate_window
+        self._reference = {}  # (port, address) -> (timestamp, BATTERY_SUMMARY) that 'rising' rules compare against.
+        self._tripped = {}  # (port, address) -> the latched TRIP.
+        self._lock = threading.Lock()
+
+    def evaluate(self, summary, previous=None, elapsed=None):
+        """Return the first rule a sample breaks.
+        @param summary -- the BATTERY_SUMMARY to check.
+        @param previous -- an earlier BATTERY_SUMMARY of the battery, for 'rising' rules.
+        @param elapsed -- seconds between the earlier sample and this one.
+        @return -- (RULE, value) or None if every rule passes.
+        """
+        for rule in self.rules:
+            value = getattr(summary, rule.field)
+            if rule.test == 'above':
+                broken = value >= rule.limit
+            elif rule.test == 'below':
+                broken = value <= rule.limit
+            elif rule.test == 'in':
+                broken = value in rule.limit
+            else:
+                if previous is None or not elapsed or elapsed <= 0:
+                    continue
+                rise = value - getattr(previous, rule.field)
+                value = rise / elapsed
+                broken = rise >= rule.limit * max(elapsed, self.rate_window)
+            if broken:
+                return rule, value
+        return None
+
+    def observe(self, sbm, summary):
+        """Check a summary just read from the battery at sbm's current address.
+        If a rule trips, the battery is turned off before this returns, and
+        an error is logged if it could not be confirmed off.
+        @return -- the TRIP, or None if every rule passed.
+        """
+        key = (sbm.rs485.port, int(sbm.address, 16))
+        now = sbm.clock.monotonic()
+        with self._lock:
+            reference = self._reference.get(key)
+            if reference is None or now - reference[0] >= self.rate_window:
+                self._reference[key] = (now, summary)
+        if reference is None:
+            broken = self.evaluate(summary)
+        else:
+            broken = self.evaluate(summary, reference[1], now - reference[0])
+        if broken is None:
+            return None
+        rule, value = broken
+        trip = TRIP(rule, key[0], key[1], value, now, summary)
+        with self._lock:
+            self._tripped[key] = trip
+        self.logger.critical(f"Interlock '{rule.name}' tripped on {key[0]} address {key[1]}: "
+                             f"{describe(rule, value)}. Turning the battery off. Sample: {summary}")
+        if not sbm.confirm_off():
+            self.logger.error(f'Unable to confirm that the battery on {key[0]} address {key[1]} is off. '
+                              f'It may still be bleeding until its watchdog times out.')
+        if self.on_trip is not None:
+            self.on_trip(trip)
+        return trip
+
+    def tripped(self, port, address):
+        """Return the latched TRIP of a battery, or None if it has not tripped.
+        @param port -- the serial port.
+        @param address -- the battery address as a decimal value.
+        """
+        return self._tripped.get((port, int(address)))
+
+    def reset(self, port=None, address=None):
+        """Clear latched trips so bleed commands are sent again.
+        @param port -- the serial port. None for every port.
+        @param address -- the battery address as a decimal value. None for every address.
+        """
+        with self._lock:
+            for key in list(self._tripped):
+                if (port is None or key[0] == port) and (address is None or key[1] == int(address)):
+                    del self._tripped[key]
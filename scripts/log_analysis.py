@@ -0,0 +1,277 @@
+"""Summarise archives of balancing logs with NumPy.
+
+Reads the bluefin1.5kwh_{sn}_{date}.txt logs written by balance.py (plain
+or gzipped after rotation) in fixed-size chunks. Each chunk's Cell
+Voltages, Current Temperature, Balance Loop, New Run and balanced lines
+are extracted with one regex pass per line type and converted to arrays
+without a Python loop over lines. Files are spread over worker processes.
+Each worker reduces its file to per-run rows, so memory stays bounded by
+the chunk size plus one row per balancing run.
+
+    python bluefin/scripts/log_analysis.py ~/bluefin/logs
+    python bluefin/scripts/log_analysis.py ~/bluefin/logs --sort bleed_rate --workers 8
+
+Fleet logs (bluefin1.5kwh_fleet_{date}.txt) do not record cell voltages and are skipped.
+"""
+
+import argparse
+import gzip
+import math
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+from constants import MAX_TEMPERATURE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNK_SIZE = 16 * 1024 * 1024
+FILE_PATTERN = re.compile(r'bluefin1\.5kwh_(\d+)_(\d{4}-\d{2}-\d{2})(?:\.(\d+))?\.txt(?:\.gz)?$')
+
+_STAMP = rb'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3})Z \| \w+ +\| '
+VOLTAGES_LINE = re.compile(_STAMP + rb'Cell Voltages: \[([^\]\n]*)\]', re.M)
+TEMPERATURE_LINE = re.compile(_STAMP + rb'Current Temperature: ([-+0-9.]+)', re.M)
+LOOP_LINE = re.compile(_STAMP + rb'Balance Loop: ', re.M)
+RUN_LINE = re.compile(_STAMP + rb'-+ New Run -+', re.M)
+BALANCED_LINE = re.compile(_STAMP + rb'Battery is balanced\.', re.M)
+
+RUN_COLUMNS = ('start', 'end', 'spread_start', 'spread_end', 'balanced_at', 'max_temperature',
+               'excursions', 'loops', 'continued')
+
+
+class PACK_REPORT(NamedTuple):
+    sn: int
+    runs: int
+    loops: int
+    drift_rate: float  # Volts per day the cell spread grows between runs (median).
+    bleed_rate: float  # Volts per hour the cell spread closes while balancing (median).
+    time_to_balance: float  # Seconds from the start of a run to balanced (median).
+    max_temperature: float
+    excursions: int  # Temperature readings at or above MAX_TEMPERATURE.
+
+
+def log_files(directory):
+    """Return the per-battery log files in a directory tree, with their serial numbers."""
+    found = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            match = FILE_PATTERN.match(name)
+            if match is not None:
+                found.append((int(match.group(1)), os.path.join(root, name)))
+    return sorted(found, key=lambda item: (item[0], item[1]))
+
+
+def _chunks(path, size=CHUNK_SIZE):
+    """Yield a file's contents in chunks that end on a line boundary."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        tail = b''
+        while True:
+            block = f.read(size)
+            if not block:
+                if tail:
+                    yield tail
+                return
+            block = tail + block
+            cut = block.rfind(b'\n') + 1
+            if cut == 0:
+                tail = block
+                continue
+            tail = block[cut:]
+            yield block[:cut]
+
+
+def _seconds(stamps):
+    """Convert a list of ISO timestamp bytes to float seconds since the epoch."""
+    if not stamps:
+        return np.empty(0)
+    times = np.array(stamps, dtype='S23').astype('U23').astype('datetime64[ms]')
+    return times.astype(np.int64) / 1000.0
+
+
+def _parse_chunk(chunk):
+    voltages = VOLTAGES_LINE.findall(chunk)
+    if voltages:
+        stamps, values = zip(*voltages)
+        cells = np.fromstring(b','.join(values).decode(), sep=',')
+        width = len(cells) // len(values)
+        cells = cells[:len(values) * width].reshape(len(values), width)
+        spread = cells.max(axis=1) - cells.min(axis=1)
+        voltage_times = _seconds(list(stamps))
+    else:
+        spread = voltage_times = np.empty(0)
+    temperatures = TEMPERATURE_LINE.findall(chunk)
+    if temperatures:
+        stamps, values = zip(*temperatures)
+        temperature = np.array(values).astype(float)
+        temperature_times = _seconds(list(stamps))
+    else:
+        temperature = temperature_times = np.empty(0)
+    return {'voltage_times': voltage_times, 'spread': spread,
+            'temperature_times': temperature_times, 'temperature': temperature,
+            'loops': _seconds(LOOP_LINE.findall(chunk)),
+            'runs': _seconds(RUN_LINE.findall(chunk)),
+            'balanced': _seconds(BALANCED_LINE.findall(chunk))}
+
+
+def _open_run(start, continued):
+    """Return an empty accumulator for a run that starts at a New Run marker (or None)."""
+    return {'start': start, 'first': math.nan, 'last': math.nan, 'spread_start': math.nan,
+            'spread_end': math.nan, 'balanced_at': math.nan, 'max_temperature': math.nan,
+            'excursions': 0, 'loops': 0, 'continued': continued, 'samples': 0}
+
+
+def _extend_run(run, times, spread, temperature, loops, balanced, max_temperature):
+    """Fold one chunk's lines for a run into its accumulator."""
+    if len(times):
+        if not run['samples']:
+            run['first'], run['spread_start'] = times[0], spread[0]
+        run['last'], run['spread_end'] = times[-1], spread[-1]
+        run['samples'] += len(times)
+    if len(balanced) and math.isnan(run['balanced_at']):
+        run['balanced_at'] = balanced[0]
+    if len(temperature):
+        run['max_temperature'] = np.fmax(run['max_temperature'], temperature.max())
+        run['excursions'] += int(np.count_nonzero(temperature >= max_temperature))
+    run['loops'] += len(loops)
+
+
+def _close_run(run, rows):
+    """Append a finished run to rows. A run without cell voltages is dropped."""
+    if not run['samples']:
+        return
+    balanced = not math.isnan(run['balanced_at'])
+    rows['start'].append(run['first'] if run['continued'] else run['start'])
+    rows['end'].append(run['balanced_at'] if balanced else run['last'])
+    for name in ('spread_start', 'spread_end', 'balanced_at', 'max_temperature', 'excursions', 'loops',
+                 'continued'):
+        rows[name].append(run[name])
+
+
+def summarise_file(path, max_temperature=MAX_TEMPERATURE, chunk_size=CHUNK_SIZE):
+    """Reduce one log file to one row per balancing run.
+    Lines before the file's first New Run marker belong to a run carried over
+    from the previous file and are flagged as continued. Each chunk is folded
+    into the open run as it is read, so only the run rows are kept.
+    @param path -- the log file, plain or gzipped.
+    @param max_temperature -- temperatures at or above this count as excursions.
+    @param chunk_size -- bytes read at a time.
+    @return -- a dict of RUN_COLUMNS -> array, one element per run.
+    """
+    rows = {name: [] for name in RUN_COLUMNS}
+    run = _open_run(None, True)
+    for chunk in _chunks(path, chunk_size):
+        data = _parse_chunk(chunk)
+        markers = data['runs']
+        cuts = {key: np.searchsorted(data[key], markers)
+                for key in ('voltage_times', 'temperature_times', 'loops', 'balanced')}
+        times = np.split(data['voltage_times'], cuts['voltage_times'])
+        spread = np.split(data['spread'], cuts['voltage_times'])
+        temperature = np.split(data['temperature'], cuts['temperature_times'])
+        loops = np.split(data['loops'], cuts['loops'])
+        balanced = np.split(data['balanced'], cuts['balanced'])
+        for i in range(len(markers) + 1):
+            _extend_run(run, times[i], spread[i], temperature[i], loops[i], balanced[i], max_temperature)
+            if i < len(markers):
+                _close_run(run, rows)
+                run = _open_run(markers[i], False)
+    _close_run(run, rows)
+    return {name: np.array(values, dtype=bool if name == 'continued' else float)
+            for name, values in rows.items()}
+
+
+def _merge_runs(runs):
+    """Join runs that continue across files into single runs."""
+    order = np.argsort(runs['start'], kind='stable')
+    runs = {name: column[order] for name, column in runs.items()}
+    keep = ~runs['continued']
+    keep[0] = True
+    for i in np.flatnonzero(~keep):  # A continued run extends the run before it.
+        j = i - 1
+        while not keep[j]:
+            j -= 1
+        runs['end'][j] = runs['end'][i]
+        runs['spread_end'][j] = runs['spread_end'][i]
+        if math.isnan(runs['balanced_at'][j]):
+            runs['balanced_at'][j] = runs['balanced_at'][i]
+        runs['max_temperature'][j] = np.fmax(runs['max_temperature'][j], runs['max_temperature'][i])
+        runs['excursions'][j] += runs['excursions'][i]
+        runs['loops'][j] += runs['loops'][i]
+    return {name: column[keep] for name, column in runs.items()}
+
+
+def _median(values):
+    values = values[np.isfinite(values)]
+    return float(np.median(values)) if len(values) else math.nan
+
+
+def report(sn, runs):
+    """Compute a PACK_REPORT from a battery's per-run rows."""
+    runs = _merge_runs(runs)
+    duration = runs['end'] - runs['start']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bleed = np.where(duration > 0, (runs['spread_start'] - runs['spread_end']) / duration * 3600, np.nan)
+        gap = runs['start'][1:] - runs['end'][:-1]
+        drift = np.where(gap > 0, (runs['spread_start'][1:] - runs['spread_end'][:-1]) / gap * 86400, np.nan)
+    temperatures = runs['max_temperature'][np.isfinite(runs['max_temperature'])]
+    return PACK_REPORT(sn=sn, runs=len(duration), loops=int(runs['loops'].sum()),
+                       drift_rate=_median(drift), bleed_rate=_median(bleed),
+                       time_to_balance=_median(runs['balanced_at'] - runs['start']),
+                       max_temperature=float(temperatures.max()) if len(temperatures) else math.nan,
+                       excursions=int(runs['excursions'].sum()))
+
+
+def analyse(paths, workers=None, max_temperature=MAX_TEMPERATURE):
+    """Summarise every battery in a set of log files or directories.
+    @param paths -- log files and directories to search for logs.
+    @param workers -- the number of worker processes. Defaults to the CPU count.
+    @param max_temperature -- temperatures at or above this count as excursions.
+    @return -- a list of PACK_REPORT, one per battery serial number.
+    """
+    if np is None:
+        raise ImportError('Log analysis requires NumPy (pip install numpy).')
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(log_files(path))
+        else:
+            match = FILE_PATTERN.match(os.path.basename(path))
+            if match is not None:
+                files.append((int(match.group(1)), path))
+    per_pack = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        summaries = pool.map(summarise_file, [path for _, path in files],
+                             [max_temperature] * len(files), chunksize=4)
+        for (sn, _), runs in zip(files, summaries):
+            per_pack.setdefault(sn, []).append(runs)
+    reports = []
+    for sn, parts in per_pack.items():
+        runs = {name: np.concatenate([p[name] for p in parts]) for name in RUN_COLUMNS}
+        if len(runs['start']):
+            reports.append(report(sn, runs))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise Bluefin 1.5 kWh balancing logs.')
+    parser.add_argument('paths', nargs='+', help='Log files or directories of logs.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes. Defaults to the CPU count.')
+    parser.add_argument('--sort', default='drift_rate', choices=PACK_REPORT._fields, help='Column to sort by.')
+    args = parser.parse_args()
+
+    reports = analyse(args.paths, args.workers)
+    reports.sort(key=lambda r: -math.inf if math.isnan(getattr(r, args.sort)) else getattr(r, args.sort),
+                 reverse=True)
+    print(f"{'SN':>8} {'runs':>5} {'loops':>6} {'drift mV/day':>13} {'bleed mV/h':>11} "
+          f"{'balance s':>10} {'max C':>6} {'>=42C':>6}")
+    for r in reports:
+        print(f'{r.sn:>8} {r.runs:>5} {r.loops:>6} {r.drift_rate * 1000:>13.1f} {r.bleed_rate * 1000:>11.1f} '
+              f'{r.time_to_balance:>10.0f} {r.max_temperature:>6.1f} {r.excursions:>6}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Off-thread, batched log files for the 'bluefin' logger.
+
+Records are put on a queue by a QueueHandler and written by a background
+QueueListener, so a log call never waits on the disk. The file handler
+buffers formatted records and writes them in one go whenever the queue
+runs dry or the buffer fills. It starts a new file at UTC midnight or once
+a file reaches max_bytes, and gzips the file it leaves behind.
+
+    bluefin1.5kwh_{sn}_{date}.txt        today's log
+    bluefin1.5kwh_{sn}_{date}.txt.gz     a finished day
+    bluefin1.5kwh_{sn}_{date}.1.txt.gz   a day's first size rollover
+"""
+
+import gzip
+import logging
+import os
+import queue
+import shutil
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+MAX_BYTES = 50 * 1024 * 1024
+CAPACITY = 256  # Records buffered before a write even if more are queued.
+
+
+def compress(path):
+    """Gzip a file and remove the original."""
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+
+
+class DailyFileHandler(logging.Handler):
+    def __init__(self, directory, prefix, date=None, max_bytes=MAX_BYTES, capacity=CAPACITY, compress=True):
+        """Write records to one file per UTC day, rolling over by size as well.
+        @param directory -- the directory the log files are written to.
+        @param prefix -- the file name before the date, e.g. 'bluefin1.5kwh_1234'.
+        @param date -- the date (YYYY-MM-DD) of the first file. Defaults to the first record's date.
+        @param max_bytes -- the size in bytes at which a file is rolled over. None for no limit.
+        @param capacity -- the number of records buffered before they are written.
+        @param compress -- if True, gzip files once they are rolled over.
+        """
+        super().__init__()
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.capacity = capacity
+        self.compress = compress
+        self.date = date
+        self._buffer = []
+        self._pending = 0  # Characters buffered but not yet written.
+        self._stream = None
+        self._size = 0  # Characters in the current file.
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f'{self.prefix}_{self.date}.txt')
+
+    def _open(self):
+        self._stream = open(self.path, 'a', encoding='utf-8')
+        self._size = self._stream.tell()
+
+    def _close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _rollover(self, date):
+        """Finish the current file and move on to the given date."""
+        self._write()
+        self._close()
+        finished = self.path
+        if date == self.date:  # Size rollover within a day.
+            n = 1
+            while any(os.path.exists(os.path.join(self.directory, f'{self.prefix}_{date}.{n}.txt{ext}'))
+                      for ext in ('', '.gz')):
+                n += 1
+            rotated = os.path.join(self.directory, f'{self.prefix}_{date}.{n}.txt')
+            os.replace(finished, rotated)
+            finished = rotated
+        if self.compress and os.path.exists(finished):
+            compress(finished)
+        self.date = date
+
+    def _write(self):
+        if not self._buffer:
+            return
+        if self._stream is None:
+            self._open()
+        data = ''.join(self._buffer)
+        self._buffer.clear()
+        self._pending = 0
+        self._stream.write(data)
+        self._stream.flush()
+        self._size += len(data)
+
+    def emit(self, record):
+        try:
+            date = time.strftime('%Y-%m-%d', time.gmtime(record.created))
+            if self.date is None:
+                self.date = date
+            elif date > self.date:
+                self._rollover(date)
+            if self._stream is None:
+                self._open()
+            line = self.format(record) + '\n'
+            size = self._size + self._pending
+            if self.max_bytes is not None and size > 0 and size + len(line) > self.max_bytes:
+                self._rollover(self.date)
+                self._open()
+            self._buffer.append(line)
+            self._pending += len(line)
+            if len(self._buffer) >= self.capacity:
+                self._write()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._write()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._write()
+            self._close()
+        finally:
+            self.release()
+        super().close()
+
+
+class BatchingQueueListener(QueueListener):
+    """A QueueListener that flushes its handlers whenever the queue runs dry."""
+
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+def queue_logger(logger, handlers):
+    """Route a logger through a queue to handlers served by a background thread.
+    @param logger -- the logger to attach a QueueHandler to.
+    @param handlers -- the handlers the background thread writes to. Their levels are respected.
+    @return -- the started BatchingQueueListener. Call stop() to drain and close it.
+    """
+    records = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(records))
+    listener = BatchingQueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
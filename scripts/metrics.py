@@ -0,0 +1,167 @@
+"""Command latency and bus utilisation metrics for SBM.
+
+Pass a Metrics instance to SBM(metrics=...) to record per-command latency
+histograms, bytes on the wire, timeouts, parse errors, retries, dropped
+bytes and watchdog resets. One instance can be shared by any number of SBM
+objects; every series is labelled with the port. TextfileExporter writes
+the metrics periodically in the Prometheus text format for node_exporter's
+textfile collector.
+"""
+
+import os
+import threading
+import time
+
+from constants import CHAR_TIME
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def command_type(command):
+    """Return the metric label of a command, e.g. '#01b3' -> 'bN'."""
+    op = command[3:5]
+    if op[:1] == 'b' and op[1:].isdigit():
+        return 'bN'
+    return op
+
+
+class Metrics():
+    def __init__(self, buckets=BUCKETS, clock=time):
+        """Thread safe counters and histograms for one or more SBM connections.
+        @param buckets -- the upper bounds in seconds of the latency histogram buckets.
+        @param clock -- the source of monotonic() for bus utilisation. Use the
+            clock of the SBM objects being measured.
+        """
+        self.buckets = tuple(buckets)
+        self.clock = clock
+        self.started = clock.monotonic()
+        self._lock = threading.Lock()
+        self._latency = {}  # (port, command) -> [bucket counts..., +Inf count, sum]
+        self._counters = {}  # (name, port, command) -> value
+
+    def _add(self, name, port, command='', value=1):
+        key = (name, port, command)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, port, command, seconds):
+        """Record the round trip time of a command."""
+        key = (port, command)
+        with self._lock:
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def sent(self, port, count):
+        self._add('bytes_sent', port, value=count)
+
+    def received(self, port, count):
+        self._add('bytes_received', port, value=count)
+
+    def timeout(self, port, command):
+        self._add('timeouts', port, command)
+
+    def parse_error(self, port, command):
+        self._add('parse_errors', port, command)
+
+    def retry(self, port, command):
+        self._add('retries', port, command)
+
+    def dropped(self, port, count):
+        self._add('bytes_dropped', port, value=count)
+
+    def watchdog_reset(self, port):
+        self._add('watchdog_resets', port)
+
+    def snapshot(self):
+        """Return the current values.
+        @return -- a dict with 'latency' mapping (port, command) to a dict of
+            count, sum and cumulative bucket counts, 'counters' mapping
+            (name, port, command) to a value, and 'utilisation' mapping port
+            to the fraction of time the line has been busy since start.
+        """
+        with self._lock:
+            latency = {key: {'count': h[-2], 'sum': h[-1], 'buckets': dict(zip(self.buckets, h[:-2]))}
+                       for key, h in self._latency.items()}
+            counters = dict(self._counters)
+        elapsed = max(self.clock.monotonic() - self.started, 1e-9)
+        traffic = {}
+        for (name, port, _), value in counters.items():
+            if name in ('bytes_sent', 'bytes_received'):
+                traffic[port] = traffic.get(port, 0) + value
+        utilisation = {port: count * CHAR_TIME / elapsed for port, count in traffic.items()}
+        return {'latency': latency, 'counters': counters, 'utilisation': utilisation}
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = ['# HELP bluefin_command_seconds Round trip time of SBM commands.',
+                 '# TYPE bluefin_command_seconds histogram']
+        for (port, command), h in sorted(snapshot['latency'].items()):
+            labels = f'port="{port}",command="{command}"'
+            for bound, count in h['buckets'].items():
+                lines.append(f'bluefin_command_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'bluefin_command_seconds_bucket{{{labels},le="+Inf"}} {h["count"]}')
+            lines.append(f'bluefin_command_seconds_sum{{{labels}}} {h["sum"]:.6f}')
+            lines.append(f'bluefin_command_seconds_count{{{labels}}} {h["count"]}')
+        names = sorted({name for name, _, _ in snapshot['counters']})
+        for name in names:
+            lines.append(f'# TYPE bluefin_{name}_total counter')
+            for (n, port, command), value in sorted(snapshot['counters'].items()):
+                if n != name:
+                    continue
+                labels = f'port="{port}"' + (f',command="{command}"' if command else '')
+                lines.append(f'bluefin_{name}_total{{{labels}}} {value}')
+        lines.append('# HELP bluefin_bus_utilisation_ratio Fraction of time the line carried data since start.')
+        lines.append('# TYPE bluefin_bus_utilisation_ratio gauge')
+        for port, ratio in sorted(snapshot['utilisation'].items()):
+            lines.append(f'bluefin_bus_utilisation_ratio{{port="{port}"}} {ratio:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+class TextfileExporter():
+    def __init__(self, metrics, path, interval=15):
+        """Periodically write metrics for node_exporter's textfile collector.
+        @param metrics -- the Metrics to export.
+        @param path -- the .prom file to write. It is replaced atomically.
+        @param interval -- seconds between writes.
+        """
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, et, ev, etb):
+        self.stop()
+
+    def write(self):
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.metrics.render())
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
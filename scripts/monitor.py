@@ -0,0 +1,192 @@
+"""Adaptive-rate monitoring of Bluefin 1.5 kWh batteries.
+
+A Monitor polls q0/q1 on a schedule set by each pack's last reading. A pack
+that carries current, runs hot or reports an error is polled every few
+seconds. A pack that is off and idle is polled about once a minute. Callbacks
+fire when a reading crosses a threshold or the state or error flag changes.
+Between polls the monitor waits with SBM.idle(), so bleeding packs keep
+their watchdog fed.
+
+    python bluefin/scripts/monitor.py /dev/ttyUSB0 1,2,3
+"""
+
+import argparse
+import heapq
+import threading
+from typing import NamedTuple
+
+from constants import MAX_TEMPERATURE
+
+
+class EVENT(NamedTuple):
+    kind: str  # 'temperature', 'current', 'state', 'error', 'water' or 'comms'.
+    address: int
+    previous: object
+    value: object
+    snapshot: object  # The SNAPSHOT that triggered the event, or None if the pack stopped answering.
+
+
+class Monitor():
+    def __init__(self, sbm, addresses=None, fast_interval=2, interval=10, idle_interval=60,
+                 current_threshold=1.0, warning_temperature=38, max_temperature=MAX_TEMPERATURE,
+                 on_event=None, on_sample=None):
+        """Poll batteries at a rate set by their state.
+        @param sbm -- the SBM connection to the bus.
+        @param addresses -- the battery addresses as decimal values. Defaults to the SBM's address.
+        @param fast_interval -- seconds between polls of a pack with current, an error or a hot cell.
+        @param interval -- seconds between polls of a pack that is on but quiet, e.g. balancing.
+        @param idle_interval -- seconds between polls of a pack that is off and idle.
+        @param current_threshold -- amps (either direction) above which a pack is polled fast.
+        @param warning_temperature -- degrees C from which the poll rate rises towards
+            fast_interval as the temperature approaches max_temperature.
+        @param max_temperature -- the temperature cutoff in degrees C.
+        @param on_event -- optional callable(EVENT) run on every threshold crossing or change.
+        @param on_sample -- optional callable(address, snapshot) run after every good poll.
+        """
+        self.sbm = sbm
+        if addresses is None:
+            addresses = [int(sbm.address, 16)]
+        self.fast_interval = fast_interval
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.current_threshold = current_threshold
+        self.warning_temperature = warning_temperature
+        self.max_temperature = max_temperature
+        self.on_event = on_event
+        self.on_sample = on_sample
+        self.latest = {}  # Address -> the latest SNAPSHOT, or None after a failed poll.
+        self._queue = []
+        self._seq = 0
+        self._running = False
+        self._thread = None
+        now = sbm.clock.monotonic()
+        for address in addresses:
+            self._push(now, int(address))
+
+    def _push(self, due, address):
+        self._seq += 1
+        heapq.heappush(self._queue, (due, self._seq, address))
+
+    def next_interval(self, summary):
+        """Return the seconds until a pack with this summary should be polled again."""
+        if summary.error_state != '-' or abs(summary.current) >= self.current_threshold:
+            return self.fast_interval
+        temperature = summary.max_temperature
+        if temperature >= self.warning_temperature:
+            span = max(self.max_temperature - self.warning_temperature, 1e-9)
+            closeness = min(1.0, (temperature - self.warning_temperature) / span)
+            return self.interval - (self.interval - self.fast_interval) * closeness
+        if summary.state == 'f' and summary.current == 0:
+            return self.idle_interval
+        return self.interval
+
+    def _level(self, summary):
+        temperature = summary.max_temperature
+        if temperature >= self.max_temperature:
+            return 'cutoff'
+        if temperature >= self.warning_temperature:
+            return 'warning'
+        return 'normal'
+
+    def _events(self, address, previous, snapshot):
+        """Yield the EVENTs between two readings of a pack."""
+        if snapshot is None:
+            if previous is not None:
+                yield EVENT('comms', address, 'ok', 'lost', None)
+            return
+        summary = snapshot.summary
+        if previous is None:
+            if address in self.latest:
+                yield EVENT('comms', address, 'lost', 'ok', snapshot)
+            if summary.error_state != '-':
+                yield EVENT('error', address, None, summary.error_state, snapshot)
+            if self._level(summary) != 'normal':
+                yield EVENT('temperature', address, None, self._level(summary), snapshot)
+            return
+        before = previous.summary
+        if summary.error_state != before.error_state:
+            yield EVENT('error', address, before.error_state, summary.error_state, snapshot)
+        if summary.state != before.state:
+            yield EVENT('state', address, before.state, summary.state, snapshot)
+        if self._level(summary) != self._level(before):
+            yield EVENT('temperature', address, self._level(before), self._level(summary), snapshot)
+        high = abs(summary.current) >= self.current_threshold
+        if high != (abs(before.current) >= self.current_threshold):
+            yield EVENT('current', address, before.current, summary.current, snapshot)
+        if summary.water_leak_detect != before.water_leak_detect:
+            yield EVENT('water', address, before.water_leak_detect, summary.water_leak_detect, snapshot)
+
+    def poll(self, address):
+        """Poll one pack, fire its callbacks and return the seconds until it is next due."""
+        sbm = self.sbm
+        original = sbm.address
+        sbm.address = sbm._format_address(address)
+        try:
+            snapshot = sbm.snapshot()
+        except (TimeoutError, ValueError):
+            snapshot = None
+        finally:
+            sbm.address = original
+        previous = self.latest.get(address)
+        events = list(self._events(address, previous, snapshot))
+        self.latest[address] = snapshot
+        if snapshot is not None and self.on_sample is not None:
+            self.on_sample(address, snapshot)
+        if self.on_event is not None:
+            for event in events:
+                self.on_event(event)
+        if snapshot is None:
+            return self.fast_interval
+        return self.next_interval(snapshot.summary)
+
+    def run(self, duration=None):
+        """Poll until stopped or for the given number of seconds."""
+        clock = self.sbm.clock
+        self._running = True
+        stop_time = None if duration is None else clock.monotonic() + duration
+        while self._running and self._queue:
+            due, _, address = self._queue[0]
+            if stop_time is not None and due > stop_time:
+                self.sbm.idle(max(0.0, stop_time - clock.monotonic()))
+                break
+            wait = due - clock.monotonic()
+            if wait > 0:
+                self.sbm.idle(min(wait, 1.0))  # Re-check often enough for stop() to take effect.
+                continue
+            heapq.heappop(self._queue)
+            self._push(clock.monotonic() + self.poll(address), address)
+
+    def start(self):
+        """Monitor on a background thread."""
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+
+def main():
+    from balance import SBM  # balance imports this module.
+
+    parser = argparse.ArgumentParser(description='Monitor Bluefin 1.5 kWh batteries at a state dependent rate.')
+    parser.add_argument('port', help='The serial port of the bus.')
+    parser.add_argument('addresses', nargs='?', default='0', help='Comma separated battery addresses.')
+    parser.add_argument('--duration', type=float, default=None, help='Seconds to monitor for.')
+    args = parser.parse_args()
+
+    def report(event):
+        print(f'Address {event.address}: {event.kind} {event.previous} -> {event.value}', flush=True)
+
+    addresses = [int(a) for a in args.addresses.split(',')]
+    with SBM(args.port) as sbm:
+        try:
+            sbm.monitor(addresses, on_event=report).run(args.duration)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Poll several Bluefin 1.5 kWh batteries that share one RS-485 bus.
+
+A single thread owns the port and issues one q0/q1 pair at a time, so there
+is never more than one command in flight on the half-duplex line. Batteries
+that are hot or balancing are polled more often than idle ones.
+
+    python bluefin/scripts/poller.py /dev/ttyUSB0 1,2,3 --duration 60
+"""
+
+import argparse
+import heapq
+import threading
+from collections import deque
+from typing import NamedTuple
+
+from balance import SBM, SNAPSHOT
+
+
+class PACK_STATUS(NamedTuple):
+    address: int
+    snapshot: SNAPSHOT or None
+    staleness: float or None
+    polls: int
+    errors: int
+    priority: int
+
+
+class BusPoller():
+    def __init__(self, port, addresses, period=10, fast_period=2, hot_temperature=38,
+                 timeout=1, on_sample=None, window=60, **options):
+        """Schedule q0/q1 polls across the batteries on one bus.
+        @param port -- the serial port of the bus.
+        @param addresses -- the battery addresses as decimal values.
+        @param period -- seconds between polls of an idle battery.
+        @param fast_period -- seconds between polls of a hot or balancing battery.
+        @param hot_temperature -- the temperature at which a battery is polled fast.
+        @param timeout -- the reply deadline in seconds for each command.
+        @param on_sample -- optional callable(address, snapshot) run after each poll.
+        @param window -- seconds of history used for the polls per second figure.
+        @param options -- further SBM arguments, e.g. transport and clock.
+        """
+        self.sbm = SBM(port, address=0, timeout=timeout, **options)
+        self.clock = self.sbm.clock
+        self.period = period
+        self.fast_period = fast_period
+        self.hot_temperature = hot_temperature
+        self.on_sample = on_sample
+        self.window = window
+
+        self._queue = []
+        self._seq = 0
+        self._status = {}
+        self._priority = {}
+        self._history = deque()
+        self._thread = None
+        self._running = False
+        now = self.clock.monotonic()
+        for address in addresses:
+            address = int(address)
+            self._status[address] = PACK_STATUS(address, None, None, 0, 0, 1)
+            self._push(now, address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, et, ev, etb):
+        self.stop()
+        self.sbm.__exit__(et, ev, etb)
+
+    def _push(self, due, address):
+        self._seq += 1  # Ties are served in insertion order, i.e. round-robin.
+        heapq.heappush(self._queue, (due, self._seq, address))
+
+    def set_priority(self, address, priority):
+        """Pin the priority of a battery.
+        @param address -- the battery address as a decimal value.
+        @param priority -- polls are issued priority times as often as an idle
+            battery, or None to return to state based scheduling.
+        """
+        if priority is None:
+            self._priority.pop(int(address), None)
+        else:
+            self._priority[int(address)] = max(1, int(priority))
+
+    def priority(self, snapshot):
+        """Return the scheduling priority implied by a battery's latest reading."""
+        if snapshot is None:
+            return 1
+        summary = snapshot.summary
+        if summary.max_temperature >= self.hot_temperature or summary.state == 'b':
+            return max(1, round(self.period / self.fast_period))
+        return 1
+
+    def poll_next(self):
+        """Wait for the next battery to fall due and poll it.
+        @return -- the PACK_STATUS of the polled battery.
+        """
+        due, _, address = heapq.heappop(self._queue)
+        delay = due - self.clock.monotonic()
+        if delay > 0:
+            self.clock.sleep(delay)
+        status = self._status[address]
+        self.sbm.address = self.sbm._format_address(address)
+        try:
+            snapshot = self.sbm.snapshot()
+        except (TimeoutError, ValueError):
+            snapshot = None
+        now = self.clock.monotonic()
+        if snapshot is None:
+            status = status._replace(errors=status.errors + 1)
+        else:
+            self._history.append(now)
+            priority = self._priority.get(address, self.priority(snapshot))
+            status = status._replace(snapshot=snapshot, polls=status.polls + 1, priority=priority)
+        self._status[address] = status
+        self._push(now + self.period / status.priority, address)
+        while self._history and now - self._history[0] > self.window:
+            self._history.popleft()
+        if snapshot is not None and self.on_sample is not None:
+            self.on_sample(address, snapshot)
+        return self.status(address)
+
+    def run(self, duration=None):
+        """Poll until stopped or for the given number of seconds."""
+        self._running = True
+        stop_time = None if duration is None else self.clock.monotonic() + duration
+        while self._running:
+            if stop_time is not None and self._queue[0][0] > stop_time:
+                break
+            self.poll_next()
+
+    def start(self):
+        """Poll on a background thread."""
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    def polls_per_second(self):
+        """Return the achieved poll rate over the history window."""
+        if len(self._history) < 2:
+            return 0.0
+        span = self.clock.monotonic() - self._history[0]
+        return len(self._history) / max(span, 1e-9)
+
+    def status(self, address):
+        """Return the PACK_STATUS of a battery, with staleness in seconds since its last good poll."""
+        status = self._status[int(address)]
+        if status.snapshot is not None:
+            status = status._replace(staleness=self.clock.monotonic() - status.snapshot.timestamp)
+        return status
+
+    def staleness(self):
+        """Return a dict of address -> seconds since the last good poll (None if never polled)."""
+        return {address: self.status(address).staleness for address in self._status}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Poll several Bluefin 1.5 kWh batteries on one bus.')
+    parser.add_argument('port', help='The serial port of the bus.')
+    parser.add_argument('addresses', help='Comma separated battery addresses.')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to poll for.')
+    parser.add_argument('--period', type=float, default=10, help='Seconds between polls of an idle battery.')
+    parser.add_argument('--fast-period', type=float, default=2, help='Seconds between polls of a busy battery.')
+    args = parser.parse_args()
+
+    addresses = [int(a) for a in args.addresses.split(',')]
+    with BusPoller(args.port, addresses, period=args.period, fast_period=args.fast_period) as poller:
+        poller.run(args.duration)
+        print(f'Polls per second: {poller.polls_per_second():.2f}')
+        for address in addresses:
+            status = poller.status(address)
+            staleness = 'never polled' if status.staleness is None else f'{status.staleness:.1f}s stale'
+            print(f'Address {address}: {status.polls} polls, {status.errors} errors, '
+                  f'priority {status.priority}, {staleness}')
+
+
+if __name__ == "__main__":
+    main()
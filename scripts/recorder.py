@@ -0,0 +1,169 @@
+"""Fixed-width binary time series of battery telemetry.
+
+Each q0/q1 sample is stored as one row of 14 float64 values:
+
+    timestamp, cell_1 ... cell_8, voltage, current, temperature, state, error
+
+where timestamp is seconds since the Unix epoch (UTC) and state and error
+are the character codes of the q0 state and error flags. Files start with
+a 16 byte header. TelemetryReader memory-maps a file and exposes the rows
+as NumPy columns without copying them.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNS = ('timestamp', 'cell_1', 'cell_2', 'cell_3', 'cell_4', 'cell_5', 'cell_6', 'cell_7',
+           'cell_8', 'voltage', 'current', 'temperature', 'state', 'error')
+ROW_VALUES = len(COLUMNS)
+ROW_SIZE = ROW_VALUES * 8
+MAGIC = b'BFTLM1'
+HEADER = struct.Struct('<6s2sII')  # Magic, byte order, values per row, reserved.
+BYTEORDER = b'le' if sys.byteorder == 'little' else b'be'
+
+
+def default_path(sn):
+    """Return the telemetry file path for a battery serial number."""
+    save_dir = os.path.join(os.path.expanduser('~'), 'bluefin', 'data')
+    return os.path.join(save_dir, f'bluefin1.5kwh_{sn}.bin')
+
+
+class TelemetryRecorder():
+    def __init__(self, path, rows=256, flush_interval=60):
+        """Append telemetry rows to a binary file.
+        @param path -- the file to append to. It is created with a header if missing.
+        @param rows -- the number of rows buffered in memory between writes.
+        @param flush_interval -- the maximum number of seconds a row stays buffered.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._buffer = array('d', bytes(rows * ROW_SIZE))
+        self._rows = rows
+        self._count = 0
+        self._last_flush = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        if new:
+            self._file.write(HEADER.pack(MAGIC, BYTEORDER, ROW_VALUES, 0))
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, et, ev, etb):
+        self.close()
+
+    def append(self, summary, voltages, timestamp=None):
+        """Buffer one sample.
+        @param summary -- the BATTERY_SUMMARY of the sample.
+        @param voltages -- the 8 cell voltages of the sample.
+        @param timestamp -- seconds since the epoch. Defaults to now.
+        """
+        if len(voltages) != 8:
+            raise ValueError('A telemetry row needs all 8 cell voltages.')
+        i = self._count * ROW_VALUES
+        row = self._buffer
+        row[i] = time.time() if timestamp is None else timestamp
+        row[i + 1:i + 9] = array('d', voltages)
+        row[i + 9] = summary.voltage
+        row[i + 10] = summary.current
+        row[i + 11] = summary.max_temperature
+        row[i + 12] = ord(summary.state)
+        row[i + 13] = ord(summary.error_state)
+        self._count += 1
+        if self._count == self._rows or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def record(self, snapshot):
+        """Buffer a SNAPSHOT from SBM.snapshot()."""
+        self.append(snapshot.summary, snapshot.voltages)
+
+    def flush(self):
+        if self._count:
+            self._file.write(memoryview(self._buffer)[:self._count * ROW_VALUES])
+            self._file.flush()
+            self._count = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+class TelemetryReader():
+    def __init__(self, path):
+        """Memory-map a telemetry file for reading.
+        Columns returned by this reader are views into the mapping. They stay
+        valid after the reader is closed, which then frees the mapping with them.
+        @param path -- the file written by TelemetryRecorder.
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError(f'{path} is not a telemetry file.')
+        magic, byteorder, values, _ = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC or values != ROW_VALUES:
+            raise ValueError(f'{path} is not a telemetry file.')
+        if byteorder != BYTEORDER:
+            raise ValueError(f'{path} was written on a machine with a different byte order.')
+        self.rows = (size - HEADER.size) // ROW_SIZE  # A partially written last row is ignored.
+        self._mmap = None
+        if self.rows:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, et, ev, etb):
+        self.close()
+
+    def __len__(self):
+        return self.rows
+
+    def table(self):
+        """Return every row as a (rows, 14) view: a NumPy array if NumPy is
+        installed, otherwise a two dimensional memoryview (empty and one
+        dimensional if the file has no rows).
+        """
+        if not self.rows:
+            if np is not None:
+                return np.empty((0, ROW_VALUES))
+            return memoryview(array('d'))
+        if np is not None:
+            return np.frombuffer(self._mmap, dtype=np.float64, count=self.rows * ROW_VALUES,
+                                 offset=HEADER.size).reshape(self.rows, ROW_VALUES)
+        data = memoryview(self._mmap)[HEADER.size:HEADER.size + self.rows * ROW_SIZE]
+        return data.cast('d', (self.rows, ROW_VALUES))
+
+    def column(self, name):
+        """Return one column by name. A NumPy view if NumPy is installed, otherwise an array('d') copy."""
+        index = COLUMNS.index(name)
+        table = self.table()
+        if np is not None:
+            return table[:, index]
+        return array('d', (table[i, index] for i in range(self.rows)))
+
+    def columns(self):
+        """Return a dict of column name -> column."""
+        return {name: self.column(name) for name in COLUMNS}
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # Columns still refer to it. The mapping is released with the last of them.
+            self._mmap = None
+        self._file.close()
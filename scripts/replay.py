@@ -0,0 +1,61 @@
+"""Replay a recorded serial transcript through the balancer.
+
+Set transcript = True in balance.py to record a field run, then feed the
+transcript back into the same balancing logic without hardware:
+
+    python bluefin/scripts/replay.py ~/bluefin/transcripts/bluefin1.5kwh_20240101T000000Z.bft
+    python bluefin/scripts/replay.py session.bft --speed 1
+
+By default the replay runs as fast as possible on a virtual clock, so the
+controller's waits cost nothing and a session of hours replays in seconds.
+"""
+
+import argparse
+import time
+
+import balance
+from interlock import InterlockError
+from transcript import ReplayError, ReplaySerial, VirtualClock
+
+
+def replay(path, speed=None, strict=False):
+    """Run balance.main() against a transcript.
+    A transcript that stops before the run did (e.g. an interrupted session)
+    ends the replay where it stops.
+    @param path -- the transcript file.
+    @param speed -- virtual seconds per wall clock second, e.g. 1 for real time. None for as fast as possible.
+    @param strict -- if True, stop at the first command that differs from the transcript.
+    @return -- the ReplaySerial, for its mismatches and clock.
+    """
+    clock = VirtualClock(speed)
+    transport = ReplaySerial(path, clock=clock, strict=strict, timeout=balance.POLL_INTERVAL)
+    try:
+        balance.main(path, telemetry=False, transport=transport, clock=clock)
+    except SystemExit:
+        pass  # main() exits once the battery is balanced.
+    except (TimeoutError, ReplayError, InterlockError):
+        if not transport.finished:
+            raise
+        transport.truncated = True  # The balancer waited on traffic the recording does not have.
+    return transport
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a Bluefin serial transcript through the balancer.')
+    parser.add_argument('path', help='The transcript file to replay.')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='Virtual seconds per wall clock second. Default: as fast as possible.')
+    parser.add_argument('--strict', action='store_true', help='Stop at the first diverging command.')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    transport = replay(args.path, args.speed, args.strict)
+    wall = time.monotonic() - start
+    print(f'Replayed {transport.clock.now:.1f} s of traffic in {wall:.2f} s, '
+          f'{len(transport.events)} events, {transport.mismatches} diverging commands.')
+    if transport.truncated:
+        print('The transcript ended before the run did.')
+
+
+if __name__ == "__main__":
+    main()
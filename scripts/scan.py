@@ -0,0 +1,31 @@
+"""List the batteries on an RS-485 bus.
+
+    python bluefin/scripts/scan.py /dev/ttyUSB0
+    python bluefin/scripts/scan.py /dev/ttyUSB0 1 20
+
+Scans start at address 1 by default, as every battery answers address 0.
+Pass 0 as the start address to find a lone battery still at the default address.
+"""
+
+import sys
+import time
+
+from balance import SBM
+
+
+def main():
+    port = sys.argv[1]
+    start = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    stop = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+    with SBM(port) as sbm:
+        t0 = time.monotonic()
+        found = sbm.scan(start, stop)
+        elapsed = time.monotonic() - t0
+    for address, versum in found.items():
+        print(f'{address:>3}  SN {versum.sn}  FW {versum.firmware_info}  '
+              f'{versum.voltage_rating} V / {versum.current_rating} A  mode {versum.mode}')
+    print(f'Found {len(found)} battery(s) at addresses {start}-{stop} in {elapsed:.1f} seconds.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+"""Pseudo-terminal simulator for Bluefin 1.5 kWh batteries.
+
+Opens a Linux pty that answers the SBM command set so that the balancer and
+the SBM class can be exercised without hardware. Run it directly to get a
+port that balance.py can be pointed at:
+
+    python bluefin/scripts/simulator.py --addresses 0
+    python bluefin/scripts/balance.py /dev/pts/5
+
+SimulatedSerial serves the same batteries in-process, without a pty, for
+use as an SBM transport.
+"""
+
+import argparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+from constants import CHAR_TIME
+
+CHUNK = 8  # Characters written to the pty at a time when pacing replies.
+
+STATES = ('f', 'd', 'c', 'b')
+ERRORS = ('-', 'V', 'v', 'I', 'C', 'c', 'x', 'T', 'W', 'H', 'h', 'm')
+
+
+class SimulatedBattery():
+    def __init__(self, address=0, voltages=None, temperature=22.0, sn=None,
+                 bleed_rate=0.0005, bleed_duration=60, watchdog=30,
+                 heat_per_cell=0.002, cooling=0.001, firmware='SBM 1.5.0 sim'):
+        """A single simulated battery.
+        @param address -- the battery address as a decimal value (0-250).
+        @param voltages -- the 8 starting cell voltages. Random if None.
+        @param temperature -- the ambient temperature in degrees C.
+        @param sn -- the battery serial number. Random if None.
+        @param bleed_rate -- volts per second lost by a cell with its bleed resistor on.
+        @param bleed_duration -- seconds a cell bleeds after a bN command.
+        @param watchdog -- seconds without a command before a balancing battery
+            stops bleeding and raises the watchdog error (m).
+        @param heat_per_cell -- degrees per second added per bleeding cell.
+        @param cooling -- fraction per second of the gap to ambient recovered.
+        """
+        self.address = int(address)
+        if voltages is None:
+            voltages = [round(random.uniform(3.60, 3.75), 3) for _ in range(8)]
+        self.voltages = list(map(float, voltages))
+        self.ambient = float(temperature)
+        self.temperature = float(temperature)
+        self.sn = random.randint(1000, 9999) if sn is None else int(sn)
+        self.board_sn = self.sn + 100000
+        self.firmware = firmware
+        self.bleed_rate = bleed_rate
+        self.bleed_duration = bleed_duration
+        self.watchdog = watchdog
+        self.heat_per_cell = heat_per_cell
+        self.cooling = cooling
+
+        self.state = 'f'
+        self.error = '-'
+        self.current = 0.0
+        self.water = 0
+        self.mode = 's'
+        self.sleep_timer = 0
+        self.bleeding = {}  # Cell index -> model time the bleed ends.
+        self.on_time = None
+        self.last_command = 0.0
+        self.now = 0.0
+
+    @property
+    def hex_address(self):
+        return f'{self.address:02x}'
+
+    def step(self, now):
+        """Advance the model to the given model time in seconds."""
+        dt = max(0.0, now - self.now)
+        self.now = now
+        if self.bleeding and self.watchdog is not None and now - self.last_command > self.watchdog:
+            self.bleeding.clear()
+            self.error = 'm'
+        for cell, until in list(self.bleeding.items()):
+            active = min(dt, max(0.0, until - (now - dt)))
+            self.voltages[cell] -= self.bleed_rate * active
+            if until <= now:
+                del self.bleeding[cell]
+        heat = self.heat_per_cell * len(self.bleeding)
+        self.temperature += (heat - self.cooling * (self.temperature - self.ambient)) * dt
+        if self.sleep_timer > 0:
+            self.sleep_timer = max(0, self.sleep_timer - dt)
+            if self.sleep_timer == 0:
+                self._turn_off()
+        if self.bleeding:
+            self.state = 'b'
+            if self.on_time is None:
+                self.on_time = now
+        elif self.state == 'b':
+            self.state = 'f'
+        if self.water and self.error == '-':
+            self.error = 'W'
+
+    def _turn_off(self):
+        self.bleeding.clear()
+        self.state = 'f'
+        self.error = '-'
+        self.current = 0.0
+        self.on_time = None
+
+    def _bleed(self, cell):
+        if self.error != '-' or not 0 <= cell < len(self.voltages):
+            return 0
+        self.bleeding[cell] = self.now + self.bleed_duration
+        self.state = 'b'
+        if self.on_time is None:
+            self.on_time = self.now
+        return 1
+
+    def summary(self):
+        voltage = sum(self.voltages)
+        runtime = 0 if self.on_time is None else int(self.now - self.on_time)
+        h, m, s = runtime // 3600, runtime % 3600 // 60, runtime % 60
+        return (f"{self.state}{self.error} {voltage:.3f} {self.current:.3f} "
+                f"{self.temperature:.1f} {min(self.voltages):.3f} {max(self.voltages):.3f} "
+                f"{self.water} {voltage * self.current:.1f} {h}:{m:02d}:{s:02d} "
+                f"{self.mode} 0 0 {int(self.sleep_timer)}")
+
+    def handle(self, header, op, arg):
+        """Apply a command addressed to this battery.
+        @param header -- the reply header address (e.g. '01').
+        @param op -- the two character operation (e.g. 'q0', 'b3').
+        @param arg -- the command argument, or an empty string.
+        @return -- the reply line without terminator, or None if the battery stays silent.
+        """
+        self.last_command = self.now
+        prefix = f'${header}{op}'
+        if op == 'q0':
+            return f'{prefix} {self.summary()}'
+        elif op == 'q1':
+            return prefix + ''.join(f' {v:.3f}' for v in self.voltages)
+        elif op == 'z0':
+            return (f'{prefix} {self.address} {self.mode} {self.board_sn} {self.sn} '
+                    f'{sum(self.voltages):.1f} 50.0 {self.firmware} ')
+        elif op == '?0':
+            return f'{prefix} {self.hex_address}'
+        elif op == '?8':
+            self.address = int(arg, 16)
+            return f'{prefix} {self.hex_address}'
+        elif op == 'bf':
+            self._turn_off()
+            return prefix
+        elif op == 'bs':
+            self.sleep_timer = float(arg or 0)
+            if self.sleep_timer == 0:
+                self._turn_off()
+            return prefix
+        elif op == 'bb':
+            cell = self.voltages.index(max(self.voltages))
+            return f'{prefix} {self._bleed(cell)}'
+        elif op[0] == 'b' and op[1:].isdigit():
+            return f'{prefix} {self._bleed(int(op[1:]))}'
+        return None
+
+
+def dispatch(batteries, line):
+    """Apply one command line to a bus of batteries.
+    @param batteries -- the SimulatedBattery objects on the bus.
+    @param line -- the command without line ending (e.g. '#01q0').
+    @return -- the reply lines without terminators, in the order they go on the wire.
+    """
+    header, op, arg = line[1:3], line[3:5], line[5:].strip()
+    if header == '00':
+        targets = batteries  # Broadcast, or a lone battery at the default address.
+    else:
+        targets = [b for b in batteries if b.hex_address == header.lower()]
+    replies = []
+    for battery in targets:
+        reply = battery.handle(header, op, arg)
+        if reply is not None:
+            replies.append(reply)
+    if op in ('?0', '?8') and len(replies) > 1:
+        replies = [''.join(replies)]  # Several batteries answering at once collide.
+    return replies
+
+
+class BatterySimulator():
+    def __init__(self, batteries=None, latency=0.02, speed=1.0, wire_time=True):
+        """A bus of simulated batteries behind a pseudo-terminal.
+        @param batteries -- a list of SimulatedBattery. Defaults to one battery at address 0.
+        @param latency -- seconds each battery takes before it starts replying.
+        @param speed -- model seconds that elapse per wall clock second. The watchdog and
+            bleed timers are model time too, so a client that paces itself in wall clock
+            seconds (e.g. balance.py) needs the default of 1.
+        @param wire_time -- if True, pace replies at 9600 baud.
+        """
+        if batteries is None:
+            batteries = [SimulatedBattery()]
+        self.batteries = batteries
+        self.latency = latency
+        self.speed = speed
+        self.wire_time = wire_time
+        self.commands = 0
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._start = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, et, ev, etb):
+        self.stop()
+
+    @property
+    def port(self):
+        return os.ttyname(self._slave)
+
+    def model_time(self):
+        return (time.monotonic() - self._start) * self.speed
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self._start = time.monotonic()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = self._thread = None
+
+    def step(self):
+        """Advance every battery to the current model time."""
+        with self._lock:
+            now = self.model_time()
+            for battery in self.batteries:
+                battery.step(now)
+
+    def _serve(self):
+        pending = b''
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            self.step()
+            if not readable:
+                continue
+            try:
+                pending += os.read(self._master, 1024)
+            except OSError:
+                continue
+            *lines, pending = pending.replace(b'\r', b'\n').split(b'\n')
+            for line in lines:
+                if line.strip():
+                    self._dispatch(line.decode(errors='replace').strip())
+
+    def _dispatch(self, line):
+        if not line.startswith('#') or len(line) < 5:
+            return
+        self.commands += 1
+        with self._lock:
+            replies = dispatch(self.batteries, line)
+        for reply in replies:
+            self._send(reply + '\r\n')
+
+    def _send(self, reply):
+        if self.latency:
+            time.sleep(self.latency)
+        data = reply.encode()
+        if not self.wire_time:
+            os.write(self._master, data)
+            return
+        for i in range(0, len(data), CHUNK):  # Stream the reply at 9600 baud.
+            chunk = data[i:i + CHUNK]
+            time.sleep(len(chunk) * CHAR_TIME)
+            os.write(self._master, chunk)
+
+
+class SimulatedSerial():
+    def __init__(self, batteries=None, clock=time, latency=0.0, wire_time=True, timeout=0.005):
+        """An in-process serial port served by simulated batteries.
+        Model time is the clock's time, so with a transcript.VirtualClock a
+        balancing run of hours completes as fast as the code can execute.
+        Pass it to SBM as the transport, with the same clock.
+        @param batteries -- a list of SimulatedBattery. Defaults to one battery at address 0.
+        @param clock -- the source of monotonic() and sleep().
+        @param latency -- seconds each battery takes before it starts replying.
+        @param wire_time -- if True, each part of a reply is not readable until it would have
+            crossed the line at 9600 baud.
+        @param timeout -- seconds an empty read blocks for, as the serial read timeout.
+        """
+        self.batteries = batteries if batteries is not None else [SimulatedBattery()]
+        self.clock = clock
+        self.latency = latency
+        self.wire_time = wire_time
+        self.timeout = timeout
+        self.port = 'sim://'
+        self.is_open = True
+        self.commands = 0
+        self._partial = b''
+        self._queued = []  # (due time, reply bytes) not yet readable.
+        self._pending = bytearray()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _deliver(self):
+        now = self.clock.monotonic()
+        while self._queued and self._queued[0][0] <= now:
+            self._pending += self._queued.pop(0)[1]
+
+    @property
+    def in_waiting(self):
+        self._deliver()
+        return len(self._pending)
+
+    def write(self, data):
+        now = self.clock.monotonic()
+        for battery in self.batteries:
+            battery.step(now)
+        *lines, self._partial = (self._partial + bytes(data)).replace(b'\r', b'\n').split(b'\n')
+        due = now
+        for line in lines:
+            line = line.decode(errors='replace').strip()
+            if not line.startswith('#') or len(line) < 5:
+                continue
+            self.commands += 1
+            for reply in dispatch(self.batteries, line):
+                reply = (reply + '\r\n').encode()
+                due = max(due, now + self.latency)
+                if not self.wire_time:
+                    self._queued.append((due, reply))
+                    continue
+                for i in range(0, len(reply), CHUNK):  # Streamed as it crosses the line, like the pty.
+                    chunk = reply[i:i + CHUNK]
+                    due += len(chunk) * CHAR_TIME
+                    self._queued.append((due, chunk))
+        return len(data)
+
+    def read(self, size=1):
+        self._deliver()
+        if not self._pending:
+            wait = self.timeout
+            if self._queued:
+                wait = min(wait, self._queued[0][0] - self.clock.monotonic())
+            self.clock.sleep(wait)
+            self._deliver()
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self._queued.clear()
+        self._pending.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate Bluefin 1.5 kWh batteries on a pseudo-terminal.')
+    parser.add_argument('--addresses', default='0', help='Comma separated battery addresses.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Reply latency in seconds.')
+    parser.add_argument('--speed', type=float, default=1.0, help='Model seconds per wall clock second.')
+    parser.add_argument('--spread', type=float, default=0.15, help='Maximum cell voltage spread in volts.')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for cell voltages.')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    batteries = []
+    for address in args.addresses.split(','):
+        voltages = [round(3.6 + random.uniform(0, args.spread), 3) for _ in range(8)]
+        batteries.append(SimulatedBattery(address=int(address), voltages=voltages))
+    with BatterySimulator(batteries, latency=args.latency, speed=args.speed) as sim:
+        print(f'Simulating {len(batteries)} battery(s) on {sim.port}. Press Ctrl+C to stop.')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Raw serial transcripts for offline replay.
+
+A transcript is every byte written to and read from a battery port, with
+monotonic timestamps. Files start with a 16 byte header followed by one
+event per write or non-empty read:
+
+    seconds since the first event (float64), direction (b'w' or b'r'), length (uint32), data
+
+TranscriptWriter wraps an open serial port and records its traffic.
+ReplaySerial stands in for the port and plays a transcript back to SBM on
+a VirtualClock, either in real time or as fast as possible.
+"""
+
+import os
+import struct
+import time
+from datetime import datetime, timezone
+
+MAGIC = b'BFTRN1'
+HEADER = struct.Struct('<6s2sd')  # Magic, reserved, wall clock start time (Unix epoch).
+EVENT = struct.Struct('<dcI')
+WRITE = b'w'
+READ = b'r'
+
+
+def default_path():
+    """Return a new transcript file path in ~/bluefin/transcripts."""
+    save_dir = os.path.join(os.path.expanduser('~'), 'bluefin', 'transcripts')
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    return os.path.join(save_dir, f'bluefin1.5kwh_{stamp}.bft')
+
+
+def read_transcript(path):
+    """Load a transcript.
+    @param path -- the file written by TranscriptWriter.
+    @return -- a list of (seconds, direction, data) events. A partially written last event is ignored.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a serial transcript.')
+    events = []
+    offset = HEADER.size
+    while offset + EVENT.size <= len(data):
+        seconds, direction, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        if offset + length > len(data):
+            break
+        events.append((seconds, direction, data[offset:offset + length]))
+        offset += length
+    return events
+
+
+class TranscriptWriter():
+    def __init__(self, transport, path):
+        """Record the traffic of an open serial port.
+        Every other attribute is passed through to the wrapped port.
+        @param transport -- the open serial.Serial (or compatible) port.
+        @param path -- the transcript file to create.
+        """
+        self.transport = transport
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, b'\0\0', time.time()))
+        self._start = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def _event(self, direction, data):
+        self._file.write(EVENT.pack(time.monotonic() - self._start, direction, len(data)))
+        self._file.write(data)
+
+    def write(self, data):
+        self._event(WRITE, bytes(data))
+        self._file.flush()  # One flush per command keeps the transcript intact if the run crashes.
+        return self.transport.write(data)
+
+    def read(self, size=1):
+        data = self.transport.read(size)
+        if data:
+            self._event(READ, data)
+        return data
+
+    def finish(self):
+        """Close the transcript file, leaving the port open (e.g. when it is shared)."""
+        if not self._file.closed:
+            self._file.close()
+
+    def close(self):
+        self.finish()
+        self.transport.close()
+
+
+class VirtualClock():
+    def __init__(self, speed=None):
+        """A monotonic clock that only advances when slept on.
+        Pass it to SBM (and main) in place of the time module.
+        @param speed -- virtual seconds per wall clock second while sleeping,
+            e.g. 1 for real time. None to never actually sleep.
+        """
+        self.speed = speed
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        seconds = max(0.0, seconds)
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        self.now += seconds
+
+
+class ReplayError(ValueError):
+    """The replayed code wrote something other than what the transcript recorded."""
+
+
+class ReplaySerial():
+    def __init__(self, path, clock=None, strict=False, timeout=0.005):
+        """A serial port that plays back a transcript.
+        Each recorded reply is delivered at the same delay after its command
+        as in the field, measured on the clock, so the reading code sees the
+        recorded timing even when it paces itself differently.
+        @param path -- the transcript file to play.
+        @param clock -- the VirtualClock shared with SBM. Defaults to an unpaced one.
+        @param strict -- if True, raise ReplayError when a written command differs
+            from the recorded one. Otherwise it is counted in mismatches.
+        @param timeout -- seconds an empty read blocks for, as the serial read timeout.
+        """
+        self.port = path
+        self.clock = clock if clock is not None else VirtualClock()
+        self.strict = strict
+        self.timeout = timeout
+        self.events = read_transcript(path)
+        self.mismatches = 0
+        self.truncated = False  # Set by replay() if the recording ran out before the run did.
+        self.is_open = True
+        self._next = 0  # Index of the next unplayed event.
+        self._offset = 0.0  # Clock time minus transcript time of the last command.
+        self._pending = bytearray()  # Delivered but unread reply bytes.
+
+    @property
+    def finished(self):
+        return self._next >= len(self.events) and not self._pending
+
+    def _deliver(self):
+        """Move every recorded reply that is due on the clock into the input buffer."""
+        events = self.events
+        while self._next < len(events):
+            seconds, direction, data = events[self._next]
+            if direction != READ or seconds + self._offset > self.clock.now:
+                break
+            self._pending += data
+            self._next += 1
+
+    def _due(self):
+        """Return the clock time the next recorded reply arrives, or None."""
+        if self._next < len(self.events) and self.events[self._next][1] == READ:
+            return self.events[self._next][0] + self._offset
+        return None
+
+    @property
+    def in_waiting(self):
+        self._deliver()
+        return len(self._pending)
+
+    def write(self, data):
+        data = bytes(data)
+        events = self.events
+        while self._next < len(events) and events[self._next][1] == READ:
+            self._next += 1  # Replies the code never waited for.
+        if self._next < len(events):
+            seconds, _, recorded = events[self._next]
+            self._next += 1
+            self._offset = self.clock.now - seconds
+            if recorded != data:
+                self.mismatches += 1
+                if self.strict:
+                    raise ReplayError(f'Wrote {data!r} where the transcript has {recorded!r}.')
+        return len(data)
+
+    def read(self, size=1):
+        self._deliver()
+        if not self._pending:
+            due = self._due()
+            wait = self.timeout if due is None else min(self.timeout, due - self.clock.now)
+            self.clock.sleep(wait)
+            self._deliver()
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self._deliver()
+        self._pending.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
@@ -22,4 +22,8 @@ setuptools.setup(
     install_requires=[
         'pyserial'  #https://pypi.org/project/pyserial/
         ],
+    extras_require={
+        'analysis': ['numpy'],  # scripts/log_analysis.py
+        'test': ['pytest'],  # tests/
+        },
 )
\ No newline at end of file
@@ -0,0 +1,47 @@
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+import balance
+from simulator import SimulatedBattery, SimulatedSerial
+from transcript import VirtualClock
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """Keep logs, telemetry and caches out of the real home directory."""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    logger = logging.getLogger('bluefin')
+    handler = logging.NullHandler()  # Keeps main() from opening the console and log file handlers.
+    logger.addHandler(handler)
+    yield tmp_path
+    logger.removeHandler(handler)
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+
+@pytest.fixture
+def wire(clock):
+    """Return a function that puts simulated batteries on a bus served on the virtual clock."""
+    def connect(*batteries, transport=SimulatedSerial):
+        batteries = list(batteries) or [SimulatedBattery(address=1, sn=1001)]
+        return transport(batteries, clock=clock, timeout=balance.POLL_INTERVAL)
+    return connect
+
+
+@pytest.fixture
+def bus(clock, wire):
+    """Return a function that connects an SBM to simulated batteries on a virtual clock."""
+    def connect(*batteries, transport=SimulatedSerial, **options):
+        serial = wire(*batteries, transport=transport)
+        options.setdefault('address', serial.batteries[0].address)
+        sbm = balance.SBM(serial.port, transport=serial, clock=clock, **options)
+        return sbm, serial
+    return connect
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from async_sbm import AsyncSBM, poll_ports
+from balance import Q0_FIELDS, parse_summary
+from bench_parser import Q0_REPLY
+from simulator import BatterySimulator, SimulatedBattery
+
+
+@pytest.fixture
+def simulator():
+    batteries = [SimulatedBattery(address=a, sn=1000 + a) for a in (1, 2)]
+    with BatterySimulator(batteries, latency=0.0, wire_time=False) as sim:
+        yield sim
+
+
+def test_getters(simulator):
+    async def read():
+        async with AsyncSBM(simulator.port, address=2) as sbm:
+            return (await sbm.get_battery_sn(), await sbm.get_voltage(), await sbm.water_detected(),
+                    await sbm.get_mode(), await sbm.get_cell_voltages())
+    sn, voltage, water, mode, voltages = asyncio.run(read())
+    assert sn == 1002
+    assert voltage == pytest.approx(sum(voltages), abs=0.001)
+    assert water is False
+    assert mode == 's'
+
+
+def test_poll_ports(simulator):
+    results = asyncio.run(poll_ports([simulator.port, '/dev/does-not-exist'], address=1))
+    assert results[simulator.port].summary.state == 'f'
+    assert isinstance(results['/dev/does-not-exist'], ConnectionError)
+
+
+def test_read_frame_keeps_a_frame_split_across_reads():
+    sbm = AsyncSBM('unused', address=1, timeout=0.05)
+    sbm._reader = True  # Wait on the data event instead of polling the unopened port.
+    sbm._frames.feed(b'\x00$01b3 1\r\n' + Q0_REPLY[:20])
+    sbm._discard_stale()  # The stale bleed reply goes; the q0 reply still arriving stays.
+    sbm._frames.feed(Q0_REPLY[20:])
+    frame = asyncio.run(sbm._read_frame('$01q0', Q0_FIELDS))
+    assert parse_summary(frame) == parse_summary(Q0_REPLY)
+    assert sbm._frames.dropped == len(b'\x00$01b3 1\r\n')
+    assert asyncio.run(sbm._read_frame('$01q0', Q0_FIELDS)) is None
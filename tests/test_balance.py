@@ -0,0 +1,190 @@
+import logging
+
+import pytest
+
+import balance
+from interlock import InterlockError
+from simulator import SimulatedBattery, SimulatedSerial
+
+logger = logging.getLogger('bluefin')
+
+
+class LossySerial(SimulatedSerial):
+    """A simulated bus that loses the next reply to each command in drop."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drop = set()
+
+    def write(self, data):
+        queued = len(self._queued)
+        count = super().write(data)
+        command = bytes(data).strip().decode()
+        if command in self.drop and len(self._queued) > queued:
+            self.drop.discard(command)
+            del self._queued[queued:]
+        return count
+
+
+@pytest.mark.parametrize('voltages', [[3.70] * 7 + [3.80], [3.60] + [3.70] * 7,
+                                      [round(3.60 + 0.02 * i, 3) for i in range(8)]])
+def test_main_balances(clock, voltages):
+    battery = SimulatedBattery(address=0, voltages=voltages, sn=1000)
+    transport = SimulatedSerial([battery], clock=clock, timeout=balance.POLL_INTERVAL)
+    with pytest.raises(SystemExit):
+        balance.main(transport.port, telemetry=False, transport=transport, clock=clock)
+    assert max(battery.voltages) - min(battery.voltages) <= balance.delta + 0.002
+    assert battery.error == '-'
+    assert not battery.bleeding
+
+
+def test_main_stops_on_over_temperature(clock):
+    battery = SimulatedBattery(address=0, voltages=[3.70] * 7 + [3.80], temperature=45, sn=1000)
+    transport = SimulatedSerial([battery], clock=clock, timeout=balance.POLL_INTERVAL)
+    with pytest.raises((InterlockError, TimeoutError)):
+        balance.main(transport.port, telemetry=False, transport=transport, clock=clock)
+    assert not battery.bleeding
+
+
+def test_balance_cells(bus):
+    battery = SimulatedBattery(address=1, voltages=[3.70] * 6 + [3.75, 3.80])
+    sbm, _ = bus(battery)
+    assert sbm.balance_cells([6, 7], battery.voltages, logger) == [6, 7]
+    assert set(battery.bleeding) == {6, 7}
+
+
+def test_balance_cells_resends_a_lost_bleed_reply(bus):
+    battery = SimulatedBattery(address=1, voltages=[3.70] * 7 + [3.80])
+    sbm, serial = bus(battery, transport=LossySerial)
+    serial.drop.add('#01b7')
+    assert sbm.balance_cells([7], battery.voltages, logger) == [7]
+    assert serial.drop == set()
+    assert 7 in battery.bleeding
+
+
+def test_balance_cells_clears_a_watchdog_timeout(bus):
+    battery = SimulatedBattery(address=1, voltages=[3.70] * 7 + [3.80])
+    battery.error = 'm'
+    sbm, _ = bus(battery)
+    assert sbm.balance_cells([7], battery.voltages, logger) == [7]
+    assert battery.error == '-'
+
+
+class WatchdogSerial(SimulatedSerial):
+    """A simulated bus whose battery's watchdog fires right after the command in trigger."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trigger = None
+
+    def write(self, data):
+        count = super().write(data)
+        if bytes(data).strip().decode() == self.trigger:
+            self.trigger = None
+            for battery in self.batteries:
+                battery.bleeding.clear()
+                battery.error = 'm'
+        return count
+
+
+def test_balance_cells_restarts_bleeds_after_a_mid_batch_watchdog(bus):
+    battery = SimulatedBattery(address=1, voltages=[3.70] * 5 + [3.75, 3.78, 3.80], bleed_duration=1000)
+    sbm, serial = bus(battery, transport=WatchdogSerial)
+    serial.trigger = '#01b5'
+    assert sbm.balance_cells([5, 6, 7], battery.voltages, logger) == [5, 6, 7]
+    assert battery.error == '-'
+    assert set(battery.bleeding) == {5, 6, 7}
+
+
+def test_keepalive_holds_off_the_watchdog(bus):
+    battery = SimulatedBattery(address=1, bleed_duration=1000, watchdog=30)
+    sbm, _ = bus(battery)
+    assert sbm.balance_cell(3) is True
+    sbm.idle(300)
+    assert battery.error == '-'
+    assert 3 in battery.bleeding
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_transaction(bus, pipeline):
+    batteries = [SimulatedBattery(address=a, sn=1000 + a) for a in (1, 2)]
+    sbm, _ = bus(*batteries, pipeline=pipeline)
+    batch = sbm.transaction()
+    first = batch.add('#01q0', balance.Q0_FIELDS)
+    second = batch.add('#02z0', balance.Z0_FIELDS)
+    missing = batch.add('#03q0', balance.Q0_FIELDS)
+    replies = batch.send(timeout=0.2)
+    assert balance.parse_summary(replies[first]).voltage == pytest.approx(sum(batteries[0].voltages), abs=0.001)
+    assert balance.parse_version_summary(replies[second]).sn == 1002
+    assert replies[missing] is None
+
+
+
+def test_pipelined_transaction_pairs_repeats_and_bounds_silence(bus, clock):
+    battery = SimulatedBattery(address=1, sn=1001)
+    sbm, _ = bus(battery, pipeline=True)
+    batch = sbm.transaction()
+    batch.add('#01q1', balance.Q1_FIELDS)
+    batch.add('#02q0', balance.Q0_FIELDS)
+    batch.add('#03q0', balance.Q0_FIELDS)
+    batch.add('#01q1', balance.Q1_FIELDS)
+    start = clock.monotonic()
+    replies = batch.send(timeout=0.2)
+    assert replies[0] is not None and replies[3] is not None
+    assert replies[1] is None and replies[2] is None
+    assert clock.monotonic() - start < 0.5  # One quiet timeout for the batch, not one per missing reply.
+
+
+def test_query_returns_when_the_frame_completes(bus, clock):
+    battery = SimulatedBattery(address=1)
+    sbm, serial = bus(battery)
+    serial.latency = 0.02
+    sbm.get_summary()
+    assert clock.now < 0.1  # The reply is read as it completes, not after a fixed 0.5 s sleep.
+
+
+def test_query_waits_for_a_slow_reply(bus, clock):
+    sbm, serial = bus(SimulatedBattery(address=1), timeout=1)
+    serial.latency = 0.6
+    assert len(sbm.get_cell_voltages()) == 8
+    assert 0.6 <= clock.now < 0.7
+
+
+def test_query_without_a_reply_times_out(bus, clock):
+    sbm, serial = bus(SimulatedBattery(address=1), timeout=1)
+    serial.batteries = []
+    with pytest.raises(TimeoutError):
+        sbm.get_summary()
+    assert clock.now == pytest.approx(sbm.timeout * (balance.RETRIES + 1), abs=0.05)
+
+
+def test_getters_share_one_summary_read(bus, clock):
+    sbm, serial = bus(SimulatedBattery(address=1), max_age=2)
+    sbm.get_voltage()
+    sent = serial.commands
+    sbm.get_current()
+    sbm.get_max_temperature()
+    sbm.get_min_max_cell_voltage()
+    assert serial.commands == sent
+    clock.sleep(3)
+    sbm.get_power()
+    assert serial.commands == sent + 1
+
+
+def test_snapshot_cache(bus, clock):
+    battery = SimulatedBattery(address=1)
+    sbm, serial = bus(battery)
+    first = sbm.snapshot()
+    sent = serial.commands
+    clock.sleep(1)
+    cached = sbm.snapshot(max_age=2)
+    assert (cached.summary, cached.voltages) == (first.summary, first.voltages)
+    assert serial.commands == sent
+    clock.sleep(2)
+    before = clock.now
+    assert sbm.snapshot(max_age=2).timestamp == before
+    assert serial.commands == sent + 2
+    sent = serial.commands
+    sbm.off()
+    sbm.snapshot(max_age=2)
+    assert serial.commands == sent + 3  # bf invalidates the cache, so q0 and q1 are read again.
@@ -0,0 +1,27 @@
+import benchmark
+
+
+def test_compare_flags_regressions_by_direction():
+    baseline = {'commands': {'q0': {'wall_us_median': 100.0, 'wall_us_p95': 100.0}},
+                'parsers': {'battery_summary': {'per_second': 1000.0}},
+                'balance': {'one_high': {'simulated_seconds': 600.0}}}
+    results = {'commands': {'q0': {'wall_us_median': 130.0, 'wall_us_p95': 500.0}},
+               'parsers': {'battery_summary': {'per_second': 1500.0}},
+               'balance': {'one_high': {'simulated_seconds': 500.0}}}
+    rows = {row[:3]: row[-1] for row in benchmark.compare(results, baseline, threshold=0.2)}
+    assert rows == {('commands', 'q0', 'wall_us_median'): True,  # Slower, and wall_us_p95 is not tracked.
+                    ('parsers', 'battery_summary', 'per_second'): False,
+                    ('balance', 'one_high', 'simulated_seconds'): False}
+    assert not any(row[-1] for row in benchmark.compare(baseline, baseline))
+
+
+def test_bench_commands():
+    results = benchmark.bench_commands(iterations=5)
+    assert set(results) == {'q0', 'q1', 'z0', 'bN', 'bf'}
+    assert results['q1']['bus_ms_mean'] > results['bf']['bus_ms_mean'] > 0
+
+
+def test_bench_balance():
+    results = benchmark.bench_balance({'one_high': benchmark.PROFILES['one_high']})
+    assert results['one_high']['outcome'] == 'balanced'
+    assert results['one_high']['simulated_seconds'] > 0
@@ -0,0 +1,89 @@
+import pytest
+
+import balance
+import connections
+from connections import ConnectionPool, FrameReassembler
+
+URL = 'loop://'
+
+
+def test_frame_split_across_feeds():
+    frames = FrameReassembler()
+    frames.feed(b'$01q1 3.70')
+    assert list(frames.frames()) == []
+    frames.feed(b'1 3.702\r\n$01b')
+    assert list(frames.frames()) == [b'$01q1 3.701 3.702\r\n']
+    assert len(frames) == 4
+    frames.feed(b'3 1\r\n')
+    assert list(frames.frames()) == [b'$01b3 1\r\n']
+    assert frames.dropped == 0
+
+
+def test_noise_between_frames_is_dropped():
+    frames = FrameReassembler()
+    frames.feed(b'\x00\xff$01bf\r\nxx$01b2 1\n')
+    assert list(frames.frames()) == [b'$01bf\r\n', b'$01b2 1\n']
+    assert frames.dropped == 4
+
+
+def test_frame_broken_by_the_next():
+    frames = FrameReassembler()
+    frames.feed(b'$01q0 b- 29.6$01b3 1\r\n')
+    assert list(frames.frames()) == [b'$01b3 1\r\n']
+    assert frames.dropped == len(b'$01q0 b- 29.6')
+
+
+def test_take_skips_other_frames():
+    frames = FrameReassembler()
+    frames.feed(b'$01b3 1\r\n$01q0 short\r\n$02q0 a b c\r\n$01q0 a b c\r\n$01b4 1\r\n')
+    assert frames.take(b'$01q0', 4) == b'$01q0 a b c\r\n'
+    assert frames.dropped == len(b'$01b3 1\r\n$01q0 short\r\n$02q0 a b c\r\n')
+    assert frames.take(b'$01b4', 2) == b'$01b4 1\r\n'
+    assert frames.take(b'$01b5', 2) is None
+
+
+def test_pending_bytes_are_bounded():
+    frames = FrameReassembler(max_pending=16)
+    frames.feed(b'$01q0 ' + b'9' * 30)
+    assert len(frames) == 16
+    assert frames.dropped == 20
+    frames.clear()
+    assert len(frames) == 0
+    assert frames.dropped == 36
+
+
+def test_pool_shares_one_port_per_url():
+    pool = ConnectionPool(linger=0)
+    with balance.SBM(URL, address=1, pool=pool) as first, balance.SBM(URL, address=2, pool=pool) as second:
+        assert first.rs485 is second.rs485
+        assert first.lock is second.lock
+        assert first._frames is second._frames
+        assert pool.ports() == {URL: 2}
+    assert not first.rs485.is_open
+    assert pool.ports() == {}
+
+
+def test_unused_port_lingers(clock, monkeypatch):
+    monkeypatch.setattr(connections, 'time', clock)
+    pool = ConnectionPool(linger=5)
+    shared = pool.acquire(URL)
+    pool.release(shared)
+    assert pool.ports() == {URL: 0}
+    clock.sleep(4)
+    assert pool.acquire(URL) is shared  # Reused within the linger time.
+    pool.release(shared)
+    clock.sleep(5)
+    again = pool.acquire(URL)
+    assert again is not shared
+    assert not shared.serial.is_open
+    pool.close()
+    assert not again.serial.is_open
+    assert pool.ports() == {}
+
+
+def test_failed_connect_releases_the_port():
+    pool = ConnectionPool(linger=None)
+    with pytest.raises(ConnectionError):
+        balance.SBM(URL, address='not an address', pool=pool)
+    assert pool.ports() == {URL: 0}
+    pool.close()
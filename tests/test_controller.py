@@ -0,0 +1,58 @@
+import logging
+
+import pytest
+
+from controller import BalanceController
+from simulator import SimulatedBattery
+
+logger = logging.getLogger('bluefin')
+
+
+def test_rates_and_predictions():
+    controller = BalanceController(delta=0.030, smoothing=0.5)
+    controller.bleeding = {7}
+    controller.update([0, 0, 0, 0, 0, 0, 0, 0.100], timestamp=0)
+    controller.update([0, 0, 0, 0, 0, 0, 0, 0.090], timestamp=10)
+    assert controller.rates[7] == pytest.approx(0.001)
+    assert controller.predict([0, 0, 0, 0, 0, 0, 0.050, 0.090]) == {6: None, 7: pytest.approx(60)}
+    controller.update([0, 0, 0, 0, 0, 0, 0, 0.070], timestamp=20)
+    assert controller.rates[7] == pytest.approx(0.0015)  # Smoothed with the previous estimate.
+    controller.update([0, 0, 0, 0, 0, 0, 0, 0.060], timestamp=30, bleeding_confirmed=False)
+    assert controller.rates[7] == pytest.approx(0.0015)
+
+
+def test_next_interval():
+    controller = BalanceController(min_interval=5, max_interval=60, learn_interval=15)
+    assert controller.next_interval({}) == 5
+    assert controller.next_interval({7: None}) == 15
+    assert controller.next_interval({6: 8, 7: None}) == 8
+    assert controller.next_interval({7: 600}) == 60
+    assert controller.next_interval({7: 1}) == 5
+
+
+def test_step_learns_the_bleed_rate(bus, clock):
+    battery = SimulatedBattery(address=1, voltages=[3.60] * 7 + [3.70], bleed_rate=0.0005,
+                               heat_per_cell=0.0, bleed_duration=1000)
+    sbm, _ = bus(battery)
+    controller = BalanceController(logger=logger)
+    interval = controller.step(sbm, sbm.get_summary(), sbm.get_cell_voltages())
+    assert interval == controller.learn_interval
+    assert controller.bleeding == {7}
+    assert controller.time_to_balance is None
+    sbm.idle(interval)
+    interval = controller.step(sbm, sbm.get_summary(), sbm.get_cell_voltages())
+    assert controller.rates[7] == pytest.approx(0.0005, rel=0.2)
+    assert controller.time_to_balance == pytest.approx(125, rel=0.2)  # (0.0925 V - 0.030 V) / 0.5 mV/s.
+    assert interval == controller.max_interval
+
+
+def test_step_stops_a_cell_that_reached_the_window(bus):
+    battery = SimulatedBattery(address=1, voltages=[3.60] * 6 + [3.62, 3.70], bleed_duration=1000)
+    sbm, _ = bus(battery)
+    controller = BalanceController(logger=logger)
+    controller.bleeding = {6, 7}
+    battery.bleeding = {6: 1000, 7: 1000}
+    battery.state = 'b'
+    controller.step(sbm, sbm.get_summary(), sbm.get_cell_voltages())
+    assert controller.bleeding == {7}
+    assert set(battery.bleeding) == {7}
@@ -0,0 +1,71 @@
+import logging
+
+import balance
+from fleet import ASSESS, BLEED, FAULT, OFF, VERIFY, Bus, Fleet, Pack
+from simulator import SimulatedBattery
+
+logger = logging.getLogger('bluefin')
+
+
+def connect(wire, clock, *batteries):
+    transport = wire(*batteries)
+    bus = Bus(transport.port, transport=transport, clock=clock)
+    bus.sbm.address = bus.sbm._format_address(batteries[0].address)
+    return bus, transport
+
+
+def test_pack_balances(wire, clock):
+    battery = SimulatedBattery(address=1, voltages=[3.70] * 7 + [3.80], sn=1001)
+    bus, _ = connect(wire, clock, battery)
+    pack = Pack(bus, 1, bus.sbm.get_version_summary(), logger)
+    states = []
+    while True:
+        wait = pack.step()
+        states.append(pack.state)
+        if wait is None:
+            break
+        bus.sbm.idle(wait)
+    assert pack.state == OFF
+    assert BLEED in states or VERIFY in states
+    assert pack.spread <= balance.delta
+    assert not bus.bleeding
+
+
+def test_faulted_pack_is_not_kept_alive(wire, clock):
+    battery = SimulatedBattery(address=1, voltages=[3.70] * 7 + [3.80], bleed_duration=1000)
+    bus, transport = connect(wire, clock, battery)
+    pack = Pack(bus, 1, bus.sbm.get_version_summary(), logger, max_errors=2)
+    assert bus.sbm.balance_cell(7) is True
+    pack.state = VERIFY
+    transport.batteries = []  # The battery stops answering, but keeps bleeding.
+    assert pack.step() is not None
+    assert pack.step() is None
+    assert pack.state == FAULT
+    assert not bus.bleeding
+    sent = transport.commands
+    clock.sleep(balance.KEEPALIVE * 2)
+    bus.keepalive()
+    assert transport.commands == sent
+
+
+def test_faulted_pack_is_turned_off(wire, clock):
+    battery = SimulatedBattery(address=1, voltages=[3.70] * 7 + [3.80], bleed_duration=1000)
+    bus, _ = connect(wire, clock, battery)
+    pack = Pack(bus, 1, bus.sbm.get_version_summary(), logger)
+    assert bus.sbm.balance_cell(7) is True
+    pack._finish(FAULT, 'unexpected error')
+    assert not battery.bleeding
+    assert battery.state == 'f'
+    assert not bus.bleeding
+
+
+def test_fleet_discovers_batteries(wire, clock):
+    batteries = [SimulatedBattery(address=a, sn=1000 + a) for a in (1, 3)]
+    bus, _ = connect(wire, clock, *batteries)
+    fleet = Fleet(ports=[], logger=logger)
+    fleet._discover = lambda port: (bus, bus.sbm.scan(1, 4))
+    fleet.ports = [bus.port]
+    packs = fleet.discover()
+    assert sorted((p.address, p.sn) for p in packs) == [(1, 1001), (3, 1003)]
+    assert all(p.state != ASSESS for p in packs)
+    assert '2 batteries: 2 RESET' in fleet.status()
@@ -0,0 +1,40 @@
+from balance import IdentityRegistry
+from simulator import SimulatedBattery
+
+
+def test_version_summary_is_read_once(bus):
+    sbm, serial = bus(SimulatedBattery(address=1, sn=1001))
+    versum = sbm.get_version_summary()
+    sent = serial.commands
+    assert sbm.get_version_summary() is versum
+    assert serial.commands == sent
+    assert sbm.get_version_summary(refresh=True) == versum
+    assert serial.commands == sent + 1
+
+
+def test_registry_persists_version_summaries(bus, tmp_path):
+    path = str(tmp_path / 'identities.json')
+    sbm, serial = bus(SimulatedBattery(address=1, sn=1001), SimulatedBattery(address=2, sn=1002),
+                      registry=IdentityRegistry(path))
+    sbm.get_version_summary()
+    sbm.address = '02'
+    sbm.get_version_summary()
+    registry = IdentityRegistry(path)
+    assert registry.lookup(serial.port, 1).sn == 1001
+    assert registry.lookup(serial.port, 2).sn == 1002
+    assert registry.lookup(serial.port, 3) is None
+    assert registry.find(1002) == [(serial.port, 2)]
+    assert set(registry.entries()) == {(serial.port, 1), (serial.port, 2)}
+
+
+def test_revalidate(bus, tmp_path):
+    battery = SimulatedBattery(address=1, sn=1001)
+    registry = IdentityRegistry(str(tmp_path / 'identities.json'))
+    sbm, serial = bus(battery, registry=registry)
+    assert sbm.revalidate() is None
+    assert not serial.commands
+    sbm.get_version_summary()
+    assert sbm.revalidate() is True
+    battery.sn = 2002  # Another battery now answers at this address.
+    assert sbm.revalidate() is False
+    assert registry.lookup(serial.port, 1).sn == 2002
@@ -0,0 +1,110 @@
+import logging
+
+import pytest
+
+from balance import parse_summary
+from bench_parser import Q0_REPLY
+from interlock import RULE, Interlock, default_rules
+from simulator import SimulatedBattery, SimulatedSerial
+
+logger = logging.getLogger('bluefin')
+
+
+class DeafSerial(SimulatedSerial):
+    """A simulated bus on which some commands never reach the battery."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lost = {}  # Command -> times it is still to be lost.
+        self.sent = []
+
+    def write(self, data):
+        command = bytes(data).strip().decode()
+        self.sent.append(command)
+        if self.lost.get(command, 0) > 0:
+            self.lost[command] -= 1
+            return len(data)
+        return super().write(data)
+
+
+def test_evaluate():
+    interlock = Interlock()
+    summary = parse_summary(Q0_REPLY)
+    assert interlock.evaluate(summary) is None
+    rule, value = interlock.evaluate(parse_summary(Q0_REPLY.replace(b' 24.5 ', b' 42.0 ')))
+    assert (rule.name, value) == ('over temperature', 42.0)
+    rule, value = interlock.evaluate(parse_summary(Q0_REPLY.replace(b'b- ', b'bV ')))
+    assert rule.name == 'battery error'
+    assert interlock.evaluate(parse_summary(Q0_REPLY.replace(b'b- ', b'bm '))) is None  # Recovered from.
+    rule, _ = interlock.evaluate(parse_summary(Q0_REPLY.replace(b' 3.690 ', b' 2.950 ')))
+    assert rule.name == 'cell under-voltage'
+
+
+def test_evaluate_rising_uses_the_rate_window():
+    interlock = Interlock(rate_window=30)
+    before = parse_summary(Q0_REPLY)
+    after = parse_summary(Q0_REPLY.replace(b' 24.5 ', b' 24.6 '))
+    assert interlock.evaluate(after, before, elapsed=1) is None  # A 0.1 C step is not a 0.1 C/s rise.
+    hot = parse_summary(Q0_REPLY.replace(b' 24.5 ', b' 26.5 '))
+    rule, value = interlock.evaluate(hot, before, elapsed=10)
+    assert rule.name == 'temperature rise'
+    assert value == pytest.approx(0.2)
+
+
+def test_unknown_test_is_rejected():
+    with pytest.raises(ValueError):
+        Interlock([RULE('bad', 'max_temperature', 'over', 42)])
+    assert [r.name for r in default_rules()][0] == 'over temperature'
+
+
+def test_interlock_trips_on_over_temperature(bus):
+    battery = SimulatedBattery(address=1, temperature=45)
+    trips = []
+    interlock = Interlock(on_trip=trips.append)
+    sbm, _ = bus(battery, interlock=interlock)
+    sbm.get_summary()
+    trip = sbm.interlocked()
+    assert trip.rule.name == 'over temperature'
+    assert trips == [trip]
+    assert battery.state == 'f'
+    assert sbm.balance_cells([3], battery.voltages, logger) == []
+    assert not battery.bleeding
+    interlock.reset()
+    assert sbm.interlocked() is None
+
+
+def test_trip_resends_a_lost_off_command(bus):
+    battery = SimulatedBattery(address=1, bleed_duration=1000)
+    sbm, serial = bus(battery, transport=DeafSerial, interlock=Interlock())
+    assert sbm.balance_cell(3) is True
+    battery.water = 1
+    serial.lost['#01bf'] = 1
+    sbm.get_summary()
+    assert sbm.interlocked().rule.name == 'water leak'
+    assert serial.sent.count('#01bf') == 2
+    assert battery.state == 'f'
+    assert not battery.bleeding
+
+
+def test_trip_reports_a_battery_that_will_not_turn_off(bus, caplog):
+    battery = SimulatedBattery(address=1, bleed_duration=1000)
+    sbm, serial = bus(battery, transport=DeafSerial, interlock=Interlock())
+    assert sbm.balance_cell(3) is True
+    battery.temperature = 50
+    serial.lost['#01bf'] = 10
+    with caplog.at_level(logging.ERROR, logger='bluefin'):
+        sbm.get_summary()
+    assert sbm.interlocked() is not None
+    assert 'Unable to confirm' in caplog.text
+    assert 3 in battery.bleeding
+    assert not sbm._bleeding  # Keepalives stop, so the battery's own watchdog ends the bleed.
+
+
+def test_snapshot_timestamp_survives_an_interlock_trip(bus, clock):
+    battery = SimulatedBattery(address=1, temperature=45)
+    sbm, _ = bus(battery, interlock=Interlock())
+    clock.sleep(500)
+    snapshot = sbm.snapshot()
+    assert snapshot.timestamp == 500
+    assert snapshot.summary.max_temperature == 45
+    assert len(snapshot.voltages) == 8
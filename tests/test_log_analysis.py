@@ -0,0 +1,69 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from log_analysis import analyse, summarise_file
+
+
+def line(stamp, message, level='INFO'):
+    return f'{stamp}.000Z | {level:<8} | {message}\n'
+
+
+def voltages(stamp, spread):
+    return line(stamp, f'Cell Voltages: {[3.70] * 7 + [round(3.70 + spread, 3)]}', 'DEBUG')
+
+
+def write_logs(directory):
+    """Two days of one battery's logs. The second run continues into the second file."""
+    first = (line('2024-05-01T00:00:00', f"{'-' * 35} New Run {'-' * 35}", 'DEBUG')
+             + line('2024-05-01T00:00:00', 'Current Temperature: 30.0')
+             + voltages('2024-05-01T00:00:00', 0.10)
+             + line('2024-05-01T00:10:00', 'Balance Loop: 1')
+             + line('2024-05-01T00:10:00', 'Current Temperature: 43.0')
+             + voltages('2024-05-01T00:10:00', 0.05)
+             + line('2024-05-01T00:20:00', 'Battery is balanced. Turning off battery.')
+             + line('2024-05-01T12:00:00', f"{'-' * 35} New Run {'-' * 35}", 'DEBUG')
+             + voltages('2024-05-01T12:00:00', 0.08)
+             + line('2024-05-01T12:10:00', 'Balance Loop: 1')
+             + voltages('2024-05-01T12:10:00', 0.06))
+    second = (line('2024-05-02T00:00:00', 'Balance Loop: 2')
+              + voltages('2024-05-02T00:00:00', 0.02)
+              + line('2024-05-02T00:10:00', 'Battery is balanced. Turning off battery.'))
+    with gzip.open(directory / 'bluefin1.5kwh_1001_2024-05-01.txt.gz', 'wt') as f:
+        f.write(first)
+    (directory / 'bluefin1.5kwh_1001_2024-05-02.txt').write_text(second)
+    (directory / 'bluefin1.5kwh_fleet_2024-05-01.txt').write_text(first)  # Not a battery log.
+
+
+def test_chunk_size_does_not_change_the_summary(tmp_path):
+    write_logs(tmp_path)
+    path = str(tmp_path / 'bluefin1.5kwh_1001_2024-05-01.txt.gz')
+    whole = summarise_file(path)
+    for chunk_size in (1, 64, 200):
+        pieces = summarise_file(path, chunk_size=chunk_size)
+        for name, column in whole.items():
+            np.testing.assert_array_equal(pieces[name], column)
+    assert list(whole['loops']) == [1, 1]
+    assert list(whole['continued']) == [False, False]
+    assert list(whole['excursions']) == [1, 0]
+
+
+def test_continued_run_is_flagged(tmp_path):
+    write_logs(tmp_path)
+    runs = summarise_file(str(tmp_path / 'bluefin1.5kwh_1001_2024-05-02.txt'))
+    assert list(runs['continued']) == [True]
+    assert runs['spread_end'][0] == pytest.approx(0.02)
+
+
+def test_analyse_merges_runs_across_files(tmp_path):
+    write_logs(tmp_path)
+    [report] = analyse([str(tmp_path)], workers=1)
+    assert report.sn == 1001
+    assert report.runs == 2
+    assert report.loops == 3
+    assert report.excursions == 1
+    assert report.max_temperature == 43.0
+    assert report.time_to_balance == pytest.approx((1200 + 43800) / 2)
+    assert report.drift_rate == pytest.approx((0.08 - 0.05) / 42000 * 86400)
+    assert report.bleed_rate == pytest.approx((0.05 / 1200 + 0.06 / 43800) * 3600 / 2)
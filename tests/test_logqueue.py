@@ -0,0 +1,59 @@
+import calendar
+import gzip
+import logging
+
+from logqueue import DailyFileHandler, queue_logger
+
+
+def record(message, date='2024-05-01'):
+    entry = logging.LogRecord('bluefin', logging.INFO, __file__, 0, message, None, None)
+    entry.created = calendar.timegm(tuple(int(x) for x in date.split('-')) + (12, 0, 0))
+    return entry
+
+
+def test_rolls_over_at_midnight(tmp_path):
+    handler = DailyFileHandler(str(tmp_path), 'bluefin1.5kwh_1001')
+    handler.handle(record('first day'))
+    handler.handle(record('second day', date='2024-05-02'))
+    handler.close()
+    with gzip.open(tmp_path / 'bluefin1.5kwh_1001_2024-05-01.txt.gz', 'rt') as f:
+        assert f.read() == 'first day\n'
+    assert (tmp_path / 'bluefin1.5kwh_1001_2024-05-02.txt').read_text() == 'second day\n'
+
+
+def test_rolls_over_by_size(tmp_path):
+    handler = DailyFileHandler(str(tmp_path), 'log', max_bytes=25, capacity=1, compress=False)
+    for i in range(5):
+        handler.handle(record(f'message {i}'))  # 10 characters a line, so two lines a file.
+    handler.close()
+    assert (tmp_path / 'log_2024-05-01.1.txt').read_text() == 'message 0\nmessage 1\n'
+    assert (tmp_path / 'log_2024-05-01.2.txt').read_text() == 'message 2\nmessage 3\n'
+    assert (tmp_path / 'log_2024-05-01.txt').read_text() == 'message 4\n'
+
+
+def test_buffers_until_capacity(tmp_path):
+    handler = DailyFileHandler(str(tmp_path), 'log', capacity=3)
+    handler.handle(record('one'))
+    handler.handle(record('two'))
+    assert (tmp_path / 'log_2024-05-01.txt').read_text() == ''
+    handler.handle(record('three'))
+    assert (tmp_path / 'log_2024-05-01.txt').read_text() == 'one\ntwo\nthree\n'
+    handler.close()
+
+
+def test_queue_logger_writes_off_thread(tmp_path):
+    logger = logging.getLogger('bluefin.test_logqueue')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = DailyFileHandler(str(tmp_path), 'log')
+    handler.setLevel(logging.INFO)
+    listener = queue_logger(logger, [handler])
+    try:
+        logger.debug('hidden')
+        logger.info('shown')
+    finally:
+        listener.stop()
+        handler.close()
+        logger.handlers.clear()
+    [path] = tmp_path.glob('log_*.txt')
+    assert path.read_text() == 'shown\n'
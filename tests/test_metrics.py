@@ -0,0 +1,64 @@
+import pytest
+
+from metrics import Metrics, TextfileExporter, command_type
+from simulator import SimulatedBattery
+
+
+def test_command_type():
+    assert command_type('#01b3') == 'bN'
+    assert command_type('#01q0') == 'q0'
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.observe('port', 'q0', 0.05)
+    metrics.observe('port', 'q0', 0.5)
+    metrics.observe('port', 'q0', 2.0)
+    latency = metrics.snapshot()['latency'][('port', 'q0')]
+    assert latency['count'] == 3
+    assert latency['buckets'] == {0.1: 1, 1.0: 2}
+    assert abs(latency['sum'] - 2.55) < 1e-9
+
+
+def test_sbm_records_commands(bus, clock):
+    metrics = Metrics(clock=clock)
+    sbm, serial = bus(SimulatedBattery(address=1, sn=1001), metrics=metrics)
+    sbm.get_cell_voltages()
+    sbm.balance_cell(3)
+    snapshot = metrics.snapshot()
+    assert snapshot['latency'][(serial.port, 'q1')]['count'] == 1
+    assert snapshot['latency'][(serial.port, 'bN')]['count'] == 1
+    assert snapshot['counters'][('bytes_sent', serial.port, '')] > 0
+    assert snapshot['counters'][('bytes_received', serial.port, '')] > 0
+    assert snapshot['utilisation'][serial.port] > 0
+
+
+def test_silent_battery_counts_timeouts(bus, clock):
+    metrics = Metrics(clock=clock)
+    sbm, serial = bus(SimulatedBattery(address=1), address=2, metrics=metrics, timeout=0.2)
+    with pytest.raises(TimeoutError):
+        sbm.get_cell_voltages()
+    assert metrics.snapshot()['counters'][('timeouts', serial.port, 'q1')] >= 1
+
+
+def test_render(bus, clock):
+    metrics = Metrics(clock=clock)
+    sbm, serial = bus(SimulatedBattery(address=1), metrics=metrics)
+    sbm.get_cell_voltages()
+    text = metrics.render()
+    labels = f'port="{serial.port}",command="q1"'
+    assert f'bluefin_command_seconds_bucket{{{labels},le="+Inf"}} 1' in text
+    assert f'bluefin_command_seconds_count{{{labels}}} 1' in text
+    assert '# TYPE bluefin_bytes_sent_total counter' in text
+    assert f'bluefin_bus_utilisation_ratio{{port="{serial.port}"}}' in text
+    assert text.endswith('\n')
+
+
+def test_textfile_exporter_writes_on_stop(tmp_path):
+    metrics = Metrics()
+    metrics.sent('port', 10)
+    path = tmp_path / 'textfile' / 'bluefin.prom'
+    with TextfileExporter(metrics, str(path), interval=3600):
+        pass
+    assert 'bluefin_bytes_sent_total{port="port"} 10' in path.read_text()
+    assert not [p for p in path.parent.iterdir() if p.suffix == '.tmp']
@@ -0,0 +1,35 @@
+from simulator import SimulatedBattery
+
+
+def test_busy_packs_are_polled_more_often(bus):
+    hot = SimulatedBattery(address=1, temperature=40)
+    idle = SimulatedBattery(address=2)
+    sbm, _ = bus(hot, idle)
+    polls = {1: 0, 2: 0}
+    monitor = sbm.monitor([1, 2], on_sample=lambda address, snapshot: polls.__setitem__(address, polls[address] + 1))
+    monitor.run(duration=120)
+    assert polls[2] == 2  # Once at the start and once after the idle interval.
+    assert polls[1] > 4 * polls[2]
+    assert monitor.next_interval(monitor.latest[1].summary) < monitor.interval
+
+
+def test_events(bus):
+    battery = SimulatedBattery(address=1, temperature=40)
+    sbm, serial = bus(battery)
+    events = []
+    monitor = sbm.monitor(on_event=events.append)
+    monitor.run(duration=5)
+    assert [(e.kind, e.previous, e.value) for e in events] == [('temperature', None, 'warning')]
+    events.clear()
+    battery.water = 1
+    monitor.run(duration=15)
+    assert [(e.kind, e.previous, e.value) for e in events] == [('error', '-', 'W'), ('water', 0, 1)]
+    events.clear()
+    serial.batteries.remove(battery)
+    monitor.run(duration=15)
+    assert [(e.kind, e.value, e.snapshot) for e in events] == [('comms', 'lost', None)]
+    assert monitor.latest[1] is None
+    events.clear()
+    serial.batteries.append(battery)
+    monitor.run(duration=5)
+    assert ('comms', 'lost', 'ok') in [(e.kind, e.previous, e.value) for e in events]
@@ -0,0 +1,75 @@
+import pytest
+
+from balance import (BATTERY_SUMMARY, PARSE_ERROR, Q0_FIELDS, ResponseError, format_address,
+                     parse_address, parse_balance, parse_cell_voltages, parse_frame, parse_summary,
+                     parse_version_summary)
+from bench_parser import (Q0_REPLY, Q1_REPLY, Z0_REPLY, legacy_cell_voltages, legacy_summary,
+                          legacy_version_summary)
+
+
+def test_parse_summary():
+    summary = parse_summary(Q0_REPLY)
+    assert isinstance(summary, BATTERY_SUMMARY)
+    assert (summary.state, summary.error_state) == ('b', '-')
+    assert summary.voltage == 29.612
+    assert summary.current == -0.102
+    assert summary.max_temperature == 24.5
+    assert (summary.min_cell_voltage, summary.max_cell_voltage) == (3.690, 3.742)
+    assert summary.water_leak_detect == 0
+    assert summary.runtime == '1:02:03'
+    assert summary.mode == 's'
+
+
+def test_parse_summary_accepts_str():
+    assert parse_summary(Q0_REPLY.decode()) == parse_summary(Q0_REPLY)
+
+
+def test_parse_version_summary():
+    versum = parse_version_summary(Z0_REPLY)
+    assert versum.sn == 4215
+    assert versum.firmware_info == 'SBM 1.5.0'
+    assert versum.mode == 's'
+
+
+def test_parse_cell_voltages():
+    assert parse_cell_voltages(Q1_REPLY) == [3.701, 3.742, 3.690, 3.711, 3.725, 3.699, 3.702, 3.733]
+
+
+def test_parse_address_and_balance():
+    assert parse_address(b'$00?0 1a\r\n') == 26
+    assert parse_balance(b'$01b3 1\r\n') is True
+    assert parse_balance(b'$01bb 0\r\n') is False
+
+
+@pytest.mark.parametrize('reply', [Q0_REPLY, Q1_REPLY, Z0_REPLY])
+def test_parse_frame_memoryview(reply):
+    assert parse_frame(memoryview(reply)) == parse_frame(reply)
+    assert parse_frame(memoryview(b'noise' + reply)) == parse_frame(reply)
+    assert parse_frame(memoryview(bytearray(reply))) == parse_frame(reply)
+
+
+def test_parse_summary_accepts_trailing_fields():
+    summary = parse_summary(Q0_REPLY.replace(b' 0 0 0\r\n', b' 0 0 0 7 extra\r\n'))
+    assert summary == parse_summary(Q0_REPLY)
+
+
+def test_parse_frame_errors():
+    truncated = parse_frame(Q0_REPLY[:30] + b'\r\n', b'q0')
+    assert isinstance(truncated, PARSE_ERROR)
+    assert truncated.reason == f'expected at least {Q0_FIELDS - 1} fields'
+    assert isinstance(parse_frame(Q1_REPLY, b'q0'), PARSE_ERROR)
+    assert isinstance(parse_frame(b'garbage\r\n'), PARSE_ERROR)
+    with pytest.raises(ResponseError):
+        parse_summary(Q1_REPLY)
+
+
+@pytest.mark.parametrize('address, expected', [(0, '00'), (1, '01'), (10, '0a'), (250, 'fa'), (251, False)])
+def test_format_address(address, expected):
+    assert format_address(address) == expected
+
+
+def test_parsers_agree_with_the_legacy_patterns():
+    summary, legacy = parse_summary(Q0_REPLY), legacy_summary(Q0_REPLY)
+    assert (summary.state, summary.voltage, summary.runtime) == (legacy.state, legacy.voltage, legacy.runtime)
+    assert parse_version_summary(Z0_REPLY).sn == legacy_version_summary(Z0_REPLY).sn
+    assert parse_cell_voltages(Q1_REPLY) == legacy_cell_voltages(Q1_REPLY[5:])
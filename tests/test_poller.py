@@ -0,0 +1,37 @@
+from poller import BusPoller
+from simulator import SimulatedBattery
+
+
+def test_busy_batteries_are_polled_more_often(wire, clock):
+    hot = SimulatedBattery(address=1, temperature=39)
+    idle = SimulatedBattery(address=2)
+    serial = wire(hot, idle)
+    samples = []
+    with BusPoller(serial.port, [1, 2], period=10, fast_period=2, transport=serial, clock=clock,
+                   on_sample=lambda address, snapshot: samples.append(address)) as poller:
+        poller.run(duration=60)
+        assert poller.status(1).priority == 5
+        assert poller.status(2).priority == 1
+        assert poller.status(1).polls >= 4 * poller.status(2).polls
+        assert samples.count(1) == poller.status(1).polls
+        assert poller.status(2).staleness <= 10
+        assert poller.polls_per_second() > 0
+
+
+def test_silent_battery_counts_errors(wire, clock):
+    serial = wire(SimulatedBattery(address=1))
+    with BusPoller(serial.port, [1, 3], period=5, timeout=0.2, transport=serial, clock=clock) as poller:
+        poller.run(duration=20)
+        assert poller.status(1).errors == 0
+        assert poller.status(3).errors > 0
+        assert poller.status(3).polls == 0
+        assert poller.staleness()[3] is None
+
+
+def test_pinned_priority(wire, clock):
+    serial = wire(SimulatedBattery(address=1), SimulatedBattery(address=2))
+    with BusPoller(serial.port, [1, 2], period=10, transport=serial, clock=clock) as poller:
+        poller.set_priority(2, 4)
+        poller.run(duration=40)
+        assert poller.status(2).priority == 4
+        assert poller.status(2).polls > poller.status(1).polls
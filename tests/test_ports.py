@@ -0,0 +1,50 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import balance
+from simulator import BatterySimulator, SimulatedBattery
+
+
+@pytest.fixture
+def simulator():
+    with BatterySimulator([SimulatedBattery(address=0, sn=4321)], latency=0.0, wire_time=False) as sim:
+        yield sim
+
+
+def comports(*devices):
+    return lambda: [SimpleNamespace(device=device, vid=None, pid=None, serial_number=None) for device in devices]
+
+
+def test_probe_port(simulator):
+    assert balance.probe_port(simulator.port) == 4321
+    assert balance.probe_port('/dev/does-not-exist') is None
+
+
+def test_find_port_probes_and_caches(simulator, tmp_path, monkeypatch):
+    cache = str(tmp_path / 'ports.json')
+    monkeypatch.setattr(balance.serial.tools.list_ports, 'comports',
+                        comports('/dev/does-not-exist', simulator.port))
+    assert balance.find_port(cache) == simulator.port
+    with open(cache) as f:
+        assert json.load(f) == {simulator.port: 4321}
+
+
+def test_find_port_tries_the_cached_port_first(simulator, tmp_path, monkeypatch):
+    cache = str(tmp_path / 'ports.json')
+    with open(cache, 'w') as f:
+        json.dump({simulator.port: 4321}, f)
+    probed = []
+    probe = balance.probe_port
+    monkeypatch.setattr(balance, 'probe_port', lambda port, timeout: probed.append(port) or probe(port, timeout))
+    monkeypatch.setattr(balance.serial.tools.list_ports, 'comports',
+                        comports('/dev/does-not-exist', simulator.port))
+    assert balance.find_port(cache) == simulator.port
+    assert probed == [simulator.port]
+
+
+def test_find_port_without_ports(tmp_path, monkeypatch):
+    monkeypatch.setattr(balance.serial.tools.list_ports, 'comports', comports())
+    with pytest.raises(ConnectionError):
+        balance.find_port(str(tmp_path / 'ports.json'))
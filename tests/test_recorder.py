@@ -0,0 +1,60 @@
+import pytest
+
+import recorder
+from recorder import COLUMNS, TelemetryReader, TelemetryRecorder
+from simulator import SimulatedBattery
+
+
+def test_snapshots_round_trip(bus, tmp_path):
+    battery = SimulatedBattery(address=1, voltages=[3.60 + 0.01 * i for i in range(8)])
+    sbm, _ = bus(battery)
+    path = str(tmp_path / 'telemetry.bin')
+    snapshots = []
+    with TelemetryRecorder(path, rows=4) as telemetry:
+        for _ in range(10):
+            snapshot = sbm.snapshot()
+            snapshots.append(snapshot)
+            telemetry.record(snapshot)
+    with TelemetryReader(path) as reader:
+        assert len(reader) == 10
+        columns = reader.columns()
+        assert list(columns['cell_8']) == [s.voltages[7] for s in snapshots]
+        assert list(columns['temperature']) == [s.summary.max_temperature for s in snapshots]
+        assert chr(int(columns['state'][0])) == 'f'
+        assert chr(int(columns['error'][0])) == '-'
+    assert columns['voltage'][-1] == snapshots[-1].summary.voltage  # Views outlive the reader.
+
+
+def test_recorder_appends_and_ignores_a_partial_row(bus, tmp_path):
+    sbm, _ = bus()
+    path = str(tmp_path / 'telemetry.bin')
+    snapshot = sbm.snapshot()
+    for run in range(2):
+        with TelemetryRecorder(path) as telemetry:
+            telemetry.append(snapshot.summary, snapshot.voltages, timestamp=run)
+    with open(path, 'ab') as f:
+        f.write(b'\0' * 20)  # A row cut short by a crash.
+    with TelemetryReader(path) as reader:
+        assert list(reader.column('timestamp')) == [0, 1]
+        assert reader.table().shape == (2, len(COLUMNS))
+
+
+def test_reader_without_numpy(bus, tmp_path, monkeypatch):
+    sbm, _ = bus()
+    path = str(tmp_path / 'telemetry.bin')
+    snapshot = sbm.snapshot()
+    with TelemetryRecorder(path) as telemetry:
+        telemetry.append(snapshot.summary, snapshot.voltages, timestamp=5)
+    monkeypatch.setattr(recorder, 'np', None)
+    with TelemetryReader(path) as reader:
+        assert list(reader.column('timestamp')) == [5]
+        assert list(reader.column('cell_1')) == [snapshot.voltages[0]]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'not telemetry at all')
+    with pytest.raises(ValueError):
+        TelemetryReader(str(path))
+    with pytest.raises(ValueError):
+        TelemetryRecorder(str(tmp_path / 't.bin')).append(None, [3.7] * 7)
@@ -0,0 +1,41 @@
+import sys
+
+import balance
+import scan
+from simulator import BatterySimulator, SimulatedBattery
+
+
+def test_scan(bus):
+    batteries = [SimulatedBattery(address=a, sn=1000 + a) for a in (1, 2, 5)]
+    sbm, _ = bus(*batteries)
+    found = sbm.scan(1, 8)
+    assert {a: v.sn for a, v in found.items()} == {1: 1001, 2: 1002, 5: 1005}
+    assert sbm.address == '01'
+    assert sorted(sbm.scan(0, 3)) == [0, 1, 2]  # Every battery answers address 0.
+
+
+def test_full_scan_is_fast(bus, clock):
+    sbm, serial = bus(SimulatedBattery(address=200, sn=1200))
+    found = sbm.scan(1, 250)
+    assert list(found) == [200]
+    assert serial.commands == 250
+    assert clock.now < 250 * (balance.SCAN_TIMEOUT + 0.01) + sbm.timeout
+
+
+def test_scan_remembers_version_summaries(bus):
+    sbm, serial = bus(SimulatedBattery(address=3, sn=1003))
+    sbm.scan(1, 4)
+    sent = serial.commands
+    sbm.address = '03'
+    assert sbm.get_battery_sn() == 1003
+    assert serial.commands == sent  # Served from the scan, not read again.
+
+
+def test_scan_cli(monkeypatch, capsys):
+    batteries = [SimulatedBattery(address=a, sn=1000 + a) for a in (2, 4)]
+    with BatterySimulator(batteries, latency=0.0) as sim:
+        monkeypatch.setattr(sys, 'argv', ['scan.py', sim.port, '1', '5'])
+        scan.main()
+    out = capsys.readouterr().out
+    assert 'SN 1002' in out and 'SN 1004' in out
+    assert 'Found 2 battery(s) at addresses 1-5' in out
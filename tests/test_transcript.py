@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import balance
+from replay import replay
+from simulator import SimulatedBattery, SimulatedSerial
+from transcript import READ, WRITE, ReplayError, ReplaySerial, TranscriptWriter, VirtualClock, read_transcript
+
+
+def record(path):
+    """Record a full balancing run of a simulated battery."""
+    clock = VirtualClock()
+    battery = SimulatedBattery(address=0, voltages=[3.70] * 7 + [3.80], sn=1000)
+    transport = SimulatedSerial([battery], clock=clock, timeout=balance.POLL_INTERVAL)
+    with pytest.raises(SystemExit):
+        balance.main(transport.port, telemetry=False, transport=transport, clock=clock, transcript=path)
+    return transport
+
+
+def test_transcript_records_traffic(tmp_path, clock):
+    path = str(tmp_path / 'session.bft')
+    transport = SimulatedSerial([SimulatedBattery(address=1)], clock=clock, timeout=balance.POLL_INTERVAL)
+    sbm = balance.SBM(transport.port, address=1, transport=transport, clock=clock, transcript=path)
+    with sbm:
+        sbm.get_summary()
+    events = read_transcript(path)
+    assert events[0][1:] == (WRITE, b'#01q0\r\n')
+    assert b''.join(data for _, direction, data in events if direction == READ).startswith(b'$01q0 ')
+
+
+def test_replay_matches_the_recording(tmp_path):
+    path = str(tmp_path / 'session.bft')
+    recorded = record(path)
+    transport = replay(path)
+    assert transport.mismatches == 0
+    assert not transport.truncated
+    assert sum(1 for _, direction, _ in transport.events if direction == WRITE) == recorded.commands
+
+
+def test_replay_of_a_truncated_transcript(tmp_path):
+    path = str(tmp_path / 'session.bft')
+    record(path)
+    with open(path, 'rb+') as f:
+        f.truncate(os.path.getsize(path) // 2)  # Cut off mid-run, mid-event.
+    transport = replay(path)
+    assert transport.truncated
+    assert transport.finished
+    assert transport.mismatches == 0
+
+
+def test_strict_replay_stops_at_a_diverging_command(tmp_path):
+    path = str(tmp_path / 'session.bft')
+    record(path)
+    transport = ReplaySerial(path, strict=True)
+    with pytest.raises(ReplayError):
+        transport.write(b'#01q1\r\n')